@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Benchmarks pychai's own hot paths against a local stand-in for LM Studio, so the numbers measure the
+# client rather than the model. Run from anywhere: the benchmark works in a throwaway directory because
+# pychai keeps its data under a relative memory/ folder.
+#
+#   python bench.py                      # default settings
+#   python bench.py --latency 0.2 --token-rate 500 --json results.json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+#############################################
+# Mock LM Studio Server
+#############################################
+
+class MockLMStudio:
+    # Serves /v1/models and /v1/chat/completions (streaming and not). latency is the delay before the
+    # first byte of a reply, token_rate the tokens per second a stream is sent at (0 = as fast as possible).
+    def __init__(self, latency=0.0, token_rate=0.0, reply_tokens=64, models=("bench-convo", "bench-sys")):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.models = list(models)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reply_for(self, payload):
+        last = payload["messages"][-1]["content"] if payload.get("messages") else ""
+        if "grade" in last.lower():
+            return ["85"]
+        return [f"tok{i} " for i in range(self.reply_tokens)]
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; without this, delayed ACKs add ~40 ms per reply.
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+            def do_GET(self):
+                self.send_json({"data": [{"id": model} for model in mock.models]})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with mock.lock:
+                    mock.requests += 1
+                tokens = mock.reply_for(payload)
+                time.sleep(mock.latency)
+                if not payload.get("stream"):
+                    if mock.token_rate:
+                        time.sleep(len(tokens) / mock.token_rate)
+                    self.send_json({
+                        "choices": [{"message": {"role": "assistant", "content": "".join(tokens)}}],
+                        "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens)}
+                    })
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                start = time.time()
+                for i, token in enumerate(tokens):
+                    if mock.token_rate:
+                        delay = start + i / mock.token_rate - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+                    event = {"choices": [{"delta": {"content": token}}]}
+                    self.send_chunk(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n")
+                self.send_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+#############################################
+# Harness
+#############################################
+
+def setup_pychai(workdir, base_url):
+    os.chdir(workdir)
+    import pychai
+    pychai.ensure_folders()
+    pychai.pin_endpoint(base_url)
+    # Measure real requests and keep background summarisation out of the timings.
+    pychai.RESPONSE_CACHE_ENABLED = False
+    pychai.COMPACTION_ENABLED = False
+    pychai.CONVO_MODEL = "bench-convo"
+    pychai.SYS_MODEL = "bench-sys"
+    return pychai
+
+def make_session(pychai):
+    class BenchSession(pychai.Session):
+        # Swallows output, remembering when the first streamed token was written.
+        def __init__(self):
+            super().__init__("bench", "#bench")
+            self.writes = 0
+            self.first_write = None
+
+        @property
+        def remote(self):
+            return True
+
+        def write(self, text):
+            self.writes += 1
+            if self.writes == 2 and self.first_write is None:
+                self.first_write = time.perf_counter()
+
+    session = BenchSession()
+    pychai.current_session.set(session)
+    return session
+
+def reset_channel(pychai, channel):
+    pychai.conversation_histories.pop(channel, None)
+    pychai.load_conversation_history(channel)
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        "min_ms": round(samples[0] * 1000, 3),
+    }
+
+def bench_turn_overhead(pychai, mock, turns):
+    # Non-streaming turn through process_api_request minus a bare POST of the same payload.
+    import requests
+    channel = "#bench"
+    mock.latency, mock.token_rate = 0.0, 0.0
+    raw, client = [], []
+    session = requests.Session()
+    for _ in range(turns):
+        reset_channel(pychai, channel)
+        pychai.conversation_histories[channel].append({"role": "user", "content": "hello"})
+        payload = {"model": pychai.CONVO_MODEL, "messages": pychai.build_context(channel), "stream": False}
+        start = time.perf_counter()
+        session.post(mock.base_url + pychai.CHAT_COMPLETIONS_PATH, json=dict(payload)).json()
+        raw.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        pychai.process_api_request(channel, payload, None)
+        client.append(time.perf_counter() - start)
+    session.close()
+    result = {"bare_post": summarize(raw), "turn": summarize(client)}
+    result["overhead_median_ms"] = round(result["turn"]["median_ms"] - result["bare_post"]["median_ms"], 3)
+    return result
+
+def bench_streaming(pychai, session, mock, turns, latency, token_rate, reply_tokens):
+    channel = "#bench"
+    mock.latency, mock.token_rate, mock.reply_tokens = latency, token_rate, reply_tokens
+    ttft, throughput = [], []
+    for _ in range(turns):
+        reset_channel(pychai, channel)
+        pychai.conversation_histories[channel].append({"role": "user", "content": "hello"})
+        payload = {"model": pychai.CONVO_MODEL, "messages": pychai.build_context(channel), "stream": True}
+        session.writes, session.first_write = 0, None
+        start = time.perf_counter()
+        pychai.process_api_request_stream(channel, payload, None)
+        elapsed = time.perf_counter() - start
+        if session.first_write is not None:
+            ttft.append(session.first_write - start - latency)
+        throughput.append(reply_tokens / elapsed)
+    return {
+        "ttft_over_server_latency": summarize(ttft) if ttft else None,
+        "tokens_per_second_median": round(statistics.median(throughput), 1),
+        "configured_token_rate": token_rate or "unlimited",
+    }
+
+def bench_characterlist(pychai, mock, characters, latency):
+    mock.latency, mock.token_rate, mock.reply_tokens = latency, 0.0, 16
+    for i in range(characters):
+        pychai.character_store.put(f"bench{i:04d}", f"Bench character {i}. " * 20)
+    start = time.perf_counter()
+    pychai.refresh_character_summaries("#bench", pychai.CHARACTERLIST_CONCURRENCY, remake=True)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    pychai.refresh_character_summaries("#bench", pychai.CHARACTERLIST_CONCURRENCY)
+    warm = time.perf_counter() - start
+    return {"characters": characters, "remake_s": round(cold, 3), "unchanged_s": round(warm, 3)}
+
+def bench_selfimprove(pychai, mock, latency, beam):
+    channel = "#bench"
+    mock.latency, mock.token_rate, mock.reply_tokens = latency, 0.0, 64
+    reset_channel(pychai, channel)
+    start = time.perf_counter()
+    pychai.process_selfimprove(channel, "bench", f"80 beam={beam}", None)
+    elapsed = time.perf_counter() - start
+    pychai.confirmation_pending.pop(channel, None)
+    return {"beam": beam, "wall_s": round(elapsed, 3)}
+
+def bench_save_load(pychai, sizes):
+    channel = "#benchlog"
+    results = []
+    for size in sizes:
+        pychai.close_journals()
+        path = pychai.journal_file(channel)
+        if os.path.exists(path):
+            os.remove(path)
+        reset_channel(pychai, channel)
+        for i in range(size):
+            role = "user" if i % 2 == 0 else "assistant"
+            pychai.conversation_histories[channel].append({"role": role, "content": f"message {i} " * 8})
+        start = time.perf_counter()
+        pychai.save_conversation(channel)
+        full_save = time.perf_counter() - start
+        pychai.conversation_histories[channel].append({"role": "user", "content": "one more"})
+        start = time.perf_counter()
+        pychai.save_conversation(channel)
+        append_save = time.perf_counter() - start
+        pychai.close_journals()
+        reset_channel(pychai, channel)
+        start = time.perf_counter()
+        pychai.process_commands(channel, "bench", "load", "", None, [])
+        load = time.perf_counter() - start
+        loaded = len(pychai.conversation_histories[channel]) - 1
+        results.append({
+            "messages": size,
+            "save_full_ms": round(full_save * 1000, 3),
+            "save_append_ms": round(append_save * 1000, 3),
+            "load_ms": round(load * 1000, 3),
+            "loaded": loaded,
+        })
+    return results
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pychai against a mock LM Studio server")
+    parser.add_argument("--latency", type=float, default=0.05, help="server delay before the first byte, seconds")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="streamed tokens per second (0 = unlimited)")
+    parser.add_argument("--reply-tokens", type=int, default=2000, help="tokens per streamed reply")
+    parser.add_argument("--turns", type=int, default=20, help="repetitions for the per-turn benchmarks")
+    parser.add_argument("--characters", type=int, default=50, help="characters for the !characterlist benchmark")
+    parser.add_argument("--beam", type=int, default=4, help="beam width for the !selfimprove benchmark")
+    parser.add_argument("--sizes", default="100,1000,10000", help="history sizes for the save/load benchmark")
+    parser.add_argument("--json", metavar="FILE", help="also write the results as JSON")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_arguments()
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    mock = MockLMStudio().start()
+    workdir = tempfile.TemporaryDirectory(prefix="pychai-bench-")
+    previous_cwd = os.getcwd()
+    pychai = None
+    try:
+        pychai = setup_pychai(workdir.name, mock.base_url)
+        session = make_session(pychai)
+        results = {}
+        benchmarks = [
+            ("turn_overhead", lambda: bench_turn_overhead(pychai, mock, args.turns)),
+            ("streaming", lambda: bench_streaming(pychai, session, mock, args.turns, args.latency, args.token_rate, args.reply_tokens)),
+            ("characterlist", lambda: bench_characterlist(pychai, mock, args.characters, args.latency)),
+            ("selfimprove", lambda: bench_selfimprove(pychai, mock, args.latency, args.beam)),
+            ("save_load", lambda: bench_save_load(pychai, sizes)),
+        ]
+        for name, run in benchmarks:
+            results[name] = run()
+            print(f"{name}: {json.dumps(results[name])}", flush=True)
+    finally:
+        # The journals and the character database must be closed before the directory can be removed.
+        if pychai is not None:
+            pychai.close_journals()
+            pychai.character_store.close()
+        os.chdir(previous_cwd)
+        mock.stop()
+        workdir.cleanup()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
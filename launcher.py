@@ -1,7 +1,10 @@
 import os
 import sys
+import json
+import hashlib
 import subprocess
 import urllib.request
+import urllib.error
 
 # Define working directory in Downloads
 workspace = os.path.join(os.path.expanduser("~"), "Downloads", "character.py")
@@ -17,24 +20,91 @@ requirements_url = "https://raw.githubusercontent.com/cdexstra1/character.py/mai
 # Define local file paths
 pychai_path = os.path.join(workspace, "pychai.py")
 requirements_path = os.path.join(workspace, "requirements.txt")
+# ETags, content hashes and the last installed requirements hash, so unchanged files are neither
+# downloaded nor reinstalled.
+cache_path = os.path.join(workspace, "launcher_cache.json")
+
+# Seconds to wait for GitHub before falling back to the cached copy
+DOWNLOAD_TIMEOUT = 5
+
+def load_cache():
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_path, cache_path)
+
+def file_sha256(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
 
 # Download function
-def download_file(url, path):
+def download_file(url, path, cache):
+    # Sends the stored ETag/Last-Modified so an unchanged file costs one 304 response. The validators are
+    # only used while the local copy still matches the hash recorded when it was downloaded.
+    entry = cache.get(url, {})
+    request = urllib.request.Request(url)
+    if entry and entry.get("sha256") == file_sha256(path):
+        if entry.get("etag"):
+            request.add_header("If-None-Match", entry["etag"])
+        if entry.get("last_modified"):
+            request.add_header("If-Modified-Since", entry["last_modified"])
     try:
+        with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+            body = response.read()
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return True
+        return use_cached_copy(url, path, e)
+    except Exception as e:
+        return use_cached_copy(url, path, e)
+    digest = hashlib.sha256(body).hexdigest()
+    if digest != file_sha256(path):
         print(f"Downloading {url}...")
-        urllib.request.urlretrieve(url, path)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
         print(f"Saved to {path}")
-    except Exception as e:
-        print(f"Failed to download {url}: {e}")
+    cache[url] = {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"), "sha256": digest}
+    return True
+
+def use_cached_copy(url, path, error):
+    if os.path.exists(path):
+        print(f"Could not check {url} ({error}); using the cached copy.")
+        return True
+    print(f"Failed to download {url}: {error}")
+    return False
+
+cache = load_cache()
 
 # Download pychai.py and requirements.txt
-download_file(pychai_url, pychai_path)
-download_file(requirements_url, requirements_path)
+download_file(pychai_url, pychai_path, cache)
+download_file(requirements_url, requirements_path, cache)
 
-# Install dependencies (if requirements.txt exists)
+# Install dependencies (if requirements.txt exists and changed since the last successful install)
 if os.path.exists(requirements_path):
-    print("Installing dependencies from requirements.txt...")
-    subprocess.run([sys.executable, "-m", "pip", "install", "-r", requirements_path], check=True)
+    requirements_hash = hashlib.sha256((sys.executable + "\0" + (file_sha256(requirements_path) or "")).encode("utf-8")).hexdigest()
+    if cache.get("requirements_installed") != requirements_hash:
+        print("Installing dependencies from requirements.txt...")
+        subprocess.run([sys.executable, "-m", "pip", "install", "-r", requirements_path], check=True)
+        cache["requirements_installed"] = requirements_hash
+
+try:
+    save_cache(cache)
+except OSError as e:
+    print(f"Could not save launcher cache: {e}")
 
 # Ensure 'memory' folder is created in Downloads (or any safe folder under Downloads)
 folder = os.path.join(workspace, "memory")
@@ -44,6 +114,6 @@ if not os.path.exists(folder):
 # Run pychai.py
 if os.path.exists(pychai_path):
     print(f"Running {pychai_path}...")
-    subprocess.run([sys.executable, pychai_path], check=True)
+    subprocess.run([sys.executable, pychai_path] + sys.argv[1:], check=True)
 else:
     print("Error: pychai.py not found. Check your GitHub URL.")
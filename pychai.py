@@ -1,35 +1,90 @@
 import os
 import time
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import re
+import hashlib
 import threading
+import queue
 import sys
+import mmap
+import collections
+import math
+import collections.abc
+import contextvars
+import contextlib
+import functools
+import atexit
+import cProfile
+import pstats
+import io
+import itertools
+import heapq
+import argparse
+import csv
+import sqlite3
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 #############################################
 # Progress Animation Helpers (Rotating Line)
 #############################################
 
-def progress_animation(message, stop_event):
+# One long-lived spinner thread renders whichever progress message is newest; callers only push and pop
+# messages instead of starting a thread per request.
+progress_messages = []
+progress_lock = threading.Lock()
+progress_wakeup = threading.Event()
+progress_thread = None
+
+def progress_animation():
     spinner = ['-', '\\', '|', '/']
     i = 0
-    while not stop_event.is_set():
+    shown = None
+    while True:
+        with progress_lock:
+            message = progress_messages[-1] if progress_messages else None
+        if message is None:
+            if shown is not None:
+                sys.stdout.write("\r" + " " * (len(shown) + 2) + "\r")
+                sys.stdout.flush()
+                shown = None
+            progress_wakeup.wait()
+            progress_wakeup.clear()
+            continue
+        if shown is not None and shown != message:
+            sys.stdout.write("\r" + " " * (len(shown) + 2) + "\r")
         anim = f"{message} {spinner[i % len(spinner)]}"
         sys.stdout.write("\r" + anim)
         sys.stdout.flush()
-        time.sleep(0.15)  # 50% slower than before
+        shown = message
+        progress_wakeup.wait(0.15)  # 50% slower than before
+        progress_wakeup.clear()
         i += 1
-    sys.stdout.write("\r" + " " * (len(message) + 2) + "\r")
-    sys.stdout.flush()
 
 def run_with_progress(message, func, *args, **kwargs):
-    stop_event = threading.Event()
-    thread = threading.Thread(target=progress_animation, args=(message, stop_event))
-    thread.start()
-    result = func(*args, **kwargs)
-    stop_event.set()
-    thread.join()
-    return result
+    global progress_thread
+    if current_session.get().remote:
+        # A network client cannot redraw a spinner line, so it just gets the message.
+        command_output(None, message + "...")
+        return func(*args, **kwargs)
+    with progress_lock:
+        if progress_thread is None:
+            progress_thread = threading.Thread(target=progress_animation, daemon=True)
+            progress_thread.start()
+        progress_messages.append(message)
+    progress_wakeup.set()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        with progress_lock:
+            progress_messages.remove(message)
+        progress_wakeup.set()
+        # Give the spinner a moment to erase its line before the caller prints.
+        time.sleep(0.02)
 
 #############################################
 # Global Configuration and Variables
@@ -44,18 +99,16 @@ available_models = []
 
 BASE_FOLDER = "memory"
 CHARACTERS_FOLDER = os.path.join(BASE_FOLDER, "characters")
+CHARACTER_DB_FILE = os.path.join(BASE_FOLDER, "characters.db")
 SAVED_CONVOS_FOLDER = os.path.join(BASE_FOLDER, "savedconvos")
 CONVERSATIONS_FOLDER = os.path.join(BASE_FOLDER, "conversations")
 USERNAME_FILE = os.path.join(BASE_FOLDER, "username.txt")
 CHARACTERLIST_FILE = os.path.join(BASE_FOLDER, "characterlist.txt")
+CHARACTERLIST_INDEX_FILE = os.path.join(BASE_FOLDER, "characterlist_index.json")
 
 # conversation_histories stores only the formatted chat messages.
 conversation_histories = {}
 
-multi_input_pending = {}   # channel -> dict
-confirmation_pending = {}  # channel -> dict
-
-username = ""
 
 role_colors = {
     "system": "\033[33m",  # yellow
@@ -92,66 +145,1140 @@ CUSTOM_QUESTIONSET_PROMPT = ("Generate a detailed, consistent, high-quality syst
 
 server_status = None
 
+# Number of summaries !characterlist requests at once; can be overridden per call with !characterlist remake <n>.
+CHARACTERLIST_CONCURRENCY = 8
+# Number of system prompts !batchcreate / --batch-create generates at once.
+BATCH_CREATE_CONCURRENCY = 4
+# Spec fields fed to CUSTOM_QUESTIONSET_PROMPT, in the order and with the labels !questionset uses.
+CHARACTER_SPEC_FIELDS = [
+    ("background", "Background"),
+    ("personality", "Personality"),
+    ("abilities", "Special Abilities/Additional Details"),
+    ("instructions", "Extra Instructions"),
+]
+
+# Context sent with each chat request: "sliding" keeps the system prompt, hints and pinned messages plus the
+# newest turns that fit in CONTEXT_TOKEN_BUDGET; "full" sends the whole history as before.
+CONTEXT_TOKEN_BUDGET = 4096
+CONTEXT_STRATEGY = "sliding"
+CONTEXT_STRATEGIES = ["sliding", "full"]
+# Rough per-message framing cost added on top of the content estimate.
+CONTEXT_MESSAGE_OVERHEAD = 4
+# "stable" keeps the bytes sent ahead of the newest turns unchanged from request to request so LM Studio can
+# reuse its cached prefix: hints go in a slot after the conversation instead of being inserted into the
+# history, and the sliding window trims down to CONTEXT_LOW_WATERMARK of the budget in one go and then holds
+# that cut until the budget is exceeded again. "inline" is the original layout.
+CONTEXT_LAYOUT = "stable"
+CONTEXT_LAYOUTS = ["stable", "inline"]
+CONTEXT_LOW_WATERMARK = 0.75
+# Report when a request no longer starts with what the previous request sent.
+CONTEXT_PREFIX_WARNINGS = True
+# Once a channel has more than COMPACTION_THRESHOLD tokens of unsummarised turns, the older ones are folded
+# into a running summary in the background, leaving the newest COMPACTION_KEEP_RECENT tokens verbatim.
+COMPACTION_ENABLED = True
+COMPACTION_THRESHOLD = 3072
+COMPACTION_KEEP_RECENT = 1024
+
+# Conversations are journaled to memory/conversations/<name>.jsonl, one JSON record per message.
+JOURNAL_FSYNC_BATCH = 16        # records written before the journal is fsynced
+JOURNAL_FSYNC_INTERVAL = 2.0    # seconds between fsyncs while records are pending
+JOURNAL_COMPACT_SLACK = 64      # extra records tolerated before the journal is rewritten from the history
+
+# !selfimprove defaults; each can be overridden per call, e.g. !selfimprove 85 beam=4 rounds=5 time=300
+SELFIMPROVE_THRESHOLD = 80
+SELFIMPROVE_BEAM = 1          # candidate prompts generated and graded concurrently per round
+SELFIMPROVE_MAX_ROUNDS = 10
+SELFIMPROVE_TIME_BUDGET = 600  # seconds of wall-clock time before the best candidate so far is offered
+
+# Non-interactive SYS_MODEL replies are cached on disk, keyed by model, messages and sampling parameters,
+# so re-running the same improve/grade/summary flow does not hit LM Studio again. Least recently used
+# entries are evicted once either bound is exceeded.
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_FOLDER = os.path.join(BASE_FOLDER, "response_cache")
+RESPONSE_CACHE_MAX_ENTRIES = 512
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# !iterate <n> asks for n alternative replies at once (one keystroke picks one). LM Studio ignores the OpenAI
+# "n" parameter, so by default the variants are separate requests sent in parallel.
+ITERATE_MAX_VARIANTS = 9
+ITERATE_USE_N_PARAMETER = False
+
+# Every LM Studio call is timed; !stats shows percentiles over the newest METRICS_MAX_SAMPLES requests per
+# model/command/endpoint. When METRICS_PROMETHEUS_FILE is set (or !stats export <path> is used), the same
+# numbers are written there in Prometheus text format at most every METRICS_EXPORT_INTERVAL seconds.
+METRICS_MAX_SAMPLES = 1000
+METRICS_PROMETHEUS_FILE = None
+METRICS_EXPORT_INTERVAL = 10
+
+# Span tracing around command dispatch, file I/O, HTTP calls and stream parsing, written as a Chrome trace
+# (chrome://tracing, Perfetto). Set PYCHAI_TRACE=<file> to trace from startup, or use !trace on|off.
+TRACE_FILE = os.environ.get("PYCHAI_TRACE") or None
+TRACE_DEFAULT_FILE = os.path.join(BASE_FOLDER, "trace.json")
+TRACE_MAX_EVENTS = 200000
+# !profile <command> saves the raw cProfile data here and prints the top functions by cumulative time.
+PROFILE_FOLDER = os.path.join(BASE_FOLDER, "profiles")
+PROFILE_TOP_FUNCTIONS = 25
+
+# Streamed tokens are written to the terminal in batches: whichever of these limits is hit first flushes.
+STREAM_FLUSH_INTERVAL = 0.05  # seconds
+STREAM_FLUSH_CHARS = 256
+
+#############################################
+# Sessions
+#############################################
+
+class Session:
+    # Per-user state: who is typing, which channel they are in and any half-finished multi-step input.
+    # The local terminal is one session; every network connection in server mode gets its own.
+    def __init__(self, username="", channel="#welcome", writer=None, loop=None):
+        self.username = username
+        self.channel = channel
+        self.writer = writer
+        self.loop = loop
+        self.multi_input_pending = {}   # channel -> dict
+        self.confirmation_pending = {}  # channel -> dict
+        self.exit_requested = False
+        self.closed = False
+
+    @property
+    def remote(self):
+        return self.writer is not None
+
+    def write(self, text):
+        if self.writer is None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        elif not self.closed:
+            # Handlers run in worker threads; the socket belongs to the event loop.
+            self.loop.call_soon_threadsafe(self.writer.write, text.encode("utf-8"))
+
+local_session = Session()
+current_session = contextvars.ContextVar("current_session", default=local_session)
+
+class SessionScopedDict(collections.abc.MutableMapping):
+    # Module-level view of one of the current session's dicts, so handlers can keep using
+    # multi_input_pending / confirmation_pending while each connection has its own state.
+    def __init__(self, attribute):
+        self.attribute = attribute
+
+    def target(self):
+        return getattr(current_session.get(), self.attribute)
+
+    def __getitem__(self, key):
+        return self.target()[key]
+
+    def __setitem__(self, key, value):
+        self.target()[key] = value
+
+    def __delitem__(self, key):
+        del self.target()[key]
+
+    def __iter__(self):
+        return iter(self.target())
+
+    def __len__(self):
+        return len(self.target())
+
+multi_input_pending = SessionScopedDict("multi_input_pending")
+confirmation_pending = SessionScopedDict("confirmation_pending")
+
+def session_username():
+    return current_session.get().username
+
+def get_current_channel():
+    return current_session.get().channel
+
+def set_current_channel(channel):
+    current_session.get().channel = channel
+
+#############################################
+# Channel State
+#############################################
+
+class ChannelState:
+    # Everything that serialises work on one channel. Jobs for a channel (chat turns, commands, multi-line
+    # input) go through its mailbox and run one at a time in arrival order, while different channels
+    # run in parallel. The lock guards the channel's history against background threads such as
+    # summarisation, which run outside the mailbox.
+    def __init__(self, channel):
+        self.channel = channel
+        self.lock = threading.RLock()
+        self.mailbox = collections.deque()  # (session, job coroutine function, future or None for chat turns)
+        self.worker = None                  # asyncio.Task draining the mailbox
+        self.cancel_event = None            # set by !cancel to stop the reply that is streaming
+
+channel_states = {}
+channel_states_lock = threading.Lock()
+# Guards process-wide settings shared by every channel (models list, current models).
+global_state_lock = threading.RLock()
+
+def channel_state(channel):
+    with channel_states_lock:
+        state = channel_states.get(channel)
+        if state is None:
+            state = channel_states[channel] = ChannelState(channel)
+        return state
+
 #############################################
 # Helper Functions for Output
 #############################################
 
+def output_write(text):
+    current_session.get().write(text)
+
 def conversation_output(channel, role, message):
     # Prints a conversation line with proper color formatting.
     if role == "user":
-        print(f"{role_colors['user']}{username}\033[0m: {message}")
+        output_write(f"{role_colors['user']}{session_username()}\033[0m: {message}\n")
     elif role == "assistant":
         char_name = channel.lstrip("#")
         if channel == "#welcome":
             char_name = "Velvet's (py)chai"
-        print(f"{role_colors['assistant']}{char_name}\033[0m: {message}")
+        output_write(f"{role_colors['assistant']}{char_name}\033[0m: {message}\n")
     else:
-        print(f"{role_colors['system']}{message}\033[0m")
+        output_write(f"{role_colors['system']}{message}\033[0m\n")
 
 def command_output(channel, message):
-    print(f"{role_colors['command']}{message}\033[0m")
+    output_write(f"{role_colors['command']}{message}\033[0m\n")
 
 #############################################
-# LM Studio API Endpoint Helpers
+# Tracing
 #############################################
 
-def get_lm_api_url():
-    try:
-        r = requests.get("http://localhost:1234/v1/models", timeout=2)
-        if r.status_code == 200:
-            return "http://localhost:1234/v1/chat/completions"
-    except Exception:
-        pass
-    return "http://velvet.tinysun.net:1234/v1/chat/completions"
+class Tracer:
+    # Collects complete ("X") events in memory and writes them as one Chrome trace JSON file. Spans are
+    # per thread, so nesting inside a thread is exact; pool workers show up as their own tracks.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.path = None
+        self.events = []
+        self.dropped = 0
+        self.threads = {}
+        self.origin = time.perf_counter()
+
+    def enable(self, path):
+        with self.lock:
+            self.path = path
+            self.events = []
+            self.dropped = 0
+            self.threads = {}
+            self.origin = time.perf_counter()
+            self.enabled = True
+
+    def disable(self):
+        count = self.flush()
+        self.enabled = False
+        return count
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter(), args)
+
+    def add(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+                 "ts": round((start - self.origin) * 1e6, 3), "dur": round((end - start) * 1e6, 3)}
+        if args:
+            event["args"] = {key: str(value) for key, value in args.items()}
+        with self.lock:
+            if len(self.events) >= TRACE_MAX_EVENTS:
+                self.dropped += 1
+                return
+            self.events.append(event)
+            self.threads.setdefault(thread.ident, thread.name)
 
-def get_models_url():
+    def flush(self):
+        # Rewrites the whole file, so it always holds every span recorded since tracing was turned on.
+        with self.lock:
+            if not self.enabled or not self.path:
+                return 0
+            pid = os.getpid()
+            names = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": ident, "args": {"name": name}}
+                     for ident, name in self.threads.items()]
+            trace = {"traceEvents": names + self.events, "displayTimeUnit": "ms",
+                     "otherData": {"version": VERSION, "dropped_events": self.dropped}}
+            count = len(self.events)
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        write_text_atomic(self.path, json.dumps(trace))
+        return count
+
+tracer = Tracer()
+if TRACE_FILE:
+    tracer.enable(TRACE_FILE)
+
+@atexit.register
+def flush_trace():
     try:
-        r = requests.get("http://localhost:1234/v1/models", timeout=2)
-        if r.status_code == 200:
-            return "http://localhost:1234/v1/models"
-    except Exception:
+        tracer.flush()
+    except OSError:
         pass
-    return "http://velvet.tinysun.net:1234/v1/models"
 
-def test_connection():
+def traced(category, name=None):
+    # Decorator form of tracer.span; costs one attribute check while tracing is off.
+    def decorate(func):
+        label = name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(label, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+#############################################
+# LM Studio API Endpoint Helpers
+#############################################
+
+LOCAL_BASE_URL = "http://localhost:1234"
+REMOTE_BASE_URL = "http://velvet.tinysun.net:1234"
+ENDPOINT_CANDIDATES = [LOCAL_BASE_URL, REMOTE_BASE_URL]
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+MODELS_PATH = "/v1/models"
+ENDPOINT_PROBE_TIMEOUT = 2
+# Seconds a resolved endpoint is trusted before it is re-probed in the background.
+ENDPOINT_TTL = 60
+
+# The resolved base URL is shared by every request; probing happens once and is refreshed off the request path.
+endpoint_state = {"base_url": None, "checked_at": 0.0, "probing": False, "pinned": False}
+endpoint_lock = threading.Lock()
+
+def probe_endpoint(base_url):
     try:
-        start = time.time()
-        r = requests.get("http://localhost:1234/v1/models", timeout=2)
-        ping = (time.time() - start) * 1000
-        if r.status_code == 200:
-            return f"Connected to LM Studio at localhost (ping: {int(ping)}ms)"
+        r = lm_client.probe(base_url)
+        return r.status_code == 200
     except Exception:
-        pass
+        return False
+
+def probe_endpoints():
+    # Returns the first reachable candidate, falling back to the last one like the original helpers did.
+    for base_url in ENDPOINT_CANDIDATES:
+        if probe_endpoint(base_url):
+            return base_url
+    return ENDPOINT_CANDIDATES[-1]
+
+def set_endpoint(base_url):
+    with endpoint_lock:
+        if endpoint_state["pinned"]:
+            return
+        endpoint_state["base_url"] = base_url
+        endpoint_state["checked_at"] = time.time()
+
+def pin_endpoint(base_url):
+    # A pinned endpoint is used as-is: no probes, no background refresh and no failover.
+    with endpoint_lock:
+        endpoint_state["base_url"] = base_url.rstrip("/")
+        endpoint_state["checked_at"] = time.time()
+        endpoint_state["pinned"] = True
+
+def refresh_endpoint():
+    base_url = probe_endpoints()
+    set_endpoint(base_url)
+    return base_url
+
+def background_refresh_endpoint():
     try:
-        start = time.time()
-        r = requests.get("http://velvet.tinysun.net:1234/v1/models", timeout=2)
-        ping = (time.time() - start) * 1000
-        if r.status_code == 200:
-            return f"Connected to LM Studio at velvet.tinysun.net (ping: {int(ping)}ms)"
-    except Exception:
-        pass
+        refresh_endpoint()
+    finally:
+        with endpoint_lock:
+            endpoint_state["probing"] = False
+
+def get_base_url():
+    with endpoint_lock:
+        base_url = endpoint_state["base_url"]
+        stale = time.time() - endpoint_state["checked_at"] > ENDPOINT_TTL and not endpoint_state["pinned"]
+        start_probe = base_url is not None and stale and not endpoint_state["probing"]
+        if start_probe:
+            endpoint_state["probing"] = True
+    if base_url is None:
+        return refresh_endpoint()
+    if start_probe:
+        threading.Thread(target=background_refresh_endpoint, daemon=True).start()
+    return base_url
+
+def mark_endpoint_failed(base_url):
+    # Switches to the next candidate straight away and lets a background probe confirm the choice later.
+    if base_url in ENDPOINT_CANDIDATES:
+        index = ENDPOINT_CANDIDATES.index(base_url)
+        fallback = ENDPOINT_CANDIDATES[(index + 1) % len(ENDPOINT_CANDIDATES)]
+    else:
+        fallback = ENDPOINT_CANDIDATES[0]
+    with endpoint_lock:
+        if endpoint_state["base_url"] == base_url and not endpoint_state["pinned"]:
+            endpoint_state["base_url"] = fallback
+            # Expire the entry so the next lookup triggers a background re-probe.
+            endpoint_state["checked_at"] = 0.0
+        return endpoint_state["base_url"]
+
+#############################################
+# Pooled HTTP Client
+#############################################
+
+HTTP_POOL_CONNECTIONS = 4     # distinct hosts kept in the pool (localhost and the remote fallback)
+HTTP_POOL_MAXSIZE = 16        # keep-alive connections per host
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 600       # generations on a busy host can take minutes
+HTTP_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.5
+
+class LMClient:
+    # One pooled session for all LM Studio traffic so connections are reused across turns and commands.
+    def __init__(self, pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        # The adapter only retries gateway errors. Connection failures are handled in request() so they can
+        # fail over to the next endpoint immediately, and read errors are never replayed because the
+        # generation may already have run.
+        retry = Retry(
+            total=retries,
+            connect=0,
+            read=0,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=["GET", "POST"],
+            raise_on_status=False
+        )
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update({"Connection": "keep-alive"})
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        # Probes get their own pool without any retry policy so an unreachable host is detected within one timeout.
+        self.probe_session = requests.Session()
+        self.probe_session.mount("http://", HTTPAdapter(pool_connections=pool_connections, pool_maxsize=2, max_retries=0))
+        self.probe_session.mount("https://", HTTPAdapter(pool_connections=pool_connections, pool_maxsize=2, max_retries=0))
+
+    def request(self, method, path, **kwargs):
+        with tracer.span(f"{method} {path}", "http", stream=bool(kwargs.get("stream"))):
+            return self.send(method, path, **kwargs)
+
+    def send(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        base_url = get_base_url()
+        attempt = 0
+        while True:
+            try:
+                return self.session.request(method, base_url + path, **kwargs)
+            except requests.ConnectionError:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                fallback = mark_endpoint_failed(base_url)
+                # Back off only once every candidate has failed; switching hosts is immediate.
+                if attempt % len(ENDPOINT_CANDIDATES) == 0 or fallback == base_url:
+                    time.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+                base_url = fallback
+            except requests.Timeout:
+                mark_endpoint_failed(base_url)
+                raise
+
+    def post(self, payload, **kwargs):
+        return self.request("POST", CHAT_COMPLETIONS_PATH, json=payload, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def probe(self, base_url, timeout=ENDPOINT_PROBE_TIMEOUT):
+        return self.probe_session.get(base_url + MODELS_PATH, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+        self.probe_session.close()
+
+lm_client = LMClient()
+
+#############################################
+# Request Scheduler
+#############################################
+
+# Priority classes, lowest number first. Interactive chat turns always jump ahead of system jobs.
+PRIORITY_INTERACTIVE = 0   # chat replies, !user, regenerations the user is waiting on
+PRIORITY_SYSTEM = 1        # one-off system model jobs: !improve, !set, !questionset, difference summaries
+PRIORITY_BULK = 2          # fan-out jobs: !characterlist, !selfimprove candidates, background summaries
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_SYSTEM: "system", PRIORITY_BULK: "bulk"}
+
+MODEL_CONCURRENCY_DEFAULT = 4   # requests in flight per model
+MODEL_CONCURRENCY = {}          # model id -> limit overriding the default
+INTERACTIVE_RESERVED_SLOTS = 1  # slots per model that background jobs may never take
+SCHEDULER_MAX_QUEUED = 32       # bulk requests allowed to wait; further submitters block before queueing
+
+class RequestScheduler:
+    # Grants request slots per model in priority order (FIFO within a class). Background work is kept out of
+    # the slots reserved for interactive turns, and once too many bulk requests are waiting, new ones block
+    # before even joining the queue so bulk jobs slow down instead of piling up on the host.
+    def __init__(self, default_limit=MODEL_CONCURRENCY_DEFAULT, limits=MODEL_CONCURRENCY,
+                 reserved=INTERACTIVE_RESERVED_SLOTS, max_queued=SCHEDULER_MAX_QUEUED):
+        self.default_limit = default_limit
+        self.limits = limits
+        self.reserved = reserved
+        self.max_queued = max_queued
+        self.condition = threading.Condition()
+        self.active = collections.Counter()
+        self.waiting = []
+        self.queued_bulk = 0
+        self.counter = itertools.count()
+
+    def limit(self, model, priority):
+        limit = self.limits.get(model, self.default_limit)
+        if priority > PRIORITY_INTERACTIVE:
+            limit = max(1, limit - self.reserved)
+        return limit
+
+    def can_start(self, entry):
+        priority, _, model = entry
+        if self.active[model] >= self.limit(model, priority):
+            return False
+        return not any(other[2] == model and other < entry for other in self.waiting)
+
+    @contextlib.contextmanager
+    def slot(self, model, priority=PRIORITY_INTERACTIVE):
+        entry = (priority, next(self.counter), model)
+        bulk = priority >= PRIORITY_BULK
+        with self.condition:
+            if bulk:
+                while self.queued_bulk >= self.max_queued:
+                    self.condition.wait()
+                self.queued_bulk += 1
+            heapq.heappush(self.waiting, entry)
+            try:
+                while not self.can_start(entry):
+                    self.condition.wait()
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                if bulk:
+                    self.queued_bulk -= 1
+                self.condition.notify_all()
+            self.active[model] += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active[model] -= 1
+                self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            waiting = collections.Counter((entry[2], entry[0]) for entry in self.waiting)
+            models = sorted(set(self.active) | set(model for model, _ in waiting))
+            lines = []
+            for model in models:
+                queued = ", ".join(f"{PRIORITY_NAMES[priority]} {waiting[(model, priority)]}" for priority in sorted(PRIORITY_NAMES) if waiting[(model, priority)])
+                lines.append(f"{model}: {self.active[model]}/{self.limits.get(model, self.default_limit)} in flight" + (f", waiting: {queued}" if queued else ""))
+            return lines
+
+scheduler = RequestScheduler()
+
+#############################################
+# Request Metrics
+#############################################
+
+# Label for the metrics of any LM Studio call made in this context: the command being run, "chat" for a
+# chat turn, "background" for threads that were started without one.
+metrics_command = contextvars.ContextVar("metrics_command", default="background")
+
+def submit_in_context(executor, func, *args):
+    # Pool threads don't inherit contextvars; run the task in a copy of the submitter's context so its
+    # requests keep the session and the metrics label.
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+def endpoint_label(response=None):
+    url = getattr(response, "url", None) or endpoint_state["base_url"] or ""
+    return urllib.parse.urlsplit(url).netloc or "unknown"
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+class RequestMetrics:
+    # Counters plus a bounded window of samples per (model, command, endpoint). Latency is measured from
+    # the moment a scheduler slot is granted, so queue_wait (client-side) and latency (network + model)
+    # can be told apart; TTFT is only known for streamed replies.
+    def __init__(self, max_samples=METRICS_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.series = {}
+        self.last_export = 0.0
+
+    def new_series(self):
+        window = lambda: collections.deque(maxlen=self.max_samples)
+        return {"requests": 0, "errors": collections.Counter(), "prompt_tokens": 0, "completion_tokens": 0,
+                "latency_sum": 0.0, "latency": window(), "ttft": window(), "tokens_per_second": window(), "queue_wait": window()}
+
+    def record(self, model, endpoint, latency, queue_wait=0.0, ttft=None, prompt_tokens=0, completion_tokens=0, error=None):
+        key = (model or "unknown", metrics_command.get(), endpoint or "unknown")
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = self.new_series()
+            series["requests"] += 1
+            series["latency_sum"] += latency
+            series["latency"].append(latency)
+            series["queue_wait"].append(queue_wait)
+            if error:
+                series["errors"][error] += 1
+            else:
+                series["prompt_tokens"] += prompt_tokens
+                series["completion_tokens"] += completion_tokens
+                if ttft is not None:
+                    series["ttft"].append(ttft)
+                generation = latency - (ttft or 0.0)
+                if completion_tokens and generation > 0:
+                    series["tokens_per_second"].append(completion_tokens / generation)
+        self.maybe_export()
+
+    def record_response(self, payload, response, latency, queue_wait=0.0):
+        if response.status_code != 200:
+            self.record(payload.get("model"), endpoint_label(response), latency, queue_wait, error=f"HTTP {response.status_code}")
+            return
+        try:
+            data = response.json()
+        except ValueError:
+            self.record(payload.get("model"), endpoint_label(response), latency, queue_wait, error="bad JSON")
+            return
+        usage = data.get("usage") or {}
+        content = (data.get("choices") or [{}])[0].get("message", {}).get("content") or ""
+        self.record(payload.get("model"), endpoint_label(response), latency, queue_wait,
+                    prompt_tokens=usage.get("prompt_tokens") or sum(message_tokens(msg) for msg in payload.get("messages", [])),
+                    completion_tokens=usage.get("completion_tokens") or estimate_tokens(content))
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+    def summary_lines(self):
+        def quantiles(samples, unit, scale=1.0):
+            if not samples:
+                return "n/a"
+            return "/".join(f"{percentile(samples, q) * scale:.{2 if scale == 1.0 else 0}f}" for q in (0.5, 0.95, 0.99)) + unit
+        lines = []
+        with self.lock:
+            for (model, command, endpoint), series in sorted(self.series.items()):
+                errors = sum(series["errors"].values())
+                error_text = f", {errors} errors ({', '.join(f'{kind} x{count}' for kind, count in series['errors'].most_common(3))})" if errors else ""
+                lines.append(
+                    f"{model} | {command} | {endpoint}: {series['requests']} requests{error_text}\n"
+                    f"  latency p50/p95/p99 {quantiles(series['latency'], ' s')}, TTFT {quantiles(series['ttft'], ' s')}, "
+                    f"queue wait {quantiles(series['queue_wait'], ' ms', 1000.0)}\n"
+                    f"  tokens/s p50/p95/p99 {quantiles(series['tokens_per_second'], '')}, "
+                    f"tokens in/out {series['prompt_tokens']}/{series['completion_tokens']}"
+                )
+        return lines
+
+    def prometheus_text(self):
+        def labels(key, **extra):
+            names = dict(zip(("model", "command", "endpoint"), key), **extra)
+            return "{" + ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in names.items()) + "}"
+        out = []
+        summaries = [("latency", "pychai_request_latency_seconds", "LM Studio request latency after a scheduler slot was granted."),
+                     ("ttft", "pychai_time_to_first_token_seconds", "Time to the first streamed token."),
+                     ("queue_wait", "pychai_queue_wait_seconds", "Time spent waiting for a scheduler slot."),
+                     ("tokens_per_second", "pychai_tokens_per_second", "Completion tokens per second of generation.")]
+        with self.lock:
+            items = sorted(self.series.items())
+            for field, metric, help_text in summaries:
+                out += [f"# HELP {metric} {help_text}", f"# TYPE {metric} summary"]
+                for key, series in items:
+                    samples = series[field]
+                    if not samples:
+                        continue
+                    for q in (0.5, 0.95, 0.99):
+                        out.append(f"{metric}{labels(key, quantile=q)} {percentile(samples, q):.6f}")
+                    out.append(f"{metric}_sum{labels(key)} {sum(samples):.6f}")
+                    out.append(f"{metric}_count{labels(key)} {len(samples)}")
+            counters = [("requests", "pychai_requests_total", "LM Studio requests made."),
+                        ("prompt_tokens", "pychai_prompt_tokens_total", "Prompt tokens sent."),
+                        ("completion_tokens", "pychai_completion_tokens_total", "Completion tokens received.")]
+            for field, metric, help_text in counters:
+                out += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+                out += [f"{metric}{labels(key)} {series[field]}" for key, series in items]
+            out += ["# HELP pychai_request_errors_total Failed LM Studio requests.", "# TYPE pychai_request_errors_total counter"]
+            for key, series in items:
+                out += [f"pychai_request_errors_total{labels(key, kind=kind)} {count}" for kind, count in sorted(series["errors"].items())]
+        return "\n".join(out) + "\n"
+
+    def export(self, path):
+        write_text_atomic(path, self.prometheus_text())
+        self.last_export = time.time()
+
+    def maybe_export(self):
+        path = METRICS_PROMETHEUS_FILE
+        if path and time.time() - self.last_export >= METRICS_EXPORT_INTERVAL:
+            try:
+                self.export(path)
+            except OSError:
+                pass
+
+request_metrics = RequestMetrics()
+
+#############################################
+# Response Cache
+#############################################
+
+class CachedResponse:
+    # Stands in for a requests.Response so callers don't care whether a reply came from the cache.
+    status_code = 200
+    ok = True
+
+    def __init__(self, data):
+        self.data = data
+        self.text = json.dumps(data)
+
+    def json(self):
+        return json.loads(self.text)
+
+class ResponseCache:
+    # One JSON file per reply under RESPONSE_CACHE_FOLDER. Recency is tracked in memory and mirrored in the
+    # files' mtimes, so the LRU order survives restarts without a separate index file.
+    def __init__(self, folder=RESPONSE_CACHE_FOLDER):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.entries = None  # key -> size in bytes, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def key(self, payload):
+        # Everything except the transport flag takes part: model, messages and any sampling parameters.
+        material = {k: v for k, v in payload.items() if k != "stream"}
+        return hashlib.sha256(json.dumps(material, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key + ".json")
+
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        if not os.path.isdir(self.folder):
+            return
+        found = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            found.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    @traced("file")
+    def get(self, key):
+        with self.lock:
+            self.load()
+            if key in self.entries:
+                try:
+                    with open(self.path(key), "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    os.utime(self.path(key))
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+                except (OSError, ValueError):
+                    self.forget(key)
+            self.misses += 1
+            return None
+
+    @traced("file")
+    def put(self, key, data):
+        text = json.dumps(data)
+        with self.lock:
+            self.load()
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                write_text_atomic(self.path(key), text)
+            except OSError:
+                return
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = len(text.encode("utf-8"))
+            self.total_bytes += self.entries[key]
+            self.stores += 1
+            while len(self.entries) > 1 and (len(self.entries) > RESPONSE_CACHE_MAX_ENTRIES or self.total_bytes > RESPONSE_CACHE_MAX_BYTES):
+                self.forget(next(iter(self.entries)))
+                self.evictions += 1
+
+    def forget(self, key):
+        self.total_bytes -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.load()
+            removed = len(self.entries)
+            for key in list(self.entries):
+                self.forget(key)
+            return removed
+
+    def stats(self):
+        with self.lock:
+            self.load()
+            lookups = self.hits + self.misses
+            hit_rate = f"{self.hits / lookups * 100:.0f}%" if lookups else "n/a"
+            return (f"{len(self.entries)} entries, {self.total_bytes / 1024:.1f} KiB "
+                    f"(limits {RESPONSE_CACHE_MAX_ENTRIES} entries, {RESPONSE_CACHE_MAX_BYTES // 1024} KiB); "
+                    f"hits {self.hits}, misses {self.misses} ({hit_rate}), stored {self.stores}, evicted {self.evictions}")
+
+response_cache = ResponseCache()
+
+#############################################
+# Request Coalescing
+#############################################
+
+class SingleFlight:
+    # Identical non-streaming requests that overlap share one HTTP call: the first caller (the leader)
+    # makes the request and every caller that arrives with the same key before it finishes gets the same
+    # response, or the same exception.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> {"done": Event, "response": ..., "error": ...}
+        self.shared = 0
+
+    def run(self, key, func):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = {"done": threading.Event(), "response": None, "error": None}
+            else:
+                self.shared += 1
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["response"]
+        try:
+            flight["response"] = func()
+            return flight["response"]
+        except BaseException as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight["done"].set()
+
+    def status(self):
+        with self.lock:
+            return f"{len(self.flights)} distinct request(s) in flight, {self.shared} duplicate(s) served from a shared call"
+
+single_flight = SingleFlight()
+
+def lm_post(payload, priority=PRIORITY_INTERACTIVE, cache=None, **kwargs):
+    # cache=None caches only non-interactive SYS_MODEL calls and cache=True forces it on. cache=False means
+    # the caller wants a fresh sample (a retry, a beam candidate, a reply variant), so the request is
+    # neither answered from the cache nor merged with an identical one already in flight.
+    fresh = cache is False
+    if cache is None:
+        cache = priority > PRIORITY_INTERACTIVE and payload.get("model") == SYS_MODEL
+    cache = cache and RESPONSE_CACHE_ENABLED and not kwargs.get("stream")
+    if cache:
+        key = response_cache.key(payload)
+        data = response_cache.get(key)
+        if data is not None:
+            return CachedResponse(data)
+    # Streaming callers hold a scheduler slot themselves for as long as they read the stream.
+    if kwargs.get("stream"):
+        return lm_client.post(payload, **kwargs)
+
+    def send():
+        queued = time.time()
+        with scheduler.slot(payload.get("model"), priority):
+            started = time.time()
+            try:
+                response = lm_client.post(payload, **kwargs)
+            except Exception as e:
+                request_metrics.record(payload.get("model"), endpoint_label(), time.time() - started, started - queued, error=type(e).__name__)
+                raise
+        request_metrics.record_response(payload, response, time.time() - started, started - queued)
+        if cache and response.status_code == 200:
+            try:
+                response_cache.put(key, response.json())
+            except ValueError:
+                pass
+        return response
+
+    if fresh:
+        return send()
+    return single_flight.run(response_cache.key(payload), send)
+
+def lm_get(path, **kwargs):
+    return lm_client.get(path, **kwargs)
+
+def test_connection():
+    candidates = [(LOCAL_BASE_URL, "localhost"), (REMOTE_BASE_URL, "velvet.tinysun.net")]
+    if endpoint_state["pinned"]:
+        # Only the pinned endpoint is checked; the defaults would never be used anyway.
+        candidates = [(endpoint_state["base_url"], endpoint_state["base_url"])]
+    for base_url, host in candidates:
+        try:
+            start = time.time()
+            r = lm_client.probe(base_url)
+            ping = (time.time() - start) * 1000
+            if r.status_code == 200:
+                # A successful explicit test is as good as a probe, so refresh the cached endpoint too.
+                set_endpoint(base_url)
+                return f"Connected to LM Studio at {host} (ping: {int(ping)}ms)"
+        except Exception:
+            pass
     return "Not connected to any LM Studio API."
 
+#############################################
+# Character Store
+#############################################
+
+def valid_character_name(name):
+    # Character names become file names (journal, sidecars, exported logs), so they may not contain a path
+    # separator or start with a dot.
+    return bool(name) and os.sep not in name and "/" not in name and not (os.altsep and os.altsep in name) and not name.startswith(".")
+
+def folder_path(folder, filename):
+    # Joins a file name derived from a channel or character name onto its folder, refusing anything that
+    # would resolve outside it.
+    path = os.path.join(folder, filename)
+    if os.path.dirname(os.path.realpath(path)) != os.path.realpath(folder):
+        raise ValueError(f"{filename!r} is not a valid file name")
+    return path
+
+class CharacterStore:
+    # Every character prompt lives in one SQLite file with its metadata and a full-text index. Loose .txt
+    # files in CHARACTERS_FOLDER (older installs, or prompts edited by hand) are imported when the store is
+    # opened, and again when a character is loaded, if they are newer than the stored copy. The database is
+    # opened on first use.
+    def __init__(self, path=CHARACTER_DB_FILE, folder=CHARACTERS_FOLDER):
+        self.path = path
+        self.folder = folder
+        self.lock = threading.RLock()
+        self.db = None
+        self.fts = False
+
+    def connect(self):
+        with self.lock:
+            if self.db is not None:
+                return self.db
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS characters ("
+                "name TEXT PRIMARY KEY, prompt TEXT NOT NULL DEFAULT '', created REAL NOT NULL, modified REAL NOT NULL, "
+                "model TEXT, grade INTEGER, file_mtime REAL)"
+            )
+            self.fts = self.create_fts(db)
+            self.db = db
+            self.import_files()
+            return db
+
+    def create_fts(self, db):
+        # SQLite builds without FTS5 fall back to LIKE scans in search().
+        existed = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'characters_fts'").fetchone() is not None
+        try:
+            db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS characters_fts USING fts5(name, prompt, content='characters', content_rowid='rowid')")
+        except sqlite3.OperationalError:
+            return False
+        db.execute(
+            "CREATE TRIGGER IF NOT EXISTS characters_ai AFTER INSERT ON characters BEGIN "
+            "INSERT INTO characters_fts(rowid, name, prompt) VALUES (new.rowid, new.name, new.prompt); END"
+        )
+        db.execute(
+            "CREATE TRIGGER IF NOT EXISTS characters_ad AFTER DELETE ON characters BEGIN "
+            "INSERT INTO characters_fts(characters_fts, rowid, name, prompt) VALUES ('delete', old.rowid, old.name, old.prompt); END"
+        )
+        db.execute(
+            "CREATE TRIGGER IF NOT EXISTS characters_au AFTER UPDATE ON characters BEGIN "
+            "INSERT INTO characters_fts(characters_fts, rowid, name, prompt) VALUES ('delete', old.rowid, old.name, old.prompt); "
+            "INSERT INTO characters_fts(rowid, name, prompt) VALUES (new.rowid, new.name, new.prompt); END"
+        )
+        if not existed:
+            db.execute("INSERT INTO characters_fts(characters_fts) VALUES ('rebuild')")
+        return True
+
+    @traced("file")
+    def import_files(self):
+        if not os.path.isdir(self.folder):
+            return 0
+        known = {name: max(file_mtime or 0, modified) for name, file_mtime, modified in
+                 self.db.execute("SELECT name, file_mtime, modified FROM characters")}
+        changed = []
+        for entry in os.scandir(self.folder):
+            if not entry.name.endswith(".txt") or not entry.is_file():
+                continue
+            name = entry.name[:-len(".txt")]
+            changed.extend(self.read_if_newer(name, entry.path, known.get(name)))
+        self.store_files(changed)
+        return len(changed)
+
+    def refresh(self, name):
+        # A .txt file edited while the store is open is only seen by import_files on the next start, so
+        # loading or reloading a character checks its file again.
+        try:
+            path = folder_path(self.folder, f"{name}.txt")
+        except ValueError:
+            return False
+        with self.lock:
+            row = self.connect().execute("SELECT file_mtime, modified FROM characters WHERE name = ?", (name,)).fetchone()
+            changed = self.read_if_newer(name, path, max(row[0] or 0, row[1]) if row else None)
+            self.store_files(changed)
+        return bool(changed)
+
+    def read_if_newer(self, name, path, known):
+        try:
+            mtime = os.stat(path).st_mtime
+            if known is not None and mtime <= known:
+                return []
+            with open(path, "r", encoding="utf-8") as f:
+                return [(name, f.read().strip(), mtime)]
+        except (OSError, UnicodeDecodeError):
+            return []
+
+    def store_files(self, changed):
+        if changed:
+            with self.transaction():
+                self.db.executemany(
+                    "INSERT INTO characters (name, prompt, created, modified, file_mtime) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET prompt = excluded.prompt, modified = excluded.modified, "
+                    "file_mtime = excluded.file_mtime, model = NULL, grade = NULL",
+                    [(name, prompt, mtime, mtime, mtime) for name, prompt, mtime in changed]
+                )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    @traced("file")
+    def get(self, name):
+        with self.lock:
+            row = self.connect().execute("SELECT prompt FROM characters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def exists(self, name):
+        return self.get(name) is not None
+
+    def info(self, name):
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT name, created, modified, model, grade, length(prompt) FROM characters WHERE name = ?", (name,)
+            ).fetchone()
+        return self.row_info(row) if row else None
+
+    def row_info(self, row):
+        name, created, modified, model, grade, size = row
+        return {"name": name, "created": created, "modified": modified, "model": model, "grade": grade, "size": size}
+
+    @traced("file")
+    def put(self, name, prompt, model=None, grade=None):
+        # One statement, so readers see either the old prompt or the new one. model and grade describe the
+        # prompt being stored; a hand-written prompt clears them.
+        now = time.time()
+        with self.lock:
+            self.connect().execute(
+                "INSERT INTO characters (name, prompt, created, modified, model, grade) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET prompt = excluded.prompt, modified = excluded.modified, "
+                "model = excluded.model, grade = excluded.grade",
+                (name, prompt, now, now, model, grade)
+            )
+
+    def create(self, name):
+        now = time.time()
+        with self.lock:
+            cursor = self.connect().execute(
+                "INSERT OR IGNORE INTO characters (name, prompt, created, modified) VALUES (?, '', ?, ?)", (name, now, now)
+            )
+        return cursor.rowcount > 0
+
+    def delete(self, name):
+        with self.lock:
+            cursor = self.connect().execute("DELETE FROM characters WHERE name = ?", (name,))
+            # The loose file has to go too, or the next start would import it again.
+            try:
+                os.remove(folder_path(self.folder, f"{name}.txt"))
+            except (OSError, ValueError):
+                pass
+        return cursor.rowcount > 0
+
+    def entries(self, prefix=""):
+        # Ordered by name; the prefix is a range scan on the primary key index.
+        query = "SELECT name, created, modified, model, grade, length(prompt) FROM characters"
+        params = ()
+        if prefix:
+            query += " WHERE name >= ? AND name < ?"
+            params = (prefix, prefix + "\U0010ffff")
+        with self.lock:
+            rows = self.connect().execute(query + " ORDER BY name", params).fetchall()
+        return [self.row_info(row) for row in rows]
+
+    def names(self, prefix=""):
+        return [entry["name"] for entry in self.entries(prefix)]
+
+    def count(self):
+        with self.lock:
+            return self.connect().execute("SELECT count(*) FROM characters").fetchone()[0]
+
+    @traced("file")
+    def search(self, query, limit=20):
+        # Returns (name, snippet) pairs for characters whose name or prompt contains every word of query;
+        # words match as prefixes when FTS5 is available.
+        words = query.split()
+        if not words:
+            return []
+        with self.lock:
+            db = self.connect()
+            if self.fts:
+                match = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+                return db.execute(
+                    "SELECT name, snippet(characters_fts, 1, '[', ']', '...', 12) FROM characters_fts "
+                    "WHERE characters_fts MATCH ? ORDER BY rank LIMIT ?", (match, limit)
+                ).fetchall()
+            conditions = " AND ".join(["(name LIKE ? ESCAPE '\\' OR prompt LIKE ? ESCAPE '\\')"] * len(words))
+            params = []
+            for word in words:
+                pattern = "%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                params += [pattern, pattern]
+            rows = db.execute(f"SELECT name, prompt FROM characters WHERE {conditions} ORDER BY name LIMIT ?", params + [limit]).fetchall()
+        results = []
+        for name, prompt in rows:
+            position = max(0, prompt.lower().find(words[0].lower()))
+            start = max(0, position - 40)
+            results.append((name, ("..." if start else "") + prompt[start:position + 60].replace("\n", " ")))
+        return results
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+character_store = CharacterStore()
+
 #############################################
 # Conversation History Management
 #############################################
@@ -163,79 +1290,96 @@ def process_reply(reply):
         return match.group(1).strip()
     return reply.rstrip()
 
+@traced("file")
 def load_conversation_history(channel):
     global conversation_histories
-    if channel not in conversation_histories:
-        conversation_histories[channel] = []
-        if channel == "#welcome":
-            default_prompt = (
-                "[WELCOME SYSTEM PROMPT]\n"
-                "Welcome to Velvet's (py)chai version " + VERSION + "!\n"
-                "This tool lets you roleplay with AI characters. Commands:\n"
-                "  !create <name>         - Create a new character\n"
-                "  !character <name>      - Switch characters (auto-saves current conversation)\n"
-                "  !duplicate <name>      - Duplicate current character to a new one\n"
-                "  !set                   - Update the system prompt\n"
-                "  !improve/sharpen/fixate - Improve the system prompt based on your advice\n"
-                "  !selfimprove [score]   - Automatically improve the system prompt until graded above a threshold (default 80)\n"
-                "  !connection            - Test connection to LM Studio API\n"
-                "  !characterlist         - List characters with one-sentence summaries (pass 'remake' to regenerate)\n"
-                "  !setcolor <role> <color> - Customize colors (roles: system, user, assistant, command)\n"
-                "  !convomodel            - Switch conversation model\n"
-                "  !sysmodel              - Switch system model\n"
-                "  !exit                  - Save conversation and exit\n"
-                "Simply type your messages to chat.\n"
-                "Enjoy!"
-            )
-            conversation_histories[channel].append({"role": "system", "content": default_prompt})
-        else:
-            char_name = channel.lstrip("#")
-            filename = os.path.join(CHARACTERS_FOLDER, f"{char_name}.txt")
-            if os.path.exists(filename):
-                try:
-                    with open(filename, "r", encoding="utf-8") as f:
-                        prompt = f.read().strip()
-                    if prompt:
-                        conversation_histories[channel].append({"role": "system", "content": prompt})
-                except Exception as e:
-                    command_output(channel, f"Error loading system prompt from {filename}: {e}")
-            else:
+    with channel_state(channel).lock:
+        if channel not in conversation_histories:
+            conversation_histories[channel] = []
+            if channel == "#welcome":
                 default_prompt = (
-                    "[SYSTEM PROMPT]\n"
-                    "Background: You are an engaging conversational AI.\n"
-                    "Personality: Friendly, concise, and interactive.\n"
-                    "Guidelines:\n"
-                    "- Keep responses brief (1-3 sentences)\n"
-                    "- Always leave room for the user to respond\n"
-                    "- Stay in character at all times"
+                    "[WELCOME SYSTEM PROMPT]\n"
+                    "Welcome to Velvet's (py)chai version " + VERSION + "!\n"
+                    "This tool lets you roleplay with AI characters. Commands:\n"
+                    "  !create <name>         - Create a new character\n"
+                    "  !character <name>      - Switch characters (auto-saves current conversation)\n"
+                    "  !duplicate <name>      - Duplicate current character to a new one\n"
+                    "  !set                   - Update the system prompt\n"
+                    "  !improve/sharpen/fixate - Improve the system prompt based on your advice\n"
+                    "  !selfimprove [score] [beam=k] [rounds=n] [time=s] - Automatically improve the system prompt until graded above a threshold (default 80)\n"
+                    "  !connection            - Test connection to LM Studio API\n"
+                    "  !characterlist         - List characters with one-sentence summaries (pass 'remake' to regenerate)\n"
+                    "  !setcolor <role> <color> - Customize colors (roles: system, user, assistant, command)\n"
+                    "  !convomodel            - Switch conversation model\n"
+                    "  !sysmodel              - Switch system model\n"
+                    "  !exit                  - Save conversation and exit\n"
+                    "Simply type your messages to chat.\n"
+                    "Enjoy!"
                 )
                 conversation_histories[channel].append({"role": "system", "content": default_prompt})
+            else:
+                char_name = channel.lstrip("#")
+                try:
+                    character_store.refresh(char_name)
+                    prompt = character_store.get(char_name)
+                except sqlite3.Error as e:
+                    command_output(channel, f"Error loading system prompt for {char_name}: {e}")
+                    prompt = ""
+                if prompt is not None:
+                    if prompt.strip():
+                        conversation_histories[channel].append({"role": "system", "content": prompt.strip()})
+                else:
+                    default_prompt = (
+                        "[SYSTEM PROMPT]\n"
+                        "Background: You are an engaging conversational AI.\n"
+                        "Personality: Friendly, concise, and interactive.\n"
+                        "Guidelines:\n"
+                        "- Keep responses brief (1-3 sentences)\n"
+                        "- Always leave room for the user to respond\n"
+                        "- Stay in character at all times"
+                    )
+                    conversation_histories[channel].append({"role": "system", "content": default_prompt})
 
-def save_conversation(channel):
+def render_conversation(channel):
+    # Build formatted log using color codes.
+    log_lines = []
+    for msg in conversation_histories[channel]:
+        if msg["role"] == "user":
+            log_lines.append(f"{role_colors['user']}{session_username()}\033[0m: {msg['content']}")
+        elif msg["role"] == "assistant":
+            char_name = channel.lstrip("#")
+            if channel == "#welcome":
+                char_name = "Velvet's (py)chai"
+            log_lines.append(f"{role_colors['assistant']}{char_name}\033[0m: {msg['content']}")
+        else:
+            log_lines.append(f"{role_colors['system']}{msg['content']}\033[0m")
+    return "\n".join(log_lines)
+
+def export_conversation(channel):
+    # Writes the colour-formatted text log; this is a render of the journal, not the source of truth.
     if channel in conversation_histories:
-        # Build formatted log using color codes.
-        log_lines = []
-        for msg in conversation_histories[channel]:
-            if msg["role"] == "user":
-                log_lines.append(f"{role_colors['user']}{username}\033[0m: {msg['content']}")
-            elif msg["role"] == "assistant":
-                char_name = channel.lstrip("#")
-                if channel == "#welcome":
-                    char_name = "Velvet's (py)chai"
-                log_lines.append(f"{role_colors['assistant']}{char_name}\033[0m: {msg['content']}")
-            else:
-                log_lines.append(f"{role_colors['system']}{msg['content']}\033[0m")
-        log = "\n".join(log_lines)
-        filename = os.path.join(SAVED_CONVOS_FOLDER, f"{channel.lstrip('#')}_saved.txt")
         try:
+            filename = folder_path(SAVED_CONVOS_FOLDER, f"{channel.lstrip('#')}_saved.txt")
             with open(filename, "w", encoding="utf-8") as f:
-                f.write(log)
-            command_output(channel, f"Conversation saved as {filename}.")
+                f.write(render_conversation(channel))
+            command_output(channel, f"Conversation exported as {filename}.")
+        except Exception as e:
+            command_output(channel, f"Error exporting conversation: {e}")
+
+@traced("file")
+def save_conversation(channel):
+    if channel in conversation_histories:
+        try:
+            sync_journal(channel)
+            flush_journal(channel)
+            command_output(channel, f"Conversation saved as {journal_file(channel)}.")
         except Exception as e:
             command_output(channel, f"Error saving conversation: {e}")
 
 def clear_conversation(channel):
     global conversation_histories
+    discard_channel_summary(channel)
+    discard_channel_hints(channel)
     if channel in conversation_histories and conversation_histories[channel]:
         if conversation_histories[channel][0]["role"] == "system":
             conversation_histories[channel] = [conversation_histories[channel][0]]
@@ -247,27 +1391,691 @@ def clear_conversation(channel):
 def reload_conversation(channel):
     global conversation_histories
     char_name = channel.lstrip("#")
-    filename = os.path.join(CHARACTERS_FOLDER, f"{char_name}.txt")
-    if os.path.exists(filename):
-        try:
-            with open(filename, "r", encoding="utf-8") as f:
-                prompt = f.read().strip()
-            if prompt:
-                conversation_histories[channel] = [{"role": "system", "content": prompt}]
-                return True
-        except Exception as e:
-            command_output(channel, f"Error reloading system prompt from {filename}: {e}")
+    try:
+        character_store.refresh(char_name)
+        prompt = (character_store.get(char_name) or "").strip()
+    except sqlite3.Error as e:
+        command_output(channel, f"Error reloading system prompt for {char_name}: {e}")
+        return False
+    if prompt:
+        conversation_histories[channel] = [{"role": "system", "content": prompt}]
+        discard_channel_summary(channel)
+        discard_channel_hints(channel)
+        return True
     return False
 
+#############################################
+# Conversation Journal
+#############################################
+
+# channel -> {"file": append handle, "entries": journaled (role, content, pinned) tuples for the history window,
+#             "offset": index in the history where that window starts, "prefix": journal records before the
+#             window that are not held in memory, "records": lines in the file, "pending": records not yet
+#             fsynced, "last_fsync": timestamp}
+journals = {}
+journal_lock = threading.RLock()
+
+def journal_file(channel):
+    return folder_path(CONVERSATIONS_FOLDER, f"{channel.lstrip('#')}.jsonl")
+
+def journal_entry(msg):
+    return (msg["role"], msg["content"], bool(msg.get("pinned", False)))
+
+def journal_record(entry):
+    record = {"role": entry[0], "content": entry[1]}
+    if entry[2]:
+        record["pinned"] = True
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+def record_message(record):
+    msg = {"role": record["role"], "content": record["content"]}
+    if record.get("pinned"):
+        msg["pinned"] = True
+    return msg
+
+def open_journal_state(channel, entries, offset=0, prefix=0, records=None):
+    path = journal_file(channel)
+    state = journals.get(channel)
+    if state:
+        state["file"].close()
+    journals[channel] = {
+        "file": open(path, "a", encoding="utf-8"),
+        "entries": entries,
+        "offset": offset,
+        "prefix": prefix,
+        "records": prefix + len(entries) if records is None else records,
+        "pending": 0,
+        "last_fsync": time.time()
+    }
+
+def rewrite_journal(channel, history, offset=0, prefix=0):
+    # Compaction: replaces the journal with one record per message of the current history window. Records
+    # before the window are copied over byte for byte; they are always the first lines of the file because
+    # truncates never reach below the window.
+    path = journal_file(channel)
+    with journal_lock:
+        state = journals.get(channel)
+        if state:
+            state["file"].flush()
+        head = b""
+        if prefix:
+            with open(path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    head = mm[:journal_line_offset(mm, prefix)]
+        entries = [journal_entry(msg) for msg in history[offset:]]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(head)
+            f.write("".join(journal_record(entry) for entry in entries).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        open_journal_state(channel, entries, offset, prefix)
+
+def sync_journal(channel):
+    # Appends only what changed since the last sync. When an earlier message was edited or removed, a
+    # truncate record is written first and the history is re-appended from that point.
+    history = conversation_histories.get(channel)
+    if history is None:
+        return
+    with journal_lock:
+        state = journals.get(channel)
+        if state is None:
+            # A session that has not loaded this channel continues the journal an earlier session left
+            # behind: everything after the system prompt is appended behind the existing records.
+            if not continue_journal(channel, 1 if history and history[0]["role"] == "system" else 0):
+                rewrite_journal(channel, history)
+                return
+            state = journals[channel]
+        entries = state["entries"]
+        window = history[state["offset"]:]
+        common = 0
+        limit = min(len(entries), len(window))
+        while common < limit and entries[common] == journal_entry(window[common]):
+            common += 1
+        if common == len(entries) == len(window):
+            return
+        lines = []
+        if common < len(entries):
+            lines.append(json.dumps({"op": "truncate", "length": state["prefix"] + common}) + "\n")
+        new_entries = [journal_entry(msg) for msg in window[common:]]
+        lines.extend(journal_record(entry) for entry in new_entries)
+        entries[common:] = new_entries
+        if state["records"] + len(lines) > state["prefix"] + 2 * len(window) + JOURNAL_COMPACT_SLACK:
+            rewrite_journal(channel, history, state["offset"], state["prefix"])
+            return
+        state["file"].write("".join(lines))
+        state["records"] += len(lines)
+        state["pending"] += len(lines)
+        if state["pending"] >= JOURNAL_FSYNC_BATCH or time.time() - state["last_fsync"] >= JOURNAL_FSYNC_INTERVAL:
+            flush_journal(channel)
+
+@traced("file")
+def flush_journal(channel=None):
+    with journal_lock:
+        channels = [channel] if channel else list(journals)
+        for name in channels:
+            state = journals.get(name)
+            if not state:
+                continue
+            state["file"].flush()
+            if state["pending"]:
+                os.fsync(state["file"].fileno())
+            state["pending"] = 0
+            state["last_fsync"] = time.time()
+
+def close_journals():
+    with journal_lock:
+        flush_journal()
+        for state in journals.values():
+            state["file"].close()
+        journals.clear()
+
+def journal_line_offset(mm, line):
+    # Byte offset where the given (0-based) line starts, found by scanning for newlines without parsing JSON.
+    pos = 0
+    for _ in range(line):
+        pos = mm.find(b"\n", pos)
+        if pos == -1:
+            return len(mm)
+        pos += 1
+    return pos
+
+def journal_is_clean(mm):
+    # A clean journal holds exactly one record per message, so line numbers are message positions.
+    # Control records are the only lines starting with {"op"; that byte sequence cannot occur inside a
+    # JSON string value because the quotes would be escaped.
+    return mm.find(b'{"op"') == -1
+
+def iter_journal(path):
+    # Streams records one line at a time so large journals are never read into memory whole.
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def replay_journal(path):
+    messages = []
+    for record in iter_journal(path):
+        if record.get("op") == "truncate":
+            del messages[record["length"]:]
+        else:
+            messages.append(record_message(record))
+    return messages
+
+def read_journal_lines(path, start, end=None):
+    # Parses only lines [start, end) of a clean journal.
+    messages = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return messages
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = journal_line_offset(mm, start)
+            line = start
+            while pos < len(mm) and (end is None or line < end):
+                next_pos = mm.find(b"\n", pos)
+                if next_pos == -1:
+                    next_pos = len(mm)
+                raw = mm[pos:next_pos].strip()
+                if raw:
+                    messages.append(record_message(json.loads(raw)))
+                pos = next_pos + 1
+                line += 1
+    return messages
+
+def count_journal_lines(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = 0
+            pos = mm.find(b"\n")
+            while pos != -1:
+                count += 1
+                pos = mm.find(b"\n", pos + 1)
+            if len(mm) and mm[len(mm) - 1:] != b"\n":
+                count += 1
+            return count
+
+def ensure_clean_journal(channel):
+    # Folds truncate records away so lines map directly to messages; only needed once per dirty journal.
+    path = journal_file(channel)
+    with journal_lock:
+        flush_journal(channel)
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                clean = journal_is_clean(mm)
+        if not clean:
+            messages = replay_journal(path)
+            entries = [journal_entry(msg) for msg in messages]
+            write_text_atomic(path, "".join(journal_record(entry) for entry in entries))
+            state = journals.get(channel)
+            if state is None:
+                return
+            # The open history window is still the tail of the journal; point its state at the rewritten
+            # file so the next sync appends instead of starting over.
+            if len(messages) == state["prefix"] + len(state["entries"]):
+                open_journal_state(channel, state["entries"], state["offset"], state["prefix"])
+            else:
+                state["file"].close()
+                del journals[channel]
+
+def restore_from_journal(channel, system_msg, last=None):
+    # Restores the saved turns behind the character's current system prompt. With last=n only the newest
+    # n messages are loaded; the older ones stay in the journal and later saves append after them.
+    path = journal_file(channel)
+    with journal_lock:
+        ensure_clean_journal(channel)
+        total = count_journal_lines(path)
+        first = read_journal_lines(path, 0, 1)
+        skip = 1 if first and first[0]["role"] == "system" else 0
+        start = skip if last is None else max(skip, total - last)
+        messages = read_journal_lines(path, start)
+        history = [system_msg] + messages
+        conversation_histories[channel] = history
+        open_journal_state(channel, [journal_entry(msg) for msg in messages], offset=1, prefix=start, records=total)
+    return len(messages), start - skip
+
+def continue_journal(channel, offset):
+    # Opens the journal so that syncs append history[offset:] behind the records already in it. Returns
+    # False when there is no journal with records to continue.
+    path = journal_file(channel)
+    with journal_lock:
+        if not os.path.exists(path):
+            return False
+        ensure_clean_journal(channel)
+        total = count_journal_lines(path)
+        if not total:
+            return False
+        open_journal_state(channel, [], offset=offset, prefix=total, records=total)
+        return True
+
+def parse_legacy_log(channel, path):
+    # Older versions only saved the colour-formatted text log. Roles are recovered from the coloured name
+    # prefixes and lines without a prefix are treated as continuations of the previous message.
+    ansi = re.compile(r"\x1b\[[0-9;]*m")
+    username = session_username()
+    char_name = "Velvet's (py)chai" if channel == "#welcome" else channel.lstrip("#")
+    messages = []
+    current_role = None
+    with open(path, "r", encoding="utf-8") as f:
+        for raw in f:
+            is_system = raw.startswith(role_colors["system"])
+            line = ansi.sub("", raw.rstrip("\n"))
+            if is_system:
+                current_role = "system"
+                continue
+            if username and line.startswith(username + ": "):
+                current_role = "user"
+                messages.append({"role": "user", "content": line[len(username) + 2:]})
+            elif line.startswith(char_name + ": "):
+                current_role = "assistant"
+                messages.append({"role": "assistant", "content": line[len(char_name) + 2:]})
+            elif current_role in ["user", "assistant"] and messages:
+                messages[-1]["content"] += "\n" + line
+    return messages
+
+def record_reply(channel):
+    # Runs after every assistant reply lands in the history.
+    try:
+        sync_journal(channel)
+    except Exception as e:
+        command_output(channel, f"Error journaling conversation: {e}")
+    schedule_compaction(channel)
+
+#############################################
+# Context Window Management
+#############################################
+
+# channel -> {"hint": text from !hint, "notes": texts accumulated by !fixate}; used by the stable layout,
+# which sends them in a trailing slot instead of storing them in the history.
+channel_hints = {}
+# channel -> history index where the stable layout's sliding window currently starts.
+context_cuts = {}
+# channel -> fingerprints of the messages sent with the channel's previous request.
+context_prefixes = {}
+HINT_PREFIX = "Hint:"
+
+def sidecar_file(channel, kind):
+    # Summary and hint files sit next to the channel's journal. Earlier versions kept them in savedconvos;
+    # a file found there is moved over the first time it is looked up.
+    name = f"{channel.lstrip('#')}_{kind}.json"
+    path = folder_path(CONVERSATIONS_FOLDER, name)
+    legacy_path = folder_path(SAVED_CONVOS_FOLDER, name)
+    if not os.path.exists(path) and os.path.exists(legacy_path):
+        try:
+            os.replace(legacy_path, path)
+        except OSError:
+            return legacy_path
+    return path
+
+def hints_file(channel):
+    return sidecar_file(channel, "hints")
+
+def get_channel_hints(channel):
+    if channel not in channel_hints:
+        hints = {"hint": None, "notes": []}
+        try:
+            with open(hints_file(channel), "r", encoding="utf-8") as f:
+                hints.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        channel_hints[channel] = hints
+    return channel_hints[channel]
+
+def set_channel_hints(channel, hint=None, notes=None):
+    channel_hints[channel] = {"hint": hint, "notes": list(notes or [])}
+    try:
+        if hint or notes:
+            write_text_atomic(hints_file(channel), json.dumps(channel_hints[channel]))
+        elif os.path.exists(hints_file(channel)):
+            os.remove(hints_file(channel))
+    except Exception as e:
+        command_output(channel, f"Error saving hints: {e}")
+
+def discard_channel_hints(channel):
+    if channel_hints.get(channel, {}).get("hint") or channel_hints.get(channel, {}).get("notes") or os.path.exists(hints_file(channel)):
+        set_channel_hints(channel)
+
+def hint_slot(channel):
+    hints = get_channel_hints(channel)
+    lines = [f"{HINT_PREFIX} {text}" for text in hints["notes"] + ([hints["hint"]] if hints["hint"] else [])]
+    return {"role": "system", "content": "\n".join(lines)} if lines else None
+
+def is_hint_slot(msg):
+    return msg["role"] == "system" and msg["content"].startswith(HINT_PREFIX)
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text; swap in a real tokenizer with set_token_estimator.
+    return len(text) // 4 + 1
+
+token_estimator = estimate_tokens
+
+def set_token_estimator(func):
+    global token_estimator
+    token_estimator = func or estimate_tokens
+
+def message_tokens(msg):
+    return token_estimator(msg["content"]) + CONTEXT_MESSAGE_OVERHEAD
+
+def is_pinned(msg):
+    # System messages (the prompt itself and any hints) always stay in the context.
+    return msg["role"] == "system" or msg.get("pinned", False)
+
+def newest_that_fit(history, start, remaining):
+    # Indexes of the newest unpinned messages from start on whose tokens fit in remaining. The newest
+    # message is always included, even if it alone exceeds the budget.
+    keep = set()
+    for i in range(len(history) - 1, start - 1, -1):
+        if is_pinned(history[i]):
+            continue
+        cost = message_tokens(history[i])
+        if cost > remaining and keep:
+            break
+        keep.add(i)
+        remaining -= cost
+    return keep
+
+def build_context(channel, budget=None, strategy=None, layout=None):
+    # Returns the messages to send for a channel, trimmed to the token budget. The stored history is never
+    # modified; only what goes over the wire is trimmed. Turns already folded into the running summary are
+    # replaced by a single summary message after the leading system prompt.
+    history = conversation_histories.get(channel, [])
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    strategy = strategy or CONTEXT_STRATEGY
+    layout = layout or CONTEXT_LAYOUT
+    slot = hint_slot(channel) if layout == "stable" else None
+    if strategy == "full":
+        context = [{"role": msg["role"], "content": msg["content"]} for msg in history]
+        return context + [slot] if slot else context
+    summary = get_channel_summary(channel)
+    covered = summary["covered"] if summary else 0
+    summary_msg = {"role": "system", "content": "Summary of the earlier conversation: " + summary["content"]} if summary else None
+    remaining = budget - sum(message_tokens(msg) for msg in history if is_pinned(msg))
+    if summary_msg:
+        remaining -= message_tokens(summary_msg)
+    if slot:
+        remaining -= message_tokens(slot)
+    if layout == "stable":
+        # Keep the previous cut while everything after it still fits; once it doesn't, cut down to the low
+        # watermark so the prefix then stays put for several turns instead of shifting every turn.
+        cut = context_cuts.get(channel, covered)
+        if cut < covered or cut > len(history):
+            cut = covered
+        keep = set(i for i in range(cut, len(history)) if not is_pinned(history[i]))
+        if sum(message_tokens(history[i]) for i in keep) > remaining:
+            keep = newest_that_fit(history, covered, int(remaining * CONTEXT_LOW_WATERMARK))
+            cut = min(keep) if keep else covered
+        context_cuts[channel] = cut
+    else:
+        keep = newest_that_fit(history, covered, remaining)
+    context = []
+    for i, msg in enumerate(history):
+        if i in keep or is_pinned(msg):
+            context.append({"role": msg["role"], "content": msg["content"]})
+        if summary_msg and i == 0:
+            context.append(summary_msg)
+    return context + [slot] if slot else context
+
+def track_prefix(channel, messages):
+    # Called with what is about to be sent. If it no longer starts with what the previous request for the
+    # channel sent, the backend's cached prefix is lost from the first differing message on; that is
+    # reported unless only the previous request's newest message differs.
+    if messages and is_hint_slot(messages[-1]):
+        messages = messages[:-1]
+    fingerprints = [message_fingerprint(msg) for msg in messages]
+    previous = context_prefixes.get(channel)
+    context_prefixes[channel] = fingerprints
+    if not previous or not CONTEXT_PREFIX_WARNINGS:
+        return
+    shared = 0
+    for old, new in zip(previous, fingerprints):
+        if old != new:
+            break
+        shared += 1
+    if shared < len(previous) - 1:
+        command_output(channel, f"Context prefix changed at message {shared + 1} of the {len(previous)} sent last time; LM Studio has to re-process the context from there.")
+
+def context_stats(channel):
+    history = conversation_histories.get(channel, [])
+    context = build_context(channel)
+    return {
+        "history_messages": len(history),
+        "history_tokens": sum(message_tokens(msg) for msg in history),
+        "context_messages": len(context),
+        "context_tokens": sum(message_tokens(msg) for msg in context)
+    }
+
+#############################################
+# Rolling Conversation Summaries
+#############################################
+
+# channel -> {"content": summary text, "covered": number of leading history messages it replaces,
+#             "anchor": fingerprint of the last covered message}
+channel_summaries = {}
+compaction_inflight = set()
+compaction_lock = threading.Lock()
+
+def summary_file(channel):
+    return sidecar_file(channel, "summary")
+
+def message_fingerprint(msg):
+    return hashlib.sha256((msg["role"] + "\0" + msg["content"]).encode("utf-8")).hexdigest()
+
+def get_channel_summary(channel):
+    # A summary is only used while the history still contains the exact turns it was built from; edits,
+    # clears or loads that change those turns make it stale and it is ignored until the next compaction.
+    with compaction_lock:
+        if channel not in channel_summaries:
+            summary = None
+            if os.path.exists(summary_file(channel)):
+                try:
+                    with open(summary_file(channel), "r", encoding="utf-8") as f:
+                        summary = json.load(f)
+                except Exception:
+                    summary = None
+            channel_summaries[channel] = summary
+        summary = channel_summaries[channel]
+    history = conversation_histories.get(channel, [])
+    if not summary or not 0 < summary["covered"] <= len(history):
+        return None
+    if message_fingerprint(history[summary["covered"] - 1]) != summary["anchor"]:
+        return None
+    return summary
+
+def discard_channel_summary(channel):
+    with compaction_lock:
+        channel_summaries[channel] = None
+    try:
+        if os.path.exists(summary_file(channel)):
+            os.remove(summary_file(channel))
+    except Exception:
+        pass
+
+def transcript_line(channel, msg):
+    if msg["role"] == "user":
+        return f"{session_username() or 'User'}: {msg['content']}"
+    if msg["role"] == "assistant":
+        return f"{channel.lstrip('#')}: {msg['content']}"
+    return f"[{msg['content']}]"
+
+def compaction_cut(channel, history):
+    # Returns (start, cut): the unsummarised turns in history[start:cut] should be folded, or None if the
+    # channel is still under the threshold.
+    summary = get_channel_summary(channel)
+    start = summary["covered"] if summary else 1 if history and history[0]["role"] == "system" else 0
+    unsummarised = [i for i in range(start, len(history)) if not is_pinned(history[i])]
+    if sum(message_tokens(history[i]) for i in unsummarised) <= COMPACTION_THRESHOLD:
+        return None
+    recent = 0
+    cut = len(history)
+    for i in reversed(unsummarised):
+        recent += message_tokens(history[i])
+        if recent > COMPACTION_KEEP_RECENT:
+            break
+        cut = i
+    if cut <= start:
+        return None
+    return start, cut
+
+def compact_channel(channel):
+    with channel_state(channel).lock:
+        history = list(conversation_histories.get(channel, []))
+    bounds = compaction_cut(channel, history)
+    if not bounds:
+        return
+    start, cut = bounds
+    summary = get_channel_summary(channel)
+    transcript = "\n".join(transcript_line(channel, msg) for msg in history[start:cut] if not is_pinned(msg))
+    instruction = (
+        "You maintain a running summary of a roleplay conversation so the character can remember it. "
+        "Keep every fact, name, promise and relationship detail that could matter later; drop small talk. "
+        "Return only the updated summary.\n"
+    )
+    if summary:
+        instruction += "\nCurrent summary:\n" + summary["content"] + "\n"
+    instruction += "\nNew turns to fold into the summary:\n" + transcript
+    content = request_completion(SYS_MODEL, instruction, PRIORITY_BULK)
+    if not content:
+        return
+    new_summary = {"content": content, "covered": cut, "anchor": message_fingerprint(history[cut - 1])}
+    with channel_state(channel).lock:
+        current = conversation_histories.get(channel, [])
+        # Drop the result if the covered turns were edited while the summary was being generated.
+        if len(current) < cut or message_fingerprint(current[cut - 1]) != new_summary["anchor"]:
+            return
+        with compaction_lock:
+            channel_summaries[channel] = new_summary
+    write_text_atomic(summary_file(channel), json.dumps(new_summary))
+
+def compaction_worker(channel):
+    metrics_command.set("compaction")
+    try:
+        compact_channel(channel)
+    except Exception as e:
+        command_output(channel, f"Background summarisation failed: {e}")
+    finally:
+        with compaction_lock:
+            compaction_inflight.discard(channel)
+
+def schedule_compaction(channel):
+    # Called after each reply; the summarisation request runs on a daemon thread so the next prompt is
+    # never held up by it.
+    if not COMPACTION_ENABLED or channel not in conversation_histories:
+        return
+    if not compaction_cut(channel, conversation_histories[channel]):
+        return
+    with compaction_lock:
+        if channel in compaction_inflight:
+            return
+        compaction_inflight.add(channel)
+    # The worker runs in a copy of this context, so its output and username belong to the session that
+    # triggered it.
+    threading.Thread(target=contextvars.copy_context().run, args=(compaction_worker, channel), daemon=True).start()
+
+#############################################
+# Streaming Decoder
+#############################################
+
+class SSEDecoder:
+    # Incremental Server-Sent Events parser. Raw bytes go in as they arrive off the socket; the data of each
+    # complete event comes out. Multi-line data fields are joined with "\n" as the spec requires, and
+    # comments and other fields (event:, id:, retry:) are ignored.
+    def __init__(self):
+        self.buffer = b""
+        self.data_lines = []
+
+    @traced("stream")
+    def feed(self, chunk):
+        self.buffer += chunk
+        events = []
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = self.buffer[start:end]
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            self.feed_line(line, events)
+        self.buffer = self.buffer[start:]
+        return events
+
+    def feed_line(self, line, events):
+        if not line:
+            if self.data_lines:
+                events.append("\n".join(self.data_lines))
+                self.data_lines = []
+        elif line.startswith(b"data:"):
+            value = line[len(b"data:"):]
+            if value.startswith(b" "):
+                value = value[1:]
+            self.data_lines.append(value.decode("utf-8", errors="replace"))
+        elif line.startswith(b"{"):
+            # Some servers skip the SSE framing and send bare JSON lines; treat each one as an event.
+            events.append(line.decode("utf-8", errors="replace"))
+
+    def finish(self):
+        events = []
+        if self.buffer:
+            self.feed_line(self.buffer.rstrip(b"\r"), events)
+            self.buffer = b""
+        self.feed_line(b"", events)
+        return events
+
+class TokenBuffer:
+    # Collects streamed tokens in a list (joined once at the end) and writes them out in batches, so long
+    # replies are neither quadratic to build nor one terminal write per token.
+    def __init__(self, interval=STREAM_FLUSH_INTERVAL, max_chars=STREAM_FLUSH_CHARS):
+        self.interval = interval
+        self.max_chars = max_chars
+        self.tokens = []
+        self.pending = []
+        self.pending_chars = 0
+        self.last_flush = time.monotonic()
+        self.first_token_at = None
+
+    def add(self, token):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.tokens.append(token)
+        self.pending.append(token)
+        self.pending_chars += len(token)
+        if self.pending_chars >= self.max_chars or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    @traced("stream")
+    def flush(self):
+        if self.pending:
+            output_write("".join(self.pending))
+            self.pending = []
+            self.pending_chars = 0
+        self.last_flush = time.monotonic()
+
+    def text(self):
+        return "".join(self.tokens)
+
+def stream_token(data):
+    try:
+        json_data = json.loads(data)
+    except json.JSONDecodeError:
+        return ""
+    return (json_data.get("choices") or [{}])[0].get("delta", {}).get("content") or ""
+
 #############################################
 # LM Studio API Integration (with Stream Support)
 #############################################
 
+@traced("chat")
 def process_api_request(channel, payload, sock_file):
     try:
         payload["stream"] = False
-        api_url = get_lm_api_url()
-        response = requests.post(api_url, json=payload, headers={"Content-Type": "application/json"})
+        track_prefix(channel, payload["messages"])
+        response = lm_post(payload)
         if response.status_code == 200:
             data = response.json()
             reply = data.get("choices", [{}])[0].get("message", {}).get("content", "")
@@ -275,6 +2083,7 @@ def process_api_request(channel, payload, sock_file):
                 reply = process_reply(reply)
                 conversation_histories[channel].append({"role": "assistant", "content": reply})
                 conversation_output(channel, "assistant", reply)
+                record_reply(channel)
             else:
                 command_output(channel, "AI returned an empty reply.")
         else:
@@ -282,43 +2091,155 @@ def process_api_request(channel, payload, sock_file):
     except Exception as e:
         command_output(channel, f"Error contacting LM Studio API: {e}")
 
-def process_api_request_stream(channel, payload, sock_file):
+@traced("chat")
+def process_api_request_stream(channel, payload, sock_file, cancel_event=None):
     try:
         payload["stream"] = True
-        api_url = get_lm_api_url()
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "text/event-stream"
-        }
-        data = json.dumps(payload)
+        track_prefix(channel, payload["messages"])
+        headers = {"Accept": "text/event-stream"}
         # Print assistant header once before streaming.
-        sys.stdout.write(f"{role_colors['assistant']}{channel.lstrip('#')}\033[0m: ")
-        sys.stdout.flush()
-        response = requests.post(api_url, data=data, headers=headers, stream=True)
-        if response.status_code != 200:
-            command_output(channel, f"API Error: {response.status_code}")
-            return
-        collected = ""
-        for chunk in response.iter_lines(decode_unicode=True):
-            if chunk:
-                if chunk.startswith("data:"):
-                    chunk = chunk[len("data:"):].strip()
-                try:
-                    json_data = json.loads(chunk)
-                    token = json_data.get("choices", [{}])[0].get("delta", {}).get("content", "")
+        output_write(f"{role_colors['assistant']}{channel.lstrip('#')}\033[0m: ")
+        # The scheduler slot is held until the whole reply has streamed.
+        queued = time.time()
+        with scheduler.slot(payload.get("model"), PRIORITY_INTERACTIVE):
+            started = time.time()
+            try:
+                response = lm_post(payload, headers=headers, stream=True)
+            except Exception as e:
+                request_metrics.record(payload.get("model"), endpoint_label(), time.time() - started, started - queued, error=type(e).__name__)
+                raise
+            if response.status_code != 200:
+                request_metrics.record(payload.get("model"), endpoint_label(response), time.time() - started, started - queued, error=f"HTTP {response.status_code}")
+                command_output(channel, f"API Error: {response.status_code}")
+                return
+            decoder = SSEDecoder()
+            tokens = TokenBuffer()
+            cancelled = False
+            done = False
+            for chunk in response.iter_content(chunk_size=None):
+                if cancel_event is not None and cancel_event.is_set():
+                    cancelled = True
+                    response.close()
+                    break
+                for data in decoder.feed(chunk):
+                    if data.strip() == "[DONE]":
+                        done = True
+                        break
+                    token = stream_token(data)
                     if token:
-                        collected += token
-                        sys.stdout.write(token)
-                        sys.stdout.flush()
-                except json.JSONDecodeError:
-                    continue
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+                        tokens.add(token)
+                if done:
+                    response.close()
+                    break
+            else:
+                for data in decoder.finish():
+                    if data.strip() != "[DONE]":
+                        token = stream_token(data)
+                        if token:
+                            tokens.add(token)
+            tokens.flush()
+            collected = tokens.text()
+            ttft = tokens.first_token_at - started if tokens.first_token_at else None
+            request_metrics.record(payload.get("model"), endpoint_label(response), time.time() - started, started - queued, ttft=ttft,
+                                   prompt_tokens=sum(message_tokens(msg) for msg in payload["messages"]), completion_tokens=len(tokens.tokens),
+                                   error="cancelled" if cancelled else None)
+        output_write("\n")
+        if cancelled:
+            command_output(channel, "Generation cancelled.")
+            # A partial reply is kept so the conversation still alternates user/assistant.
+            if not collected:
+                return
         # Append full reply without reprinting.
         conversation_histories[channel].append({"role": "assistant", "content": collected})
+        record_reply(channel)
     except Exception as e:
         command_output(channel, f"Error contacting LM Studio API: {e}")
 
+def request_completion(model, prompt, priority=PRIORITY_SYSTEM, cache=None):
+    # Sends a single-turn, non-streaming request and returns the processed reply text.
+    payload = {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": False}
+    response = lm_post(payload, priority, cache)
+    if response.status_code != 200:
+        raise RuntimeError("API error " + str(response.status_code))
+    data = response.json()
+    return process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
+
+#############################################
+# Reply Variants
+#############################################
+
+def request_variants(payload, count):
+    # Returns count reply texts (None for a failed one) for the same context, generated concurrently so
+    # the whole set takes about as long as a single reply.
+    if ITERATE_USE_N_PARAMETER:
+        response = lm_post(dict(payload, n=count, stream=False))
+        if response.status_code == 200:
+            choices = response.json().get("choices", [])
+            if len(choices) >= count:
+                return [process_reply(choice.get("message", {}).get("content", "")) or None for choice in choices[:count]]
+
+    def one_variant():
+        # Identical payloads on purpose: cache=False keeps them from being merged into one request.
+        response = lm_post(dict(payload, stream=False), cache=False)
+        if response.status_code != 200:
+            raise RuntimeError(f"API Error: {response.status_code}")
+        return process_reply(response.json().get("choices", [{}])[0].get("message", {}).get("content", ""))
+
+    variants = [None] * count
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        futures = {submit_in_context(executor, one_variant): index for index in range(count)}
+        for future in as_completed(futures):
+            try:
+                variants[futures[future]] = future.result() or None
+            except Exception:
+                variants[futures[future]] = None
+    return variants
+
+def iterate_variants(channel, count):
+    history = conversation_histories.get(channel)
+    if not history:
+        command_output(channel, "Nothing to iterate on.")
+        return
+    removed = history.pop() if history[-1]["role"] == "assistant" else None
+    if history[-1]["role"] != "user":
+        if removed:
+            history.append(removed)
+        command_output(channel, "The last message is not a user message; nothing to regenerate.")
+        return
+    payload = {"model": CONVO_MODEL, "messages": build_context(channel)}
+    track_prefix(channel, payload["messages"])
+    variants = run_with_progress(f"Generating {count} variants", request_variants, payload, count)
+    if not any(variants):
+        if removed:
+            history.append(removed)
+        command_output(channel, "No variants could be generated; the previous reply was kept.")
+        return
+    char_name = "Velvet's (py)chai" if channel == "#welcome" else channel.lstrip("#")
+    for number, variant in enumerate(variants, start=1):
+        command_output(channel, f"[{number}]")
+        if variant:
+            output_write(f"{role_colors['assistant']}{char_name}\033[0m: {variant}\n")
+        else:
+            command_output(channel, "(failed)")
+    confirmation_pending[channel] = {"type": "variants", "command": "iterate", "variants": variants, "removed": removed}
+    command_output(channel, f"Pick a variant (1-{count}), or 'cancel' to keep the previous reply.")
+
+def process_variant_choice(channel, pending, response):
+    history = conversation_histories[channel]
+    choice = response.strip().lower()
+    if choice in ["cancel", "0"]:
+        if pending["removed"]:
+            history.append(pending["removed"])
+        confirmation_pending.pop(channel, None)
+        command_output(channel, "Variants discarded; the previous reply was kept.")
+    elif choice.isdigit() and 1 <= int(choice) <= len(pending["variants"]) and pending["variants"][int(choice) - 1]:
+        history.append({"role": "assistant", "content": pending["variants"][int(choice) - 1]})
+        confirmation_pending.pop(channel, None)
+        command_output(channel, f"Variant {choice} kept.")
+        record_reply(channel)
+    else:
+        command_output(channel, f"Pick a variant (1-{len(pending['variants'])}), or 'cancel' to keep the previous reply.")
+
 #############################################
 # Confirmation and Improvement Response Processing
 #############################################
@@ -331,6 +2252,10 @@ def process_confirmation_response(channel, sender, response, sock_file):
     pending = confirmation_pending.get(channel)
     if not pending:
         return False
+    metrics_command.set(pending.get("command", "iterate"))
+    if pending.get("type") == "variants":
+        process_variant_choice(channel, pending, response)
+        return True
     if pending.get("type") == "improvement":
         resp = response.lower()
         if resp in ["1", "confirm"]:
@@ -341,16 +2266,18 @@ def process_confirmation_response(channel, sender, response, sock_file):
                     if conversation_histories[channel][i]["role"] == "assistant":
                         conversation_histories[channel].pop(i)
                         command_output(channel, "Regenerating previous assistant message...")
-                        payload = {"model": SYS_MODEL, "messages": conversation_histories[channel]}
+                        payload = {"model": SYS_MODEL, "messages": build_context(channel)}
                         process_api_request(channel, payload, sock_file)
                         break
             if pending["command"] == "fixate":
-                conversation_histories[channel].append({"role": "system", "content": f"Hint: {pending['feedback']}"})
+                if CONTEXT_LAYOUT == "stable":
+                    hints = get_channel_hints(channel)
+                    set_channel_hints(channel, hints["hint"], hints["notes"] + [pending["feedback"]])
+                else:
+                    conversation_histories[channel].append({"role": "system", "content": f"Hint: {pending['feedback']}"})
             char_name = channel.lstrip("#")
-            filename = os.path.join(CHARACTERS_FOLDER, f"{char_name}.txt")
             try:
-                with open(filename, "w", encoding="utf-8") as f:
-                    f.write(pending["new_prompt"])
+                character_store.put(char_name, pending["new_prompt"], model=SYS_MODEL, grade=pending.get("grade"))
                 command_output(channel, "New system prompt saved permanently.")
             except Exception as e:
                 command_output(channel, f"Error saving system prompt: {e}")
@@ -369,7 +2296,8 @@ def process_confirmation_response(channel, sender, response, sock_file):
             )
             payload = {"model": SYS_MODEL, "messages": [{"role": "user", "content": instruction}]}
             try:
-                response_retry = run_with_progress("Generating improved backstory", lambda: requests.post(get_lm_api_url(), json=payload, headers={"Content-Type": "application/json"}))
+                # A retry asks for a different candidate, so it must not be answered from the cache.
+                response_retry = run_with_progress("Generating improved backstory", lambda: lm_post(payload, PRIORITY_SYSTEM, cache=False))
                 if response_retry.status_code != 200:
                     command_output(channel, f"LM Studio API error during prompt improvement: {response_retry.status_code}")
                     return True
@@ -389,7 +2317,7 @@ def process_confirmation_response(channel, sender, response, sock_file):
             )
             payload_summary = {"model": SYS_MODEL, "messages": [{"role": "user", "content": summary_instruction}]}
             try:
-                response_summary = run_with_progress("Generating Difference Summary", lambda: requests.post(get_lm_api_url(), json=payload_summary, headers={"Content-Type": "application/json"}))
+                response_summary = run_with_progress("Generating Difference Summary", lambda: lm_post(payload_summary, PRIORITY_SYSTEM))
                 if response_summary.status_code == 200:
                     data_summary = response_summary.json()
                     summary = process_reply(data_summary.get("choices", [{}])[0].get("message", {}).get("content", ""))
@@ -407,6 +2335,8 @@ def process_confirmation_response(channel, sender, response, sock_file):
         if response in ["yes", "no"]:
             if response == "yes":
                 if pending["command"] == "clearbackstory":
+                    discard_channel_summary(channel)
+                    discard_channel_hints(channel)
                     if channel in conversation_histories and conversation_histories[channel]:
                         if conversation_histories[channel][0]["role"] == "system":
                             conversation_histories[channel] = [conversation_histories[channel][0]]
@@ -420,17 +2350,15 @@ def process_confirmation_response(channel, sender, response, sock_file):
                         command_output(channel, "Cannot delete the default character.")
                     else:
                         char_name = channel.lstrip("#")
-                        filename = os.path.join(CHARACTERS_FOLDER, f"{char_name}.txt")
-                        if os.path.exists(filename):
-                            try:
-                                os.remove(filename)
+                        try:
+                            if character_store.delete(char_name):
                                 if channel in conversation_histories:
                                     del conversation_histories[channel]
-                                command_output(channel, f"Character '{char_name}' and its file have been deleted.")
-                            except Exception as e:
-                                command_output(channel, f"Error deleting character '{char_name}': {e}")
-                        else:
-                            command_output(channel, f"No file exists for character '{char_name}'.")
+                                command_output(channel, f"Character '{char_name}' has been deleted.")
+                            else:
+                                command_output(channel, f"No stored character named '{char_name}'.")
+                        except Exception as e:
+                            command_output(channel, f"Error deleting character '{char_name}': {e}")
                 confirmation_pending.pop(channel, None)
             elif response == "no":
                 command_output(channel, f"{pending['command']} command canceled.")
@@ -442,59 +2370,107 @@ def process_confirmation_response(channel, sender, response, sock_file):
 # Self-Improve Command (Beta Feature)
 #############################################
 
-def process_selfimprove(channel, sender, argument, sock_file):
+def improve_prompt(prompt, priority=PRIORITY_BULK, cache=None):
+    instruction = (
+        "Improve the following system prompt by adding more descriptive details and enhancements without removing any original information. "
+        "Ensure the final output is a refined system prompt suitable for guiding an AI character's behavior. "
+        "Do not include any greetings or extraneous text; output only the final improved system prompt.\n"
+        "Original system prompt:\n" + prompt
+    )
+    return request_completion(SYS_MODEL, instruction, priority, cache)
+
+def grade_prompt(prompt):
+    grade_instruction = (
+        "On a scale from 0 to 100, grade the following system prompt solely based on user experience and clarity. "
+        "Return only the number.\n" + prompt
+    )
+    grade_str = request_completion(SYS_MODEL, grade_instruction, PRIORITY_BULK)
     try:
-        threshold = int(argument.strip()) if argument.strip().isdigit() else 80
+        return int(''.join(filter(str.isdigit, grade_str)))
     except:
-        threshold = 80
+        return 0
+
+def improve_and_grade(prompt, cache=None):
+    candidate = improve_prompt(prompt, cache=cache)
+    if not candidate:
+        raise RuntimeError("empty improved prompt")
+    return candidate, grade_prompt(candidate)
+
+def run_selfimprove_round(prompt, beam, deadline, reuse_cached=False):
+    # Each worker improves then immediately grades its own candidate, so grading overlaps with the
+    # remaining generations. Candidates still running at the deadline are abandoned.
+    executor = ThreadPoolExecutor(max_workers=beam)
+    try:
+        # With reuse_cached only the first candidate may come from the cache; the rest must be fresh samples
+        # or the beam collapses.
+        futures = [submit_in_context(executor, improve_and_grade, prompt, None if i == 0 and reuse_cached else False) for i in range(beam)]
+        done, _ = wait(futures, timeout=max(0, deadline - time.time()))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    candidates, errors = [], []
+    for future in done:
+        try:
+            candidates.append(future.result())
+        except Exception as e:
+            errors.append(e)
+    return candidates, errors
+
+def parse_selfimprove_arguments(argument):
+    options = {"threshold": SELFIMPROVE_THRESHOLD, "beam": SELFIMPROVE_BEAM, "rounds": SELFIMPROVE_MAX_ROUNDS, "time": SELFIMPROVE_TIME_BUDGET}
+    for part in argument.split():
+        if part.isdigit():
+            options["threshold"] = int(part)
+            continue
+        key, _, value = part.partition("=")
+        if key.lower() not in ["beam", "rounds", "time"] or not value.isdigit() or int(value) < 1:
+            return None
+        options[key.lower()] = int(value)
+    return options
+
+def process_selfimprove(channel, sender, argument, sock_file):
+    options = parse_selfimprove_arguments(argument)
+    if options is None:
+        command_output(channel, "Usage: !selfimprove [score] [beam=<candidates>] [rounds=<max rounds>] [time=<seconds>]")
+        return True
+    threshold = options["threshold"]
     if channel not in conversation_histories or not conversation_histories[channel] or conversation_histories[channel][0]["role"] != "system":
         command_output(channel, "No system prompt to improve.")
         return True
     old_prompt = conversation_histories[channel][0]["content"]
     improved_prompt = None
-    grade = 0
-    while True:
-        instruction = (
-            "Improve the following system prompt by adding more descriptive details and enhancements without removing any original information. "
-            "Ensure the final output is a refined system prompt suitable for guiding an AI character's behavior. "
-            "Do not include any greetings or extraneous text; output only the final improved system prompt.\n"
-            "Original system prompt:\n" + old_prompt
-        )
-        payload = {"model": SYS_MODEL, "messages": [{"role": "user", "content": instruction}]}
-        try:
-            response = run_with_progress("Generating improved backstory", lambda: requests.post(get_lm_api_url(), json=payload, headers={"Content-Type": "application/json"}))
-            if response.status_code != 200:
-                command_output(channel, f"LM Studio API error during selfimprove: {response.status_code}")
-                return True
-            data = response.json()
-            improved_prompt = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
-        except Exception as e:
-            command_output(channel, f"Error during selfimprove: {e}")
-            return True
-        grade_instruction = (
-            "On a scale from 0 to 100, grade the following system prompt solely based on user experience and clarity. "
-            "Return only the number.\n" + improved_prompt
-        )
-        payload_grade = {"model": SYS_MODEL, "messages": [{"role": "user", "content": grade_instruction}]}
-        try:
-            response_grade = run_with_progress("Generating backstory grade", lambda: requests.post(get_lm_api_url(), json=payload_grade, headers={"Content-Type": "application/json"}))
-            if response_grade.status_code != 200:
-                command_output(channel, f"LM Studio API error during grading: {response_grade.status_code}")
-                return True
-            data_grade = response_grade.json()
-            grade_str = process_reply(data_grade.get("choices", [{}])[0].get("message", {}).get("content", ""))
-            try:
-                grade = int(''.join(filter(str.isdigit, grade_str)))
-            except:
-                grade = 0
-        except Exception as e:
-            command_output(channel, f"Error during grading: {e}")
-            return True
-        command_output(channel, f"Self-improve iteration: grade = {grade}")
-        if grade >= threshold:
+    grade = -1
+    deadline = time.time() + options["time"]
+    rounds = 0
+    while rounds < options["rounds"] and time.time() < deadline:
+        rounds += 1
+        label = "Generating improved backstory" if options["beam"] == 1 else f"Generating and grading {options['beam']} candidate backstories"
+        # A cached candidate is only reused in the first round, so rerunning the same !selfimprove is cheap.
+        # A later round may send the same prompt again when the previous one did not improve the grade, and
+        # a cached answer would just replay that round.
+        candidates, errors = run_with_progress(label, run_selfimprove_round, old_prompt, options["beam"], deadline, rounds == 1)
+        if not candidates:
+            if errors:
+                command_output(channel, f"Error during selfimprove: {errors[0]}")
+                if improved_prompt is None:
+                    return True
             break
+        round_prompt, round_grade = max(candidates, key=lambda candidate: candidate[1])
+        if options["beam"] == 1:
+            command_output(channel, f"Self-improve iteration: grade = {round_grade}")
         else:
-            old_prompt = improved_prompt
+            grades = ", ".join(str(candidate[1]) for candidate in sorted(candidates, key=lambda candidate: -candidate[1]))
+            command_output(channel, f"Self-improve round {rounds}: best grade = {round_grade} (candidates: {grades})")
+        # Later rounds build on the best candidate seen so far rather than the latest one.
+        if round_grade > grade:
+            improved_prompt, grade = round_prompt, round_grade
+        if grade >= threshold:
+            break
+        old_prompt = improved_prompt
+    if improved_prompt is None:
+        command_output(channel, "Self-improve ran out of time before any candidate was graded.")
+        return True
+    if grade < threshold:
+        command_output(channel, f"Self-improve stopped after {rounds} round(s) without reaching {threshold}; offering the best candidate (grade {grade}).")
     summary_instruction = (
         "Below is the current system prompt:\n" + conversation_histories[channel][0]["content"] +
         "\n\nBelow is the new improved system prompt:\n" + improved_prompt +
@@ -502,73 +2478,272 @@ def process_selfimprove(channel, sender, argument, sock_file):
     )
     payload_summary = {"model": SYS_MODEL, "messages": [{"role": "user", "content": summary_instruction}]}
     try:
-        response_summary = run_with_progress("Generating Difference Summary", lambda: requests.post(get_lm_api_url(), json=payload_summary, headers={"Content-Type": "application/json"}))
+        response_summary = run_with_progress("Generating Difference Summary", lambda: lm_post(payload_summary, PRIORITY_SYSTEM))
         if response_summary.status_code == 200:
             data_summary = response_summary.json()
             summary = process_reply(data_summary.get("choices", [{}])[0].get("message", {}).get("content", ""))
         else:
-            summary = "No summary provided."
-    except Exception as e:
-        summary = f"Error during summary generation: {e}"
-    confirmation_pending[channel] = {
-        "type": "improvement",
-        "command": "selfimprove",
-        "old_prompt": conversation_histories[channel][0]["content"],
-        "feedback": f"Self-improve iteration completed with grade {grade}",
-        "new_prompt": improved_prompt
-    }
-    prompt_confirmation(sock_file, channel, summary)
-    return True
+            summary = "No summary provided."
+    except Exception as e:
+        summary = f"Error during summary generation: {e}"
+    confirmation_pending[channel] = {
+        "type": "improvement",
+        "command": "selfimprove",
+        "old_prompt": conversation_histories[channel][0]["content"],
+        "feedback": f"Self-improve iteration completed with grade {grade}",
+        "new_prompt": improved_prompt,
+        "grade": grade
+    }
+    prompt_confirmation(sock_file, channel, summary)
+    return True
+
+#############################################
+# Character List Summaries
+#############################################
+
+@traced("file")
+def write_text_atomic(path, text):
+    # Writes to a temporary file first so readers never see a half-written file.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def summary_cache_key(content, model):
+    return hashlib.sha256((model + "\0" + content).encode("utf-8")).hexdigest()
+
+def load_summary_index():
+    if not os.path.exists(CHARACTERLIST_INDEX_FILE):
+        return {}
+    try:
+        with open(CHARACTERLIST_INDEX_FILE, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        return index if isinstance(index, dict) else {}
+    except Exception:
+        return {}
+
+def save_summary_index(index):
+    write_text_atomic(CHARACTERLIST_INDEX_FILE, json.dumps(index, indent=1, sort_keys=True))
+
+def summarize_character(content):
+    if not content:
+        return "No system prompt available."
+    prompt_text = "Provide a one sentence summary of the following character description:\n" + content
+    return request_completion(SYS_MODEL, prompt_text, PRIORITY_BULK)
+
+def generate_character_summaries(channel, jobs, concurrency):
+    # jobs is a list of (character, content). Summaries are requested from a bounded pool and slotted back
+    # by index so the result order never depends on which request finishes first. Failed entries are
+    # returned as None alongside an error message so callers can avoid caching them.
+    results = [None] * len(jobs)
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {submit_in_context(executor, summarize_character, content): index for index, (character, content) in enumerate(jobs)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = (future.result(), None)
+            except Exception as e:
+                results[index] = (None, f"Error: {e}")
+            done += 1
+            command_output(channel, f"[{done}/{len(jobs)}] Summarised {jobs[index][0]}")
+    return results
+
+def refresh_character_summaries(channel, concurrency, remake=False):
+    # Only characters whose prompt (or the summarising model) changed since the last run are re-summarised.
+    # The store's modified time is checked first so unchanged prompts are not even fetched or re-hashed.
+    index = {} if remake else load_summary_index()
+    entries = character_store.entries()
+    characters = [entry["name"] for entry in entries]
+    updated_index = {}
+    stale = []
+    for character, modified in ((entry["name"], entry["modified"]) for entry in entries):
+        entry = index.get(character)
+        if entry and entry.get("model") == SYS_MODEL and entry.get("modified") == modified:
+            updated_index[character] = entry
+            continue
+        content = (character_store.get(character) or "").strip()
+        key = summary_cache_key(content, SYS_MODEL)
+        if entry and entry.get("hash") == key:
+            updated_index[character] = dict(entry, modified=modified)
+            continue
+        stale.append((character, content, key, modified))
+    present = set(characters)
+    removed = [character for character in index if character not in present]
+    if stale:
+        command_output(channel, f"AI is busy, please wait... generating {len(stale)} of {len(characters)} character summaries ({concurrency} at a time)")
+        results = generate_character_summaries(channel, [(job[0], job[1]) for job in stale], concurrency)
+    else:
+        results = []
+    errors = {}
+    for (character, content, key, modified), (summary, error) in zip(stale, results):
+        if summary is None:
+            errors[character] = error
+            continue
+        updated_index[character] = {"hash": key, "model": SYS_MODEL, "modified": modified, "summary": summary}
+    save_summary_index(updated_index)
+    summary_lines = [f"{character}: {errors.get(character) or updated_index[character]['summary']}" for character in characters]
+    final_list = "\n\n".join(summary_lines)
+    write_text_atomic(CHARACTERLIST_FILE, final_list)
+    return final_list, len(stale) - len(errors), len(removed), len(errors)
+
+#############################################
+# Batch Character Creation
+#############################################
+
+def load_character_specs(path):
+    # A spec is a .jsonl file with one object per line or a .csv file with a header row. Each entry needs a
+    # "name" and either "details" (used like !set) or any of the !questionset fields.
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = [(reader_line, row) for reader_line, row in enumerate(csv.DictReader(f), start=2)]
+        else:
+            rows = []
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"line {line_number}: {e}")
+                if not isinstance(row, dict):
+                    raise ValueError(f"line {line_number}: expected a JSON object")
+                rows.append((line_number, row))
+    specs = []
+    seen = set()
+    for line_number, row in rows:
+        row = {str(k).strip().lower(): str(v).strip() for k, v in row.items() if k is not None and v is not None}
+        name = row.get("name", "")
+        if not valid_character_name(name):
+            raise ValueError(f"line {line_number}: invalid or missing character name {name!r}")
+        if name.lower() in seen:
+            raise ValueError(f"line {line_number}: duplicate character name {name!r}")
+        if not row.get("details") and not any(row.get(field) for field, _ in CHARACTER_SPEC_FIELDS):
+            raise ValueError(f"line {line_number}: {name} has no details to generate a prompt from")
+        seen.add(name.lower())
+        row["name"] = name
+        specs.append(row)
+    return specs
+
+def character_spec_prompt(spec):
+    if spec.get("details"):
+        return CUSTOM_SET_PROMPT + "\nDetails: " + spec["details"]
+    lines = [f"Name: {spec['name']}"] + [f"{label}: {spec.get(field, '')}" for field, label in CHARACTER_SPEC_FIELDS]
+    return CUSTOM_QUESTIONSET_PROMPT + "\n" + "\n".join(lines)
+
+def generate_character_prompt(spec, cache=None):
+    prompt = request_completion(SYS_MODEL, character_spec_prompt(spec), PRIORITY_BULK, cache)
+    if not prompt:
+        raise RuntimeError("empty system prompt")
+    return prompt
+
+def batch_create_characters(channel, specs, concurrency=BATCH_CREATE_CONCURRENCY, force=False):
+    # Each prompt is stored as soon as it arrives, so an interrupted run can simply be started again:
+    # characters that already have a non-empty prompt are skipped unless force is set.
+    jobs = []
+    skipped = invalid = 0
+    for spec in specs:
+        if not valid_character_name(spec["name"]):
+            invalid += 1
+            command_output(channel, f"Invalid character name '{spec['name']}': names may not contain '/' or start with '.'.")
+            continue
+        if not force and character_store.get(spec["name"]):
+            skipped += 1
+            continue
+        jobs.append(spec)
+    if skipped:
+        command_output(channel, f"Skipping {skipped} character(s) that already have a system prompt (use force to regenerate).")
+    created, failed = 0, invalid
+    if not jobs:
+        return created, skipped, failed
+    command_output(channel, f"AI is busy, please wait... generating {len(jobs)} system prompts ({concurrency} at a time)")
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # force asks for new prompts, so the response cache is bypassed rather than replaying the old ones.
+        futures = {submit_in_context(executor, generate_character_prompt, spec, False if force else None): spec for spec in jobs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            name = futures[future]["name"]
+            try:
+                prompt = future.result()
+                character_store.put(name, prompt, model=SYS_MODEL)
+                # A character that is already open picks up its new prompt straight away.
+                character_channel = "#" + name
+                with channel_state(character_channel).lock:
+                    history = conversation_histories.get(character_channel)
+                    if history and history[0]["role"] == "system":
+                        history[0]["content"] = prompt
+                created += 1
+                command_output(channel, f"[{done}/{len(jobs)}] Created {name}")
+            except Exception as e:
+                failed += 1
+                command_output(channel, f"[{done}/{len(jobs)}] Failed {name}: {e}")
+    return created, skipped, failed
+
+def parse_batch_create_arguments(argument):
+    # !batchcreate <file> [force] [n]
+    parts = argument.split()
+    if not parts:
+        return None
+    path, force, concurrency = parts[0], False, BATCH_CREATE_CONCURRENCY
+    for part in parts[1:]:
+        if part.lower() == "force":
+            force = True
+        elif part.isdigit() and int(part) > 0:
+            concurrency = int(part)
+        else:
+            return None
+    return path, force, concurrency
 
 #############################################
 # Command Processing Functions
 #############################################
 
+@traced("dispatch")
 def process_commands_section1(channel, sender, command, argument, sock_file, active_users):
-    global current_channel
     if command == "create":
         if argument:
             new_character = argument.strip()
+            if not valid_character_name(new_character):
+                command_output(channel, f"Invalid character name '{new_character}': names may not contain '/' or start with '.'.")
+                return True
             new_channel = "#" + new_character
-            filename = os.path.join(CHARACTERS_FOLDER, f"{new_character}.txt")
-            if not os.path.exists(filename):
-                with open(filename, "w", encoding="utf-8") as f:
-                    f.write("")
-                command_output(channel, f"File '{filename}' created.")
+            if character_store.create(new_character):
+                command_output(channel, f"Character '{new_character}' added to the character store.")
             else:
-                command_output(channel, f"File '{filename}' already exists.")
+                command_output(channel, f"Character '{new_character}' already exists.")
             load_conversation_history(new_channel)
             command_output(new_channel, f"Character '{new_character}' created.")
-            current_channel = new_channel
-            command_output(current_channel, f"Switched to character '{new_character}'.")
+            set_current_channel(new_channel)
+            command_output(new_channel, f"Switched to character '{new_character}'.")
         else:
             command_output(channel, "Usage: !create <character_name>")
         return True
     elif command == "duplicate":
         if argument:
             new_character = argument.strip()
-            source_character = current_channel.lstrip("#")
+            if not valid_character_name(new_character):
+                command_output(channel, f"Invalid character name '{new_character}': names may not contain '/' or start with '.'.")
+                return True
+            source_character = get_current_channel().lstrip("#")
             if source_character.lower() == "welcome":
                 command_output(channel, "Default character cannot be duplicated.")
                 return True
-            source_file = os.path.join(CHARACTERS_FOLDER, f"{source_character}.txt")
-            if not os.path.exists(source_file):
-                command_output(channel, f"Warning: Source character file for '{source_character}' does not exist. Cannot duplicate.")
+            source_info = character_store.info(source_character)
+            if source_info is None:
+                command_output(channel, f"Warning: Source character '{source_character}' is not stored. Cannot duplicate.")
                 return True
-            new_file = os.path.join(CHARACTERS_FOLDER, f"{new_character}.txt")
-            if os.path.exists(new_file):
+            if character_store.exists(new_character):
                 command_output(channel, f"Character '{new_character}' already exists.")
                 return True
             try:
-                with open(source_file, "r", encoding="utf-8") as f:
-                    content = f.read()
-                with open(new_file, "w", encoding="utf-8") as f:
-                    f.write(content)
+                character_store.put(new_character, character_store.get(source_character), model=source_info["model"], grade=source_info["grade"])
                 command_output(channel, f"Character duplicated as '{new_character}'.")
                 save_conversation(channel)
-                current_channel = "#" + new_character
-                load_conversation_history(current_channel)
-                command_output(current_channel, f"Switched to character '{new_character}'.")
+                new_channel = "#" + new_character
+                set_current_channel(new_channel)
+                load_conversation_history(new_channel)
+                command_output(new_channel, f"Switched to character '{new_character}'.")
             except Exception as e:
                 command_output(channel, f"Error duplicating character: {e}")
         else:
@@ -600,10 +2775,19 @@ def process_commands_section1(channel, sender, command, argument, sock_file, act
         return True
     elif command == "exit":
         save_conversation(channel)
+        export_conversation(channel)
+        session = current_session.get()
+        if session.remote:
+            # In server mode !exit only ends this connection.
+            session.exit_requested = True
+            command_output(channel, "Disconnecting. Conversation saved.")
+            return True
+        close_journals()
         command_output(channel, "Exiting. Conversation saved.")
         exit(0)
     return False
 
+@traced("dispatch")
 def process_commands_section3(channel, sender, command, argument, sock_file):
     if channel in multi_input_pending:
         return True
@@ -630,7 +2814,7 @@ def process_commands_section3(channel, sender, command, argument, sock_file):
     )
     payload = {"model": SYS_MODEL, "messages": [{"role": "user", "content": instruction}]}
     try:
-        response = run_with_progress("Generating improved backstory", lambda: requests.post(get_lm_api_url(), json=payload, headers={"Content-Type": "application/json"}))
+        response = run_with_progress("Generating improved backstory", lambda: lm_post(payload, PRIORITY_SYSTEM))
         if response.status_code != 200:
             command_output(channel, f"LM Studio API error during prompt improvement: {response.status_code}")
             return True
@@ -647,7 +2831,7 @@ def process_commands_section3(channel, sender, command, argument, sock_file):
         )
         payload_summary = {"model": SYS_MODEL, "messages": [{"role": "user", "content": summary_instruction}]}
         try:
-            response_summary = run_with_progress("Generating Difference Summary", lambda: requests.post(get_lm_api_url(), json=payload_summary, headers={"Content-Type": "application/json"}))
+            response_summary = run_with_progress("Generating Difference Summary", lambda: lm_post(payload_summary, PRIORITY_SYSTEM))
             if response_summary.status_code == 200:
                 data_summary = response_summary.json()
                 summary = data_summary.get("choices", [{}])[0].get("message", {}).get("content", "")
@@ -671,21 +2855,28 @@ def process_commands_section3(channel, sender, command, argument, sock_file):
         command_output(channel, f"Error during prompt improvement: {e}")
     return True
 
-def process_commands_section4(channel, sender, command, argument, sock_file, active_users):
-    global SYS_MODEL, CONVO_MODEL, available_models
-    if command == "serve":
-        payload = {"model": CONVO_MODEL, "messages": conversation_histories.get(channel, []), "stream": True}
-        process_api_request_stream(channel, payload, sock_file)
-        return True
-    elif command == "convomodel":
+def fetch_available_models(channel):
+    with global_state_lock:
         if not available_models:
             try:
-                response = requests.get(get_models_url(), timeout=2)
+                response = lm_get(MODELS_PATH, timeout=ENDPOINT_PROBE_TIMEOUT)
                 data = response.json()
                 available_models.extend([m["id"] for m in data["data"]])
             except Exception as e:
                 command_output(channel, f"Error fetching models: {e}")
-                return True
+                return False
+    return True
+
+@traced("dispatch")
+def process_commands_section4(channel, sender, command, argument, sock_file, active_users):
+    global SYS_MODEL, CONVO_MODEL, available_models, CONTEXT_TOKEN_BUDGET, CONTEXT_STRATEGY, CONTEXT_LAYOUT, RESPONSE_CACHE_ENABLED, METRICS_PROMETHEUS_FILE
+    if command == "serve":
+        payload = {"model": CONVO_MODEL, "messages": build_context(channel), "stream": True}
+        process_api_request_stream(channel, payload, sock_file)
+        return True
+    elif command == "convomodel":
+        if not fetch_available_models(channel):
+            return True
         command_output(channel, "Available conversation models:")
         for idx, model in enumerate(available_models, start=1):
             command_output(channel, f"{idx}. {model}")
@@ -693,7 +2884,8 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
             try:
                 model_index = int(argument.strip())
                 if 1 <= model_index <= len(available_models):
-                    CONVO_MODEL = available_models[model_index - 1]
+                    with global_state_lock:
+                        CONVO_MODEL = available_models[model_index - 1]
                     command_output(channel, f"Conversation model switched to {CONVO_MODEL}")
                 else:
                     command_output(channel, "Invalid model number.")
@@ -701,14 +2893,8 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
                 command_output(channel, "Usage: !convomodel <number>")
         return True
     elif command == "sysmodel":
-        if not available_models:
-            try:
-                response = requests.get(get_models_url(), timeout=2)
-                data = response.json()
-                available_models.extend([m["id"] for m in data["data"]])
-            except Exception as e:
-                command_output(channel, f"Error fetching models: {e}")
-                return True
+        if not fetch_available_models(channel):
+            return True
         command_output(channel, "Available system models:")
         for idx, model in enumerate(available_models, start=1):
             command_output(channel, f"{idx}. {model}")
@@ -716,7 +2902,8 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
             try:
                 model_index = int(argument.strip())
                 if 1 <= model_index <= len(available_models):
-                    SYS_MODEL = available_models[model_index - 1]
+                    with global_state_lock:
+                        SYS_MODEL = available_models[model_index - 1]
                     command_output(channel, f"System model switched to {SYS_MODEL}")
                 else:
                     command_output(channel, "Invalid model number.")
@@ -725,7 +2912,24 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
         return True
     elif command == "hint":
         if not argument:
-            command_output(channel, "Usage: !hint <instruction>")
+            command_output(channel, "Usage: !hint <instruction> | !hint clear")
+            return True
+        if CONTEXT_LAYOUT == "stable":
+            hints = get_channel_hints(channel)
+            if argument.strip().lower() == "clear":
+                set_channel_hints(channel)
+                command_output(channel, "Hints cleared.")
+                return True
+            set_channel_hints(channel, argument, hints["notes"])
+            history = conversation_histories[channel]
+            if history and history[-1]["role"] == "assistant":
+                history.pop()
+                command_output(channel, "Previous response removed due to hint. Regenerating...")
+            if history and history[-1]["role"] == "user":
+                payload = {"model": CONVO_MODEL, "messages": build_context(channel), "stream": True}
+                process_api_request_stream(channel, payload, sock_file)
+            else:
+                command_output(channel, "Hint set; it will be sent with the next message.")
             return True
         if conversation_histories[channel] and conversation_histories[channel][0]["role"] == "system":
             if len(conversation_histories[channel]) > 1 and conversation_histories[channel][1]["role"] == "system" and conversation_histories[channel][1]["content"].startswith("Hint:"):
@@ -739,7 +2943,7 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
             command_output(channel, "Previous response removed due to hint. Regenerating...")
             user_msg = conversation_histories[channel][-1]["content"]
             conversation_histories[channel].append({"role": "user", "content": user_msg})
-            payload = {"model": CONVO_MODEL, "messages": conversation_histories[channel], "stream": True}
+            payload = {"model": CONVO_MODEL, "messages": build_context(channel), "stream": True}
             process_api_request_stream(channel, payload, sock_file)
         return True
     elif command == "user":
@@ -753,9 +2957,8 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
             return True
         user_prompt = f"Generate a user reply to the following assistant message:\n{last_assistant}"
         payload = {"model": CONVO_MODEL, "messages": [{"role": "user", "content": user_prompt}]}
-        run_with_progress("Generating user reply", lambda: requests.post(get_lm_api_url(), json=payload, headers={"Content-Type": "application/json"}))
         try:
-            response = requests.post(get_lm_api_url(), json=payload, headers={"Content-Type": "application/json"})
+            response = run_with_progress("Generating user reply", lambda: lm_post(payload))
             if response.status_code == 200:
                 data = response.json()
                 user_reply = data.get("choices", [{}])[0].get("message", {}).get("content", "")
@@ -788,7 +2991,7 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
                 conversation_histories[channel].pop(i)
                 break
         command_output(channel, "User message edited. Regenerating assistant response...")
-        payload = {"model": CONVO_MODEL, "messages": conversation_histories[channel], "stream": True}
+        payload = {"model": CONVO_MODEL, "messages": build_context(channel), "stream": True}
         process_api_request_stream(channel, payload, sock_file)
         return True
     elif command == "assistantedit":
@@ -809,48 +3012,192 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
     elif command == "log":
         if channel in conversation_histories:
             for msg in conversation_histories[channel]:
-                if msg["role"] == "user":
-                    print(f"{role_colors['user']}{username}\033[0m: {msg['content']}")
-                elif msg["role"] == "assistant":
-                    char_name = channel.lstrip("#")
-                    if channel == "#welcome":
-                        char_name = "Velvet's (py)chai"
-                    print(f"{role_colors['assistant']}{char_name}\033[0m: {msg['content']}")
-                else:
-                    print(f"{role_colors['system']}{msg['content']}\033[0m")
+                conversation_output(channel, msg["role"], msg["content"])
         else:
             command_output(channel, "No conversation history available.")
         return True
     elif command == "save":
         save_conversation(channel)
+        export_conversation(channel)
         return True
     elif command == "load":
-        filename = os.path.join(SAVED_CONVOS_FOLDER, f"{channel.lstrip('#')}_saved.txt")
-        if os.path.exists(filename):
-            try:
-                with open(filename, "r", encoding="utf-8") as f:
-                    lines = f.readlines()
-                loaded_history = []
-                for line in lines:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    if ": " in line:
-                        role, content = line.split(": ", 1)
-                        if role.lower() == "system":
-                            continue
-                        loaded_history.append({"role": role, "content": content})
-                if channel in conversation_histories and conversation_histories[channel]:
-                    system_msg = conversation_histories[channel][0]
-                else:
-                    load_conversation_history(channel)
-                    system_msg = conversation_histories[channel][0]
+        # !load restores the whole saved conversation, !load last <n> only the newest n messages, and
+        # !load <from>-<to> prints saved messages from..to (1 = first saved record) without restoring.
+        parts = argument.strip().split()
+        journal_path = journal_file(channel)
+        legacy_path = folder_path(SAVED_CONVOS_FOLDER, f"{channel.lstrip('#')}_saved.txt")
+        last = None
+        view = None
+        if len(parts) == 2 and parts[0].lower() == "last" and parts[1].isdigit():
+            last = int(parts[1])
+        elif len(parts) == 1 and re.match(r"^\d+-\d+$", parts[0]):
+            first, final = (int(x) for x in parts[0].split("-"))
+            if first < 1 or final < first:
+                command_output(channel, "Usage: !load [last <n> | <from>-<to>]")
+                return True
+            view = (first, final)
+        elif parts:
+            command_output(channel, "Usage: !load [last <n> | <from>-<to>]")
+            return True
+        try:
+            if channel not in conversation_histories or not conversation_histories[channel]:
+                load_conversation_history(channel)
+            system_msg = conversation_histories[channel][0]
+            if os.path.exists(journal_path):
+                if view:
+                    ensure_clean_journal(channel)
+                    for number, msg in enumerate(read_journal_lines(journal_path, view[0] - 1, view[1]), start=view[0]):
+                        command_output(channel, f"[{number}]")
+                        conversation_output(channel, msg["role"], msg["content"])
+                    return True
+                loaded, skipped = restore_from_journal(channel, system_msg, last)
+                note = f" (older {skipped} messages left in the journal)" if skipped else ""
+                command_output(channel, f"Conversation history loaded: {loaded} messages{note}.")
+            elif os.path.exists(legacy_path):
+                if view or last is not None:
+                    command_output(channel, "Partial loads need a journaled conversation; loading the whole text log instead.")
+                loaded_history = parse_legacy_log(channel, legacy_path)
                 conversation_histories[channel] = [system_msg] + loaded_history
-                command_output(channel, "Conversation history loaded from saved file.")
-            except Exception as e:
-                command_output(channel, f"Error loading saved conversation: {e}")
+                command_output(channel, "Conversation history loaded from saved text log.")
+            else:
+                command_output(channel, "No saved conversation found.")
+        except Exception as e:
+            command_output(channel, f"Error loading saved conversation: {e}")
+        return True
+    elif command == "context":
+        parts = argument.strip().split()
+        if len(parts) == 2 and parts[0].lower() == "budget" and parts[1].isdigit() and int(parts[1]) > 0:
+            CONTEXT_TOKEN_BUDGET = int(parts[1])
+            command_output(channel, f"Context budget set to {CONTEXT_TOKEN_BUDGET} tokens.")
+        elif len(parts) == 2 and parts[0].lower() == "strategy" and parts[1].lower() in CONTEXT_STRATEGIES:
+            CONTEXT_STRATEGY = parts[1].lower()
+            command_output(channel, f"Context strategy set to {CONTEXT_STRATEGY}.")
+        elif len(parts) == 2 and parts[0].lower() == "layout" and parts[1].lower() in CONTEXT_LAYOUTS:
+            CONTEXT_LAYOUT = parts[1].lower()
+            command_output(channel, f"Context layout set to {CONTEXT_LAYOUT}.")
+        elif parts:
+            command_output(channel, "Usage: !context [budget <tokens> | strategy <" + "|".join(CONTEXT_STRATEGIES) + "> | layout <" + "|".join(CONTEXT_LAYOUTS) + ">]")
+            return True
+        stats = context_stats(channel)
+        command_output(channel, (
+            f"Context: strategy {CONTEXT_STRATEGY}, layout {CONTEXT_LAYOUT}, budget {CONTEXT_TOKEN_BUDGET} tokens. "
+            f"Sending {stats['context_messages']}/{stats['history_messages']} messages "
+            f"(~{stats['context_tokens']}/{stats['history_tokens']} tokens)."
+        ))
+        summary = get_channel_summary(channel)
+        if summary:
+            command_output(channel, f"Running summary covers the first {summary['covered']} messages:\n{summary['content']}")
+        slot = hint_slot(channel)
+        if slot and CONTEXT_LAYOUT == "stable":
+            command_output(channel, "Trailing hint slot:\n" + slot["content"])
+        return True
+    elif command == "cache":
+        option = argument.strip().lower()
+        if option == "clear":
+            command_output(channel, f"Response cache cleared ({response_cache.clear()} entries removed).")
+        elif option in ["on", "off"]:
+            RESPONSE_CACHE_ENABLED = option == "on"
+            command_output(channel, f"Response cache turned {option}.")
+        elif option:
+            command_output(channel, "Usage: !cache [on|off|clear]")
+        else:
+            state = "on" if RESPONSE_CACHE_ENABLED else "off"
+            command_output(channel, f"Response cache is {state}: {response_cache.stats()}")
+        return True
+    elif command == "trace":
+        parts = argument.strip().split(maxsplit=1)
+        option = parts[0].lower() if parts else ""
+        if option == "on":
+            path = parts[1] if len(parts) == 2 else TRACE_DEFAULT_FILE
+            tracer.enable(path)
+            command_output(channel, f"Tracing to {path}. !trace save writes it now, !trace off writes it and stops.")
+        elif option in ("off", "save"):
+            if not tracer.enabled:
+                command_output(channel, "Tracing is off.")
+                return True
+            try:
+                count = tracer.disable() if option == "off" else tracer.flush()
+                command_output(channel, f"Wrote {count} spans to {tracer.path}; open it in chrome://tracing or ui.perfetto.dev.")
+            except OSError as e:
+                command_output(channel, f"Error writing trace: {e}")
+        elif option:
+            command_output(channel, "Usage: !trace [on [file] | save | off]")
+        elif tracer.enabled:
+            dropped = f" ({tracer.dropped} dropped past TRACE_MAX_EVENTS)" if tracer.dropped else ""
+            command_output(channel, f"Tracing to {tracer.path}: {len(tracer.events)} spans recorded{dropped}.")
+        else:
+            command_output(channel, "Tracing is off. Use !trace on [file] or set PYCHAI_TRACE.")
+        return True
+    elif command == "profile":
+        parts = argument.strip().split(" ", 1)
+        target = parts[0].lstrip("!").lower()
+        if not target or target == "profile":
+            command_output(channel, "Usage: !profile <command> [arguments]")
+            return True
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            command_output(channel, f"Cannot profile: {e}")
+            return True
+        start = time.perf_counter()
+        try:
+            process_commands(channel, sender, target, parts[1] if len(parts) > 1 else "", sock_file, active_users)
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).strip_dirs().sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        try:
+            os.makedirs(PROFILE_FOLDER, exist_ok=True)
+            path = os.path.join(PROFILE_FOLDER, f"{target}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+            profiler.dump_stats(path)
+            saved = f"Saved to {path}."
+        except OSError as e:
+            saved = f"Could not save the profile: {e}."
+        # cProfile only sees the calling thread; work handed to pools or the request threads is not included.
+        command_output(channel, f"!{target} took {elapsed:.3f}s. {saved} Worker threads are not profiled.\n" + report.getvalue().strip())
+        return True
+    elif command == "stats":
+        parts = argument.strip().split(maxsplit=1)
+        option = parts[0].lower() if parts else ""
+        if option == "reset":
+            request_metrics.reset()
+            command_output(channel, "Request statistics reset.")
+        elif option == "export" and len(parts) == 2:
+            if parts[1].lower() == "off":
+                METRICS_PROMETHEUS_FILE = None
+                command_output(channel, "Prometheus export turned off.")
+            else:
+                try:
+                    request_metrics.export(parts[1])
+                    METRICS_PROMETHEUS_FILE = parts[1]
+                    command_output(channel, f"Metrics written to {parts[1]}; it is refreshed at most every {METRICS_EXPORT_INTERVAL}s as requests complete.")
+                except OSError as e:
+                    command_output(channel, f"Error writing metrics: {e}")
+        elif option:
+            command_output(channel, "Usage: !stats [reset | export <path>|off]")
+        else:
+            lines = request_metrics.summary_lines()
+            command_output(channel, "LM Studio request statistics (model | command | endpoint):\n" + ("\n".join(lines) if lines else "No requests yet."))
+        return True
+    elif command == "queue":
+        lines = scheduler.status()
+        command_output(channel, "LM Studio request queue:\n" + ("\n".join(lines) if lines else "idle") + "\n" + single_flight.status())
+        return True
+    elif command in ["pin", "unpin"]:
+        history = conversation_histories.get(channel, [])
+        offset = argument.strip() or "1"
+        if not offset.isdigit() or not 1 <= int(offset) <= len(history):
+            command_output(channel, f"Usage: !{command} [n] (n = message position from the end, default 1)")
+            return True
+        msg = history[-int(offset)]
+        if command == "pin":
+            msg["pinned"] = True
+            command_output(channel, f"Pinned {msg['role']} message; it will always be kept in the context.")
         else:
-            command_output(channel, "No saved conversation found.")
+            msg.pop("pinned", None)
+            command_output(channel, f"Unpinned {msg['role']} message.")
         return True
     elif command == "delete":
         if channel.lower() == "#welcome":
@@ -860,6 +3207,13 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
         command_output(channel, "Are you sure you want to delete this character? (yes/no)")
         return True
     elif command == "iterate":
+        if argument.strip():
+            if not argument.strip().isdigit() or not 1 <= int(argument.strip()) <= ITERATE_MAX_VARIANTS:
+                command_output(channel, f"Usage: !iterate [variants 1-{ITERATE_MAX_VARIANTS}]")
+                return True
+            if int(argument.strip()) > 1:
+                iterate_variants(channel, int(argument.strip()))
+                return True
         if channel in conversation_histories and len(conversation_histories[channel]) > 0:
             last_msg = conversation_histories[channel][-1]
             if last_msg["role"] in ["assistant", "user"]:
@@ -867,7 +3221,7 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
                 command_output(channel, "Previous response removed. Regenerating...")
                 user_msg = conversation_histories[channel][-1]["content"]
                 conversation_histories[channel].append({"role": "user", "content": user_msg})
-                payload = {"model": CONVO_MODEL, "messages": conversation_histories[channel], "stream": True}
+                payload = {"model": CONVO_MODEL, "messages": build_context(channel), "stream": True}
                 process_api_request_stream(channel, payload, sock_file)
         return True
     elif command in ["rawset", "setraw"]:
@@ -881,10 +3235,8 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
             else:
                 conversation_histories[channel] = [{"role": "system", "content": new_prompt}]
             char_name = channel.lstrip("#")
-            filename = os.path.join(CHARACTERS_FOLDER, f"{char_name}.txt")
             try:
-                with open(filename, "w", encoding="utf-8") as f:
-                    f.write(new_prompt)
+                character_store.put(char_name, new_prompt)
                 command_output(channel, "System prompt set manually via rawset.")
             except Exception as e:
                 command_output(channel, f"Error writing system prompt: {e}")
@@ -939,58 +3291,73 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
         command_output(channel, f"Color for {role} messages set to {color}.")
         return True
     elif command == "characterlist":
-        # New: if argument "remake" is provided, regenerate the character list.
-        remake = argument.strip().lower() == "remake"
-        try:
-            if not remake and os.path.exists(CHARACTERLIST_FILE):
-                with open(CHARACTERLIST_FILE, "r", encoding="utf-8") as f:
-                    final_list = f.read().strip()
-                command_output(channel, "Character list (loaded from memory):\n" + final_list)
+        # Summaries are cached per character; "remake" discards the cache and regenerates every summary.
+        parts = argument.strip().split()
+        remake = bool(parts) and parts[0].lower() == "remake"
+        concurrency = CHARACTERLIST_CONCURRENCY
+        if parts and (not remake or len(parts) > 2):
+            command_output(channel, "Usage: !characterlist [remake [concurrency]]")
+            return True
+        if len(parts) > 1:
+            if not parts[1].isdigit() or int(parts[1]) < 1:
+                command_output(channel, "Usage: !characterlist [remake [concurrency]]")
                 return True
-            char_folder = CHARACTERS_FOLDER
-            files = [f for f in os.listdir(char_folder) if f.endswith(".txt")]
-            if not files:
+            concurrency = int(parts[1])
+        try:
+            if not character_store.count():
                 command_output(channel, "No characters found.")
                 return True
-            command_output(channel, "AI is busy, please wait... generating character summaries")
-            summary_lines = []
-            for filename in files:
-                character = os.path.splitext(filename)[0]
-                with open(os.path.join(char_folder, filename), "r", encoding="utf-8") as f:
-                    content = f.read().strip()
-                if not content:
-                    summary = "No system prompt available."
-                else:
-                    prompt_text = "Provide a one sentence summary of the following character description:\n" + content
-                    payload = {"model": SYS_MODEL, "messages": [{"role": "user", "content": prompt_text}]}
-                    try:
-                        command_output(channel, "Generating character summary...")
-                        response = requests.post(get_lm_api_url(), json=payload, headers={"Content-Type": "application/json"})
-                        if response.status_code == 200:
-                            data = response.json()
-                            summary = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
-                        else:
-                            summary = "API error " + str(response.status_code)
-                    except Exception as e:
-                        summary = f"Error: {e}"
-                summary_lines.append(f"{character}: {summary}")
-            final_list = "\n\n".join(summary_lines)
-            with open(CHARACTERLIST_FILE, "w", encoding="utf-8") as f:
-                f.write(final_list)
-            command_output(channel, "Character list:\n" + final_list)
+            final_list, summarised, removed, failed = refresh_character_summaries(channel, concurrency, remake)
+            if summarised or removed or failed:
+                command_output(channel, f"Character summaries refreshed: {summarised} updated, {removed} removed, {failed} failed.")
+                command_output(channel, "Character list:\n" + final_list)
+            else:
+                command_output(channel, "Character list (loaded from memory):\n" + final_list)
         except Exception as e:
             command_output(channel, f"Error generating character list: {e}")
         return True
+    elif command == "characters":
+        entries = character_store.entries(argument.strip())
+        if not entries:
+            command_output(channel, "No characters found.")
+            return True
+        lines = []
+        for entry in entries:
+            details = [time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["modified"])), f"{entry['size']} chars"]
+            if entry["model"]:
+                details.append(entry["model"])
+            if entry["grade"] is not None:
+                details.append(f"grade {entry['grade']}")
+            lines.append(f"{entry['name']} ({', '.join(details)})")
+        command_output(channel, f"{len(entries)} character(s):\n" + "\n".join(lines))
+        return True
+    elif command == "search":
+        if not argument.strip():
+            command_output(channel, "Usage: !search <words>")
+            return True
+        results = character_store.search(argument)
+        if results:
+            command_output(channel, "Matching characters:\n" + "\n".join(f"{name}: {snippet}" for name, snippet in results))
+        else:
+            command_output(channel, "No characters match.")
+        return True
+    elif command == "batchcreate":
+        parsed = parse_batch_create_arguments(argument)
+        if not parsed:
+            command_output(channel, "Usage: !batchcreate <specs.jsonl|specs.csv> [force] [concurrency]")
+            return True
+        path, force, concurrency = parsed
+        try:
+            specs = load_character_specs(path)
+        except (OSError, ValueError) as e:
+            command_output(channel, f"Error reading character specs: {e}")
+            return True
+        created, skipped, failed = batch_create_characters(channel, specs, concurrency, force)
+        command_output(channel, f"Batch create finished: {created} created, {skipped} skipped, {failed} failed.")
+        return True
     elif command == "character":
-        save_conversation(channel)
         if argument.strip():
-            new_channel = "#" + argument.strip()
-            current_character_file = os.path.join(CHARACTERS_FOLDER, f"{argument.strip()}.txt")
-            current_channel = new_channel
-            load_conversation_history(current_channel)
-            if not os.path.exists(current_character_file):
-                command_output(current_channel, f"Warning: Character file for '{argument.strip()}' does not exist. Using default prompt.")
-            command_output(current_channel, f"Switched to character '{argument.strip()}'.")
+            switch_character(channel, argument.strip())
         else:
             command_output(channel, "Usage: !character {name}")
         return True
@@ -1008,22 +3375,33 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
             "rawset - Manually set the system prompt (multiline input supported).\n"
             "questionset - Guided setup for a new character's system prompt (first question is single line).\n"
             "improve/sharpen/fixate - Improve the system prompt; 'sharpen' regenerates the previous assistant message, 'fixate' adds a hint.\n"
-            "selfimprove [score] - Automatically improve the system prompt until graded above the threshold (default 80).\n"
+            "selfimprove [score] [beam=k] [rounds=n] [time=s] - Automatically improve the system prompt until graded above the threshold (default 80); beam=k grades k candidates per round in parallel, stopping after n rounds or s seconds.\n"
             "edit - Replace the previous user message and regenerate a response.\n"
             "assistantedit - Replace the previous assistant message with a custom one.\n"
             "serve - Generate an AI response using the full conversation history with stream support.\n"
-            "hint - Add a hint to influence the next AI response and remake the previous answer.\n"
+            "hint <text> | hint clear - Add a hint to influence the next AI response and remake the previous answer (in the stable layout it is sent after the conversation; 'clear' removes hints).\n"
             "convomodel - List available conversation models or switch conversation model by number.\n"
             "sysmodel - List available system models or switch system model by number.\n"
             "user - Generate a user reply to the last assistant message.\n"
             "log - Display the full conversation history with proper formatting.\n"
-            "save - Save the current conversation log to a file.\n"
-            "load - Load the saved conversation log.\n"
-            "iterate - Remove the last response and regenerate it.\n"
+            "save - Save the current conversation and export a formatted text log.\n"
+            "load [last <n> | <from>-<to>] - Restore the saved conversation (or only its newest n messages); a range prints saved messages without restoring.\n"
+            "iterate [n] - Remove the last response and regenerate it; with n > 1, generate n variants at once and pick one by number.\n"
+            "context [budget <tokens> | strategy <sliding|full> | layout <stable|inline>] - Show or change how much history is sent with each request and how it is laid out.\n"
+            "pin/unpin [n] - Always keep (or stop keeping) the n-th message from the end in the context (default: last message).\n"
             "connection - Test LM Studio API connectivity and display ping.\n"
+            "queue - Show LM Studio requests in flight and waiting, per model and priority, and how many duplicates were merged.\n"
+            "trace [on [file] | save | off] - Record spans for commands, file I/O, HTTP and stream parsing as a Chrome trace (PYCHAI_TRACE=<file> traces from startup).\n"
+            "profile <command> [arguments] - Run a command under cProfile and show the slowest functions.\n"
+            "stats [reset | export <path>|off] - Show latency, time to first token and tokens/s percentiles per model, command and endpoint, or export them in Prometheus format.\n"
+            "cache [on|off|clear] - Show system model response cache statistics, toggle it or empty it.\n"
             "setcolor - Customize message colors. Usage: !setcolor <role> <color>\n"
-            "characterlist [remake] - List all characters with one-sentence summaries (pass 'remake' to regenerate them).\n"
+            "characterlist [remake [n]] - List all characters with one-sentence summaries; only new or edited characters are re-summarised (pass 'remake' to regenerate all of them, n requests at a time).\n"
+            "characters [prefix] - List stored characters (optionally only names starting with prefix) with their metadata.\n"
+            "search <words> - Find characters whose name or system prompt contains all of the words.\n"
+            "batchcreate <file> [force] [n] - Generate system prompts for every character in a JSONL/CSV spec file, n at a time; existing characters are skipped unless 'force' is given.\n"
             "character - Switch to a specific character (auto-saves current conversation).\n"
+            "cancel [all] - Stop the reply that is streaming ('all' also drops queued messages).\n"
             "exit - Save conversation and exit the tool.\n"
             "help - Display this help message."
         )
@@ -1031,199 +3409,611 @@ def process_commands_section4(channel, sender, command, argument, sock_file, act
         return True
     return False
 
+def switch_character(channel, name):
+    if not valid_character_name(name):
+        command_output(channel, f"Invalid character name '{name}': names may not contain '/' or start with '.'.")
+        return channel
+    save_conversation(channel)
+    new_channel = "#" + name
+    set_current_channel(new_channel)
+    load_conversation_history(new_channel)
+    if not character_store.exists(name):
+        command_output(new_channel, f"Warning: Character '{name}' does not exist. Using default prompt.")
+    command_output(new_channel, f"Switched to character '{name}'.")
+    return new_channel
+
+# Commands that read or write arbitrary paths on the host, or reset process-wide state. Network clients
+# (--listen) get a refusal; None blocks the whole command, a string only that first argument.
+REMOTE_BLOCKED_COMMANDS = {"trace": None, "profile": None, "batchcreate": None, "stats": "export", "cache": "clear"}
+
+def remote_blocked(command, argument):
+    if command not in REMOTE_BLOCKED_COMMANDS:
+        return False
+    option = REMOTE_BLOCKED_COMMANDS[command]
+    return option is None or argument.strip().lower().split()[:1] == [option]
+
 def process_commands(channel, sender, command, argument, sock_file, active_users):
-    if process_commands_section1(channel, sender, command, argument, sock_file, active_users):
+    metrics_command.set(command)
+    if current_session.get().remote and remote_blocked(command, argument):
+        blocked = " ".join(filter(None, [command, REMOTE_BLOCKED_COMMANDS[command]]))
+        command_output(channel, f"!{blocked} is only available at the server's own prompt.")
+        return
+    with tracer.span("!" + command, "dispatch", channel=channel):
+        if process_commands_section1(channel, sender, command, argument, sock_file, active_users):
+            return
+        if process_commands_section3(channel, sender, command, argument, sock_file):
+            return
+        if process_commands_section4(channel, sender, command, argument, sock_file, active_users):
+            return
+        command_output(channel, "Unknown command. Type !help for a list of commands.")
+
+#############################################
+# Multiline Input Processing
+#############################################
+
+def process_multi_input(channel, user_input):
+    pending = multi_input_pending[channel]
+    metrics_command.set(pending["command"])
+    if user_input.lower() == "cancel":
+        multi_input_pending.pop(channel, None)
+        command_output(channel, "Multiline input cancelled.")
+        return
+    if pending["command"] == "questionset" and pending.get("single_line_first", False) and pending["question_index"] == 0:
+        pending.setdefault("answers", []).append(user_input.strip())
+        pending["buffer"] = ""
+        pending["question_index"] += 1
+        if pending["question_index"] < len(pending["questions"]):
+            next_q = pending["questions"][pending["question_index"]]
+            command_output(channel, next_q + " (type your answer then 'continue' when done or 'cancel' to abort)")
+        else:
+            details = pending["answers"]
+            ai_query = CUSTOM_QUESTIONSET_PROMPT + "\n" + (
+                f"Name: {details[0]}\n"
+                f"Background: {details[1]}\n"
+                f"Personality: {details[2]}\n"
+                f"Special Abilities/Additional Details: {details[3]}\n"
+                f"Extra Instructions: {details[4]}"
+            )
+            response = run_with_progress("Generating Backstory", lambda: lm_post({"model": SYS_MODEL, "messages": [{"role": "user", "content": ai_query}], "stream": False}, PRIORITY_SYSTEM))
+            if response.status_code == 200:
+                data = response.json()
+                new_prompt = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
+                if new_prompt:
+                    if channel in conversation_histories and conversation_histories[channel]:
+                        conversation_histories[channel][0]["content"] = new_prompt
+                    else:
+                        conversation_histories[channel] = [{"role": "system", "content": new_prompt}]
+                    char_name = channel.lstrip("#")
+                    character_store.put(char_name, new_prompt, model=SYS_MODEL)
+                    command_output(channel, "Questionset prompt updated and backstory set.")
+                else:
+                    command_output(channel, "LM Studio API returned an empty prompt for questionset.")
+            else:
+                command_output(channel, f"LM Studio API error during questionset: {response.status_code}")
+            multi_input_pending.pop(channel, None)
+        return
+
+    if user_input.lower() == "continue":
+        if pending["command"] == "set":
+            complete_input = pending.get("buffer", "").strip()
+            ai_prompt = CUSTOM_SET_PROMPT + "\nDetails: " + complete_input
+            response = run_with_progress("Generating Backstory", lambda: lm_post({"model": SYS_MODEL, "messages": [{"role": "user", "content": ai_prompt}]}, PRIORITY_SYSTEM))
+            if response.status_code == 200:
+                data = response.json()
+                new_prompt = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
+                if new_prompt:
+                    if channel in conversation_histories and conversation_histories[channel]:
+                        conversation_histories[channel][0]["content"] = new_prompt
+                    else:
+                        conversation_histories[channel] = [{"role": "system", "content": new_prompt}]
+                    char_name = channel.lstrip("#")
+                    character_store.put(char_name, new_prompt, model=SYS_MODEL)
+                    command_output(channel, "System prompt updated via set command.")
+                else:
+                    command_output(channel, "LM Studio API returned an empty prompt for set.")
+            else:
+                command_output(channel, f"LM Studio API error during set: {response.status_code}")
+            multi_input_pending.pop(channel, None)
+        elif pending["command"] == "questionset":
+            pending.setdefault("answers", []).append(pending.get("buffer", "").strip())
+            pending["buffer"] = ""
+            pending["question_index"] += 1
+            if pending["question_index"] < len(pending["questions"]):
+                next_q = pending["questions"][pending["question_index"]]
+                command_output(channel, next_q + " (type your answer then 'continue' when done or 'cancel' to abort)")
+            else:
+                details = pending["answers"]
+                ai_query = CUSTOM_QUESTIONSET_PROMPT + "\n" + (
+                    f"Name: {details[0]}\n"
+                    f"Background: {details[1]}\n"
+                    f"Personality: {details[2]}\n"
+                    f"Special Abilities/Additional Details: {details[3]}\n"
+                    f"Extra Instructions: {details[4]}"
+                )
+                response = run_with_progress("Generating Backstory", lambda: lm_post({"model": SYS_MODEL, "messages": [{"role": "user", "content": ai_query}], "stream": False}, PRIORITY_SYSTEM))
+                if response.status_code == 200:
+                    data = response.json()
+                    new_prompt = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
+                    if new_prompt:
+                        if channel in conversation_histories and conversation_histories[channel]:
+                            conversation_histories[channel][0]["content"] = new_prompt
+                        else:
+                            conversation_histories[channel] = [{"role": "system", "content": new_prompt}]
+                        char_name = channel.lstrip("#")
+                        character_store.put(char_name, new_prompt, model=SYS_MODEL)
+                        command_output(channel, "Questionset prompt updated and backstory set.")
+                    else:
+                        command_output(channel, "LM Studio API returned an empty prompt for questionset.")
+                else:
+                    command_output(channel, f"LM Studio API error during questionset: {response.status_code}")
+                multi_input_pending.pop(channel, None)
+        elif pending["command"] == "dialogue":
+            complete_input = pending.get("buffer", "").strip()
+            load_conversation_history(channel)
+            conversation_histories[channel].append({"role": "user", "content": complete_input})
+            payload = {"model": CONVO_MODEL, "messages": build_context(channel), "stream": True}
+            process_api_request_stream(channel, payload, None)
+            multi_input_pending.pop(channel, None)
         return
-    if process_commands_section3(channel, sender, command, argument, sock_file):
+    else:
+        pending["buffer"] = pending.get("buffer", "") + "\n" + user_input
+        command_output(channel, "Current multiline input:\n" + pending["buffer"])
+
+#############################################
+# Async Event Loop Core
+#############################################
+
+# Chat turns and channel commands are jobs in the channel's mailbox (see ChannelState); one asyncio task
+# per busy channel drains it, so the prompt stays live while a reply streams. !cancel stops the reply.
+
+# Commands that may run while a reply is still streaming on the channel; everything else waits its turn.
+CONCURRENT_COMMANDS = ["cancel", "character", "help", "setcolor", "connection", "context", "characterlist", "convomodel", "sysmodel", "queue", "cache", "characters", "search", "stats", "trace"]
+
+async def channel_worker(state):
+    try:
+        while state.mailbox:
+            session, job, future = state.mailbox.popleft()
+            # Each job reports back to whoever queued it, even when several users share a channel.
+            current_session.set(session)
+            try:
+                result = await job()
+                if future and not future.done():
+                    future.set_result(result)
+            except (Exception, SystemExit) as e:
+                # SystemExit (from !exit) is handed to the waiting caller so the REPL shuts down normally.
+                if future and not future.done():
+                    future.set_exception(e)
+                elif isinstance(e, SystemExit):
+                    raise
+                else:
+                    command_output(state.channel, f"Error handling message: {e}")
+    finally:
+        state.worker = None
+
+def post_job(channel, job, wait=True):
+    # Queues a job on the channel's mailbox and starts the worker if the channel was idle. Returns a
+    # future resolved with the job's result when wait is set.
+    state = channel_state(channel)
+    busy = state.worker is not None
+    future = asyncio.get_running_loop().create_future() if wait else None
+    state.mailbox.append((current_session.get(), job, future))
+    if not busy:
+        state.worker = asyncio.get_running_loop().create_task(channel_worker(state))
+    return future, busy
+
+def run_in_channel(channel, func, *args):
+    # Wraps a blocking handler as a mailbox job: it runs on a worker thread while holding the channel lock.
+    def locked_call():
+        with channel_state(channel).lock:
+            return func(*args)
+    async def job():
+        return await asyncio.to_thread(locked_call)
+    return job
+
+async def call_in_channel(channel, func, *args, wait=True):
+    # An idle channel runs the job right away and returns its result. On a busy channel the job is only
+    # queued unless wait is set: the worker reports its output when it runs, and the prompt stays free
+    # for more input and !cancel. Queued jobs return None.
+    busy = channel_state(channel).worker is not None
+    future, _ = post_job(channel, run_in_channel(channel, func, *args), wait=wait or not busy)
+    if future is None:
+        command_output(channel, "Queued behind earlier work on this channel; it runs when that finishes (!cancel stops a streaming reply).")
+        return None
+    if busy:
+        command_output(channel, "Waiting for earlier work on this channel to finish...")
+    return await future
+
+def chat_turn(channel, user_input):
+    async def job():
+        state = channel_state(channel)
+        state.cancel_event = threading.Event()
+        label = metrics_command.set("chat")
+        try:
+            with state.lock:
+                load_conversation_history(channel)
+                conversation_histories[channel].append({"role": "user", "content": user_input})
+                payload = {"model": CONVO_MODEL, "messages": build_context(channel), "stream": True}
+            # The stream itself runs without the lock so background jobs are not held up for a whole reply;
+            # the mailbox already keeps other jobs for this channel waiting.
+            await asyncio.to_thread(process_api_request_stream, channel, payload, None, state.cancel_event)
+        finally:
+            state.cancel_event = None
+            metrics_command.reset(label)
+    job.chat_turn = True
+    return job
+
+def submit_message(channel, user_input):
+    conversation_output(channel, "user", user_input)
+    _, busy = post_job(channel, chat_turn(channel, user_input), wait=False)
+    if busy:
+        waiting = len(channel_state(channel).mailbox)
+        command_output(channel, f"Queued; {waiting} job(s) waiting on this channel.")
+
+def cancel_generation(channel, clear_queue=False):
+    state = channel_state(channel)
+    dropped = 0
+    if clear_queue:
+        kept = collections.deque(entry for entry in state.mailbox if not getattr(entry[1], "chat_turn", False))
+        dropped = len(state.mailbox) - len(kept)
+        state.mailbox.clear()
+        state.mailbox.extend(kept)
+    event = state.cancel_event
+    if event:
+        event.set()
+    return event is not None, dropped
+
+def active_usernames():
+    return [session.username for session in connected_sessions]
+
+async def handle_input(user_input):
+    session = current_session.get()
+    channel = session.channel
+    sender = session.username or "User"
+    sock_file = session if session.remote else None
+    if channel in confirmation_pending:
+        if await call_in_channel(channel, process_confirmation_response, channel, sender, user_input, sock_file, wait=False) is not False:
+            return
+    if channel in multi_input_pending:
+        await call_in_channel(channel, process_multi_input, channel, user_input, wait=False)
         return
-    if process_commands_section4(channel, sender, command, argument, sock_file, active_users):
+    if user_input.startswith("!"):
+        parts = user_input[1:].split(" ", 1)
+        cmd = parts[0].lower()
+        arg = parts[1] if len(parts) > 1 else ""
+        if cmd == "cancel":
+            stopped, dropped = cancel_generation(channel, arg.strip().lower() == "all")
+            if not stopped and not dropped:
+                command_output(channel, "Nothing to cancel.")
+            elif dropped:
+                command_output(channel, f"Dropped {dropped} queued message(s).")
+            return
+        if cmd == "character":
+            # Switching never waits; a reply still streaming for the old character finishes in the background.
+            if arg.strip():
+                await asyncio.to_thread(switch_character, channel, arg.strip())
+            else:
+                command_output(channel, "Usage: !character {name}")
+            return
+        if cmd in CONCURRENT_COMMANDS:
+            await asyncio.to_thread(process_commands, channel, sender, cmd, arg, sock_file, active_usernames())
+        else:
+            # !exit still waits so the prompt closes once the channel's earlier work is done.
+            await call_in_channel(channel, process_commands, channel, sender, cmd, arg, sock_file, active_usernames(), wait=cmd == "exit")
         return
-    command_output(channel, "Unknown command. Type !help for a list of commands.")
+    submit_message(channel, user_input)
+
+class InputReader:
+    # input() runs on a daemon thread of its own rather than the default executor: a read that Ctrl+C
+    # abandons would otherwise keep asyncio.run from returning until Enter is pressed.
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.thread = None
+
+    async def read(self, prompt):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.requests.put((prompt, loop, future))
+        return await future
+
+    def run(self):
+        while True:
+            prompt, loop, future = self.requests.get()
+            try:
+                line, error = input(prompt), None
+            except Exception as e:
+                line, error = None, e
+            loop.call_soon_threadsafe(self.settle, future, line, error)
+
+    @staticmethod
+    def settle(future, line, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+input_reader = InputReader()
+
+async def repl():
+    try:
+        while True:
+            try:
+                prompt_str = f"[{get_current_channel()}] {session_username()} > "
+                user_input = await input_reader.read(prompt_str)
+            except EOFError:
+                command_output(get_current_channel(), "EOF encountered. Exiting interactive mode.")
+                break
+            user_input = user_input.strip()
+            if not user_input:
+                continue
+            await handle_input(user_input)
+        # Let queued replies finish (they are journaled as they land) unless the user cancels them.
+        pending = [state.worker for state in list(channel_states.values()) if state.worker and not state.worker.done()]
+        if pending:
+            command_output(get_current_channel(), "Waiting for replies still in flight...")
+            await asyncio.wait(pending)
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        # asyncio.run turns Ctrl+C into a cancellation of this task. Stop what is streaming, drop queued
+        # turns and save like !exit does.
+        channel = get_current_channel()
+        command_output(channel, "KeyboardInterrupt received. Exiting.")
+        for name in list(channel_states):
+            cancel_generation(name, clear_queue=True)
+        save_conversation(channel)
+        export_conversation(channel)
+
+#############################################
+# Network Server Mode
+#############################################
+
+SERVER_HOST = "127.0.0.1"  # other interfaces only when --listen HOST:PORT names one
+SERVER_PORT = 4321
+
+connected_sessions = set()
+
+async def serve_connection(reader, writer):
+    # Line-based protocol (works with telnet/nc): the first line is the username, every following line is
+    # handled exactly like a line typed at the local prompt.
+    session = Session(writer=writer, loop=asyncio.get_running_loop())
+    current_session.set(session)
+    peer = writer.get_extra_info("peername")
+    try:
+        session.write("Enter your username: ")
+        line = await reader.readline()
+        if not line:
+            return
+        session.username = line.decode("utf-8", "replace").strip() or "guest"
+        connected_sessions.add(session)
+        command_output(session.channel, f"Welcome to Velvet's (py)chai version {VERSION}! Logged in as {session.username}.")
+        command_output(session.channel, "Type !help for list of commands.")
+        load_conversation_history(session.channel)
+        local_session.write(f"{role_colors['command']}{session.username} connected from {peer}.\033[0m\n")
+        while not session.exit_requested:
+            session.write(f"[{session.channel}] {session.username} > ")
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                break
+            user_input = line.decode("utf-8", "replace").strip()
+            if not user_input:
+                continue
+            try:
+                await handle_input(user_input)
+            except Exception as e:
+                command_output(session.channel, f"Error handling input: {e}")
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        connected_sessions.discard(session)
+        if session.username:
+            save_conversation(session.channel)
+        session.closed = True
+        writer.close()
+        local_session.write(f"{role_colors['command']}{session.username or peer} disconnected.\033[0m\n")
+
+async def run_server(host, port):
+    server = await asyncio.start_server(serve_connection, host, port)
+    command_output("#welcome", f"Serving pychai on {host}:{port}. Press Ctrl+C to stop.")
+    async with server:
+        await server.serve_forever()
+
+#############################################
+# Headless Mode
+#############################################
+
+ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*m")
+
+class HeadlessSession(Session):
+    # Collects command output instead of printing it, so stdout carries nothing but the JSON result.
+    def __init__(self, username="headless", channel="#welcome"):
+        super().__init__(username, channel)
+        self.log = []
+
+    @property
+    def remote(self):
+        # Treated like a network client: no spinner thread is started.
+        return True
+
+    def write(self, text):
+        text = ANSI_ESCAPE.sub("", text).strip()
+        if text:
+            self.log.append(text)
+
+def run_headless(character, turns, model=None, endpoint=None, save=False):
+    # Runs each of turns as a user message to character, one non-streaming request per turn, and returns a
+    # JSON-serialisable dict. With endpoint set that URL is pinned; without it the run starts on the local
+    # endpoint instead of probing and only moves on if a request fails. save appends the turns to the
+    # character's saved conversation.
+    ensure_folders()
+    if endpoint:
+        pin_endpoint(endpoint)
+    elif endpoint_state["base_url"] is None:
+        set_endpoint(LOCAL_BASE_URL)
+    channel = "#" + character.lstrip("#")
+    session = HeadlessSession(channel=channel)
+    token = current_session.set(session)
+    label = metrics_command.set("headless")
+    model = model or CONVO_MODEL
+    result = {"character": channel.lstrip("#"), "model": model, "turns": [], "ok": True}
+    try:
+        load_conversation_history(channel)
+        for user_input in turns:
+            turn = {"user": user_input}
+            result["turns"].append(turn)
+            start = time.time()
+            with channel_state(channel).lock:
+                conversation_histories[channel].append({"role": "user", "content": user_input})
+                payload = {"model": model, "messages": build_context(channel), "stream": False}
+                track_prefix(channel, payload["messages"])
+            try:
+                response = lm_post(payload)
+                if response.status_code != 200:
+                    raise RuntimeError(f"API Error: {response.status_code}")
+                data = response.json()
+                reply = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
+            except Exception as e:
+                # Later turns would be answered without this one's reply, so the script stops here.
+                conversation_histories[channel].pop()
+                turn["error"] = str(e)
+                result["ok"] = False
+                break
+            with channel_state(channel).lock:
+                conversation_histories[channel].append({"role": "assistant", "content": reply})
+            turn["assistant"] = reply
+            turn["elapsed"] = round(time.time() - start, 3)
+            if data.get("usage"):
+                turn["usage"] = data["usage"]
+        if save:
+            save_conversation(channel)
+            close_journals()
+        character_store.close()
+    finally:
+        metrics_command.reset(label)
+        current_session.reset(token)
+    result["endpoint"] = endpoint_state["base_url"]
+    result["log"] = session.log
+    return result
+
+def read_headless_turns(args):
+    turns = list(args.message or [])
+    if args.script:
+        if args.script == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.script, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        turns.extend(line for line in lines if line.strip())
+    return turns
 
 #############################################
 # Main Command-Line Interface Loop
 #############################################
 
-def main():
-    global current_channel, SYS_MODEL, CONVO_MODEL, username, server_status
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Velvet's (py)chai")
+    parser.add_argument("--listen", metavar="[HOST:]PORT", nargs="?", const=str(SERVER_PORT),
+                        help=f"serve many users over TCP instead of the local prompt (default {SERVER_HOST}:{SERVER_PORT}; "
+                             "clients are not authenticated, so only name another host on a trusted network)")
+    parser.add_argument("--batch-create", metavar="SPECS",
+                        help="generate characters from a JSONL/CSV spec file and exit")
+    parser.add_argument("--force", action="store_true",
+                        help="with --batch-create, regenerate characters that already have a system prompt")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CREATE_CONCURRENCY,
+                        help=f"with --batch-create, system prompts generated at once (default {BATCH_CREATE_CONCURRENCY})")
+    parser.add_argument("--headless", metavar="CHARACTER",
+                        help="run the turns given by --message/--script against CHARACTER, print JSON and exit")
+    parser.add_argument("-m", "--message", action="append",
+                        help="with --headless, a user message to send (repeatable)")
+    parser.add_argument("--script", metavar="FILE",
+                        help="with --headless, a file of user messages, one per line ('-' reads stdin)")
+    parser.add_argument("--endpoint", metavar="URL",
+                        help="use this LM Studio base URL without probing, e.g. http://localhost:1234")
+    parser.add_argument("--model", help="with --headless, the conversation model to use")
+    parser.add_argument("--save", action="store_true",
+                        help="with --headless, append the turns to the character's saved conversation")
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.headless and not (args.message or args.script):
+        parser.error("--headless needs --message or --script")
+    return args
+
+def ensure_folders():
     for folder in [BASE_FOLDER, CHARACTERS_FOLDER, SAVED_CONVOS_FOLDER, CONVERSATIONS_FOLDER]:
         if not os.path.exists(folder):
             os.makedirs(folder)
 
+def main():
+    global SYS_MODEL, CONVO_MODEL, server_status
+    args = parse_arguments()
+    if args.headless:
+        try:
+            turns = read_headless_turns(args)
+        except OSError as e:
+            print(json.dumps({"ok": False, "error": f"Error reading script: {e}"}))
+            sys.exit(1)
+        result = run_headless(args.headless, turns, args.model, args.endpoint, args.save)
+        print(json.dumps(result, ensure_ascii=False))
+        sys.exit(0 if result["ok"] else 1)
+    ensure_folders()
+    connection_status = None
+    if args.endpoint:
+        pin_endpoint(args.endpoint)
+        # Like headless mode, a pinned endpoint is used without probing it first.
+        connection_status = f"Using the LM Studio endpoint {endpoint_state['base_url']} given with --endpoint."
+
+    if args.batch_create:
+        command_output("#welcome", connection_status or test_connection())
+        try:
+            specs = load_character_specs(args.batch_create)
+        except (OSError, ValueError) as e:
+            command_output("#welcome", f"Error reading character specs: {e}")
+            sys.exit(1)
+        created, skipped, failed = batch_create_characters("#welcome", specs, args.concurrency, args.force)
+        command_output("#welcome", f"Batch create finished: {created} created, {skipped} skipped, {failed} failed.")
+        sys.exit(1 if failed else 0)
+
+    if args.listen:
+        server_status = connection_status or test_connection()
+        command_output("#welcome", server_status)
+        host, _, port = args.listen.rpartition(":")
+        try:
+            asyncio.run(run_server(host or SERVER_HOST, int(port)))
+        except KeyboardInterrupt:
+            command_output("#welcome", "Server stopped.")
+        finally:
+            close_journals()
+            character_store.close()
+        return
+
     if os.path.exists(USERNAME_FILE):
         with open(USERNAME_FILE, "r", encoding="utf-8") as f:
-            username = f.read().strip()
+            local_session.username = f.read().strip()
     else:
-        username = input("Enter your username: ").strip()
+        local_session.username = input("Enter your username: ").strip()
         with open(USERNAME_FILE, "w", encoding="utf-8") as f:
-            f.write(username)
+            f.write(local_session.username)
     
-    server_status = test_connection()
+    server_status = connection_status or test_connection()
     command_output("#welcome", server_status)
     
-    welcome_msg = f"Welcome to Velvet's (py)chai version {VERSION}! Logged in as {username}."
+    welcome_msg = f"Welcome to Velvet's (py)chai version {VERSION}! Logged in as {local_session.username}."
     command_output("#welcome", welcome_msg)
 
-    current_channel = "#welcome"
-    load_conversation_history(current_channel)
-    command_output(current_channel, f"Switched to default character channel: {current_channel}")
-    command_output(current_channel, "Type !help for list of commands.")
+    local_session.channel = "#welcome"
+    load_conversation_history(local_session.channel)
+    command_output(local_session.channel, f"Switched to default character channel: {local_session.channel}")
+    command_output(local_session.channel, "Type !help for list of commands.")
 
-    while True:
-        try:
-            prompt_str = f"[{current_channel}] {username} > "
-            user_input = input(prompt_str)
-        except EOFError:
-            command_output(current_channel, "EOF encountered. Exiting interactive mode.")
-            break
-        except KeyboardInterrupt:
-            command_output(current_channel, "KeyboardInterrupt received. Exiting.")
-            break
-        user_input = user_input.strip()
-        if not user_input:
-            continue
-
-        if current_channel in confirmation_pending:
-            if process_confirmation_response(current_channel, "User", user_input, None):
-                continue
-
-        if current_channel in multi_input_pending:
-            pending = multi_input_pending[current_channel]
-            if user_input.lower() == "cancel":
-                multi_input_pending.pop(current_channel, None)
-                command_output(current_channel, "Multiline input cancelled.")
-                continue
-            if pending["command"] == "questionset" and pending.get("single_line_first", False) and pending["question_index"] == 0:
-                pending.setdefault("answers", []).append(user_input.strip())
-                pending["buffer"] = ""
-                pending["question_index"] += 1
-                if pending["question_index"] < len(pending["questions"]):
-                    next_q = pending["questions"][pending["question_index"]]
-                    command_output(current_channel, next_q + " (type your answer then 'continue' when done or 'cancel' to abort)")
-                else:
-                    details = pending["answers"]
-                    ai_query = CUSTOM_QUESTIONSET_PROMPT + "\n" + (
-                        f"Name: {details[0]}\n"
-                        f"Background: {details[1]}\n"
-                        f"Personality: {details[2]}\n"
-                        f"Special Abilities/Additional Details: {details[3]}\n"
-                        f"Extra Instructions: {details[4]}"
-                    )
-                    response = run_with_progress("Generating Backstory", lambda: requests.post(get_lm_api_url(), json={"model": SYS_MODEL, "messages": [{"role": "user", "content": ai_query}], "stream": False}, headers={"Content-Type": "application/json"}))
-                    if response.status_code == 200:
-                        data = response.json()
-                        new_prompt = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
-                        if new_prompt:
-                            if current_channel in conversation_histories and conversation_histories[current_channel]:
-                                conversation_histories[current_channel][0]["content"] = new_prompt
-                            else:
-                                conversation_histories[current_channel] = [{"role": "system", "content": new_prompt}]
-                            char_name = current_channel.lstrip("#")
-                            with open(os.path.join(CHARACTERS_FOLDER, f"{char_name}.txt"), "w", encoding="utf-8") as f:
-                                f.write(new_prompt)
-                            command_output(current_channel, "Questionset prompt updated and backstory set.")
-                        else:
-                            command_output(current_channel, "LM Studio API returned an empty prompt for questionset.")
-                    else:
-                        command_output(current_channel, f"LM Studio API error during questionset: {response.status_code}")
-                    multi_input_pending.pop(current_channel, None)
-                continue
-
-            if user_input.lower() == "continue":
-                if pending["command"] == "set":
-                    complete_input = pending.get("buffer", "").strip()
-                    ai_prompt = CUSTOM_SET_PROMPT + "\nDetails: " + complete_input
-                    response = run_with_progress("Generating Backstory", lambda: requests.post(get_lm_api_url(), json={"model": SYS_MODEL, "messages": [{"role": "user", "content": ai_prompt}]}, headers={"Content-Type": "application/json"}))
-                    if response.status_code == 200:
-                        data = response.json()
-                        new_prompt = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
-                        if new_prompt:
-                            if current_channel in conversation_histories and conversation_histories[current_channel]:
-                                conversation_histories[current_channel][0]["content"] = new_prompt
-                            else:
-                                conversation_histories[current_channel] = [{"role": "system", "content": new_prompt}]
-                            char_name = current_channel.lstrip("#")
-                            with open(os.path.join(CHARACTERS_FOLDER, f"{char_name}.txt"), "w", encoding="utf-8") as f:
-                                f.write(new_prompt)
-                            command_output(current_channel, "System prompt updated via set command.")
-                        else:
-                            command_output(current_channel, "LM Studio API returned an empty prompt for set.")
-                    else:
-                        command_output(current_channel, f"LM Studio API error during set: {response.status_code}")
-                    multi_input_pending.pop(current_channel, None)
-                elif pending["command"] == "questionset":
-                    pending.setdefault("answers", []).append(pending.get("buffer", "").strip())
-                    pending["buffer"] = ""
-                    pending["question_index"] += 1
-                    if pending["question_index"] < len(pending["questions"]):
-                        next_q = pending["questions"][pending["question_index"]]
-                        command_output(current_channel, next_q + " (type your answer then 'continue' when done or 'cancel' to abort)")
-                    else:
-                        details = pending["answers"]
-                        ai_query = CUSTOM_QUESTIONSET_PROMPT + "\n" + (
-                            f"Name: {details[0]}\n"
-                            f"Background: {details[1]}\n"
-                            f"Personality: {details[2]}\n"
-                            f"Special Abilities/Additional Details: {details[3]}\n"
-                            f"Extra Instructions: {details[4]}"
-                        )
-                        response = run_with_progress("Generating Backstory", lambda: requests.post(get_lm_api_url(), json={"model": SYS_MODEL, "messages": [{"role": "user", "content": ai_query}], "stream": False}, headers={"Content-Type": "application/json"}))
-                        if response.status_code == 200:
-                            data = response.json()
-                            new_prompt = process_reply(data.get("choices", [{}])[0].get("message", {}).get("content", ""))
-                            if new_prompt:
-                                if current_channel in conversation_histories and conversation_histories[current_channel]:
-                                    conversation_histories[current_channel][0]["content"] = new_prompt
-                                else:
-                                    conversation_histories[current_channel] = [{"role": "system", "content": new_prompt}]
-                                char_name = current_channel.lstrip("#")
-                                with open(os.path.join(CHARACTERS_FOLDER, f"{char_name}.txt"), "w", encoding="utf-8") as f:
-                                    f.write(new_prompt)
-                                command_output(current_channel, "Questionset prompt updated and backstory set.")
-                            else:
-                                command_output(current_channel, "LM Studio API returned an empty prompt for questionset.")
-                        else:
-                            command_output(current_channel, f"LM Studio API error during questionset: {response.status_code}")
-                        multi_input_pending.pop(current_channel, None)
-                elif pending["command"] == "dialogue":
-                    complete_input = pending.get("buffer", "").strip()
-                    load_conversation_history(current_channel)
-                    conversation_histories[current_channel].append({"role": "user", "content": complete_input})
-                    payload = {"model": CONVO_MODEL, "messages": conversation_histories[current_channel], "stream": True}
-                    process_api_request_stream(current_channel, payload, None)
-                    multi_input_pending.pop(current_channel, None)
-                continue
-            else:
-                pending["buffer"] = pending.get("buffer", "") + "\n" + user_input
-                command_output(current_channel, "Current multiline input:\n" + pending["buffer"])
-                continue
-
-        if user_input.startswith("!"):
-            parts = user_input[1:].split(" ", 1)
-            cmd = parts[0].lower()
-            arg = parts[1] if len(parts) > 1 else ""
-            if cmd == "character":
-                save_conversation(current_channel)
-                if arg.strip():
-                    new_channel = "#" + arg.strip()
-                    char_file = os.path.join(CHARACTERS_FOLDER, f"{arg.strip()}.txt")
-                    current_channel = new_channel
-                    load_conversation_history(current_channel)
-                    if not os.path.exists(char_file):
-                        command_output(current_channel, f"Warning: Character file for '{arg.strip()}' does not exist. Using default prompt.")
-                    command_output(current_channel, f"Switched to character '{arg.strip()}'.")
-                else:
-                    command_output(current_channel, "Usage: !character {name}")
-                continue
-            process_commands(current_channel, "User", cmd, arg, None, None)
-            continue
-
-        # Append the user input (formatted) to the conversation history.
-        conversation_histories[current_channel].append({"role": "user", "content": user_input})
-        conversation_output(current_channel, "user", user_input)
-        # Send request with streaming; block input until complete.
-        payload = {"model": CONVO_MODEL, "messages": conversation_histories[current_channel], "stream": True}
-        process_api_request_stream(current_channel, payload, None)
+    try:
+        asyncio.run(repl())
+    finally:
+        close_journals()
+        character_store.close()
 
 if __name__ == "__main__":
     main()
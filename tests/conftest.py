@@ -0,0 +1,85 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pychai
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # pychai keeps everything under a relative memory/ folder, so each test runs in its own directory.
+    monkeypatch.chdir(tmp_path)
+    pychai.ensure_folders()
+    yield tmp_path
+    pychai.close_journals()
+    pychai.character_store.close()
+    pychai.conversation_histories.clear()
+
+
+@pytest.fixture
+def session():
+    # Captures command output instead of printing it.
+    session = pychai.HeadlessSession(channel="#bob")
+    token = pychai.current_session.set(session)
+    yield session
+    pychai.current_session.reset(token)
+
+
+class FakeResponse:
+    status_code = 200
+    url = "http://fake:1234/v1/chat/completions"
+
+    def __init__(self, content=""):
+        self.content = content
+
+    def json(self):
+        return {"choices": [{"message": {"role": "assistant", "content": self.content}}]}
+
+
+class FakeBackend:
+    # Stands in for lm_client. reply turns a request payload into the reply text; delay keeps each call in
+    # flight for a while so overlapping callers can be tested.
+    def __init__(self, reply=lambda payload: "ok", delay=0.0):
+        self.reply = reply
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.payloads = []
+        self.probes = []
+
+    def post(self, payload, **kwargs):
+        with self.lock:
+            self.payloads.append(payload)
+        if self.delay:
+            time.sleep(self.delay)
+        return FakeResponse(self.reply(payload))
+
+    def probe(self, base_url, timeout=None):
+        self.probes.append(base_url)
+        return FakeResponse()
+
+    def sent(self, prefix=""):
+        # Payloads whose last message starts with prefix.
+        return [payload for payload in self.payloads if payload["messages"][-1]["content"].startswith(prefix)]
+
+
+@pytest.fixture
+def backend(request, workdir, monkeypatch):
+    # Replaces the LM Studio client for one test. Parametrize indirectly with FakeBackend keyword arguments
+    # to change the replies; the response cache starts empty and disabled.
+    backend = FakeBackend(**getattr(request, "param", {}))
+    monkeypatch.setattr(pychai, "lm_client", backend)
+    monkeypatch.setattr(pychai, "RESPONSE_CACHE_ENABLED", False)
+    monkeypatch.setattr(pychai, "response_cache", pychai.ResponseCache(pychai.RESPONSE_CACHE_FOLDER))
+    monkeypatch.setattr(pychai, "single_flight", pychai.SingleFlight())
+    return backend
+
+
+@pytest.fixture
+def endpoint_state(monkeypatch):
+    monkeypatch.setattr(pychai, "endpoint_state", {"base_url": None, "checked_at": 0.0, "probing": False, "pinned": False})
+    return pychai.endpoint_state
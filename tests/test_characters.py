@@ -0,0 +1,32 @@
+import os
+import time
+
+import pychai
+
+CHANNEL = "#bob"
+
+
+def write_prompt(text, mtime):
+    os.makedirs(pychai.CHARACTERS_FOLDER, exist_ok=True)
+    path = os.path.join(pychai.CHARACTERS_FOLDER, "bob.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.utime(path, (mtime, mtime))
+
+
+def test_reload_picks_up_a_prompt_file_edited_while_running(workdir, session):
+    pychai.character_store.put("bob", "old prompt")
+    pychai.load_conversation_history(CHANNEL)
+    assert pychai.conversation_histories[CHANNEL][0]["content"] == "old prompt"
+
+    write_prompt("edited by hand", time.time() + 60)
+    pychai.process_commands(CHANNEL, "tester", "reload", "", None, [])
+    assert pychai.conversation_histories[CHANNEL][0]["content"] == "edited by hand"
+    assert pychai.character_store.get("bob") == "edited by hand"
+
+
+def test_load_skips_a_prompt_file_older_than_the_store(workdir):
+    pychai.character_store.put("bob", "stored prompt")
+    write_prompt("stale file", time.time() - 60)
+    pychai.load_conversation_history(CHANNEL)
+    assert pychai.conversation_histories[CHANNEL][0]["content"] == "stored prompt"
@@ -0,0 +1,33 @@
+import json
+import os
+import time
+
+import pychai
+
+CHANNEL = "#bob"
+
+
+def test_background_compaction_reports_to_the_triggering_session(workdir, session, monkeypatch):
+    monkeypatch.setattr(pychai, "COMPACTION_ENABLED", True)
+    monkeypatch.setattr(pychai, "compaction_cut", lambda channel, history: 2)
+
+    def fail(channel):
+        raise RuntimeError(f"boom for {pychai.session_username()}")
+    monkeypatch.setattr(pychai, "compact_channel", fail)
+    pychai.conversation_histories[CHANNEL] = [{"role": "system", "content": "You are Bob."}]
+    pychai.schedule_compaction(CHANNEL)
+    deadline = time.time() + 2
+    while CHANNEL in pychai.compaction_inflight and time.time() < deadline:
+        time.sleep(0.01)
+    assert "Background summarisation failed: boom for headless" in session.log
+
+
+def test_sidecars_live_next_to_the_journal(workdir):
+    legacy = os.path.join(pychai.SAVED_CONVOS_FOLDER, "bob_hints.json")
+    with open(legacy, "w", encoding="utf-8") as f:
+        json.dump({"hint": "be brief", "notes": []}, f)
+    assert pychai.get_channel_hints(CHANNEL)["hint"] == "be brief"
+    assert not os.path.exists(legacy)
+    assert os.path.dirname(pychai.hints_file(CHANNEL)) == os.path.dirname(pychai.journal_file(CHANNEL))
+    assert os.path.dirname(pychai.summary_file(CHANNEL)) == pychai.CONVERSATIONS_FOLDER
+    pychai.channel_hints.pop(CHANNEL, None)
@@ -0,0 +1,29 @@
+import pychai
+
+
+def test_pinned_endpoint_survives_test_connection(backend, endpoint_state):
+    pychai.pin_endpoint("http://10.0.0.5:1234/")
+    assert pychai.test_connection().startswith("Connected to LM Studio at http://10.0.0.5:1234")
+    assert backend.probes == ["http://10.0.0.5:1234"]
+    assert pychai.get_base_url() == "http://10.0.0.5:1234"
+
+
+def test_pinned_endpoint_ignores_set_endpoint_and_failover(endpoint_state):
+    pychai.pin_endpoint("http://10.0.0.5:1234")
+    pychai.set_endpoint(pychai.LOCAL_BASE_URL)
+    pychai.mark_endpoint_failed("http://10.0.0.5:1234")
+    assert pychai.get_base_url() == "http://10.0.0.5:1234"
+
+
+def test_unpinned_test_connection_switches_endpoint(backend, endpoint_state):
+    pychai.set_endpoint(pychai.REMOTE_BASE_URL)
+    pychai.test_connection()
+    assert endpoint_state["base_url"] == pychai.LOCAL_BASE_URL
+
+
+def test_headless_without_endpoint_never_probes(backend, endpoint_state):
+    result = pychai.run_headless("bob", ["hello"])
+    assert result["ok"]
+    assert backend.probes == []
+    assert endpoint_state["base_url"] == pychai.LOCAL_BASE_URL
+    assert not endpoint_state["pinned"]
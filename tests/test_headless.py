@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+import pychai
+
+echo = {"reply": lambda payload: "reply to " + payload["messages"][-1]["content"]}
+
+
+def saved(channel="#bob"):
+    return [(msg["role"], msg["content"]) for msg in pychai.replay_journal(pychai.journal_file(channel))]
+
+
+@pytest.mark.parametrize("backend", [echo], indirect=True)
+def test_save_appends_to_the_saved_conversation(backend):
+    first = pychai.run_headless("bob", ["one"], save=True)
+    pychai.conversation_histories.clear()
+    second = pychai.run_headless("bob", ["two", "three"], save=True)
+    assert first["ok"] and second["ok"]
+    assert saved()[1:] == [
+        ("user", "one"), ("assistant", "reply to one"),
+        ("user", "two"), ("assistant", "reply to two"),
+        ("user", "three"), ("assistant", "reply to three"),
+    ]
+    assert saved()[0][0] == "system"
+
+
+@pytest.mark.parametrize("backend", [echo], indirect=True)
+def test_without_save_nothing_is_journaled(backend):
+    result = pychai.run_headless("bob", ["one"])
+    assert result["turns"][0]["assistant"] == "reply to one"
+    assert not os.path.exists(pychai.journal_file("#bob"))
@@ -0,0 +1,134 @@
+import pychai
+
+CHANNEL = "#bob"
+SYSTEM = {"role": "system", "content": "You are Bob."}
+
+
+def turns(count, start=0):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"} for i in range(start, start + count)]
+
+
+def journal_lines(channel=CHANNEL):
+    return pychai.count_journal_lines(pychai.journal_file(channel))
+
+
+def test_first_sync_writes_one_record_per_message(workdir):
+    history = [SYSTEM] + turns(4)
+    pychai.conversation_histories[CHANNEL] = history
+    pychai.sync_journal(CHANNEL)
+    pychai.flush_journal(CHANNEL)
+    assert pychai.replay_journal(pychai.journal_file(CHANNEL)) == history
+    assert journal_lines() == 5
+
+
+def test_appends_only_new_messages(workdir):
+    history = [SYSTEM] + turns(4)
+    pychai.conversation_histories[CHANNEL] = history
+    pychai.sync_journal(CHANNEL)
+    history.extend(turns(2, start=4))
+    pychai.sync_journal(CHANNEL)
+    pychai.sync_journal(CHANNEL)
+    pychai.flush_journal(CHANNEL)
+    assert journal_lines() == 7
+    assert pychai.replay_journal(pychai.journal_file(CHANNEL)) == history
+
+
+def test_edits_round_trip_through_truncate_records(workdir):
+    history = [SYSTEM] + turns(6)
+    pychai.conversation_histories[CHANNEL] = history
+    pychai.sync_journal(CHANNEL)
+    history[3] = {"role": "user", "content": "edited", "pinned": True}
+    del history[5:]
+    history.append({"role": "assistant", "content": "new reply"})
+    pychai.sync_journal(CHANNEL)
+    pychai.flush_journal(CHANNEL)
+    path = pychai.journal_file(CHANNEL)
+    with open(path, "rb") as f:
+        assert b'{"op": "truncate", "length": 3}' in f.read()
+    assert pychai.replay_journal(path) == history
+
+    pychai.ensure_clean_journal(CHANNEL)
+    assert journal_lines() == len(history)
+    assert pychai.read_journal_lines(path, 0) == history
+
+
+def test_repeated_edits_compact_the_journal(workdir, monkeypatch):
+    monkeypatch.setattr(pychai, "JOURNAL_COMPACT_SLACK", 4)
+    history = [SYSTEM] + turns(4)
+    pychai.conversation_histories[CHANNEL] = history
+    pychai.sync_journal(CHANNEL)
+    for i in range(20):
+        history[-1] = {"role": "assistant", "content": f"regenerated {i}"}
+        pychai.sync_journal(CHANNEL)
+    pychai.flush_journal(CHANNEL)
+    assert journal_lines() <= 2 * len(history) + 4
+    assert pychai.replay_journal(pychai.journal_file(CHANNEL)) == history
+
+
+def test_load_last_keeps_older_messages_in_the_journal(workdir, session):
+    saved = turns(10)
+    pychai.conversation_histories[CHANNEL] = [SYSTEM] + saved
+    pychai.sync_journal(CHANNEL)
+    pychai.close_journals()
+    pychai.conversation_histories[CHANNEL] = [SYSTEM]
+
+    pychai.process_commands(CHANNEL, "tester", "load", "last 3", None, [])
+    assert pychai.conversation_histories[CHANNEL] == [SYSTEM] + saved[-3:]
+    assert "Conversation history loaded: 3 messages (older 7 messages left in the journal)." in session.log
+
+    # Later saves append behind the messages that were never loaded, and edits only touch the loaded window.
+    pychai.conversation_histories[CHANNEL][-1] = {"role": "assistant", "content": "edited"}
+    pychai.conversation_histories[CHANNEL].append({"role": "user", "content": "after load"})
+    pychai.save_conversation(CHANNEL)
+    expected = [SYSTEM] + saved[:-1] + [{"role": "assistant", "content": "edited"}, {"role": "user", "content": "after load"}]
+    assert pychai.replay_journal(pychai.journal_file(CHANNEL)) == expected
+
+
+def test_load_range_prints_without_restoring(workdir, session):
+    pychai.conversation_histories[CHANNEL] = [SYSTEM] + turns(4)
+    pychai.sync_journal(CHANNEL)
+    pychai.close_journals()
+    pychai.conversation_histories[CHANNEL] = [SYSTEM]
+    pychai.process_commands(CHANNEL, "tester", "load", "2-3", None, [])
+    assert pychai.conversation_histories[CHANNEL] == [SYSTEM]
+    assert "[2]" in session.log and "[3]" in session.log and "[4]" not in session.log
+
+
+def test_new_session_appends_behind_an_existing_journal(workdir):
+    earlier = turns(20)
+    pychai.conversation_histories[CHANNEL] = [SYSTEM] + earlier
+    pychai.sync_journal(CHANNEL)
+    pychai.close_journals()
+
+    # A new session replies before anyone runs !load; the earlier conversation must survive.
+    pychai.conversation_histories[CHANNEL] = [SYSTEM] + turns(2, start=100)
+    pychai.record_reply(CHANNEL)
+    pychai.flush_journal(CHANNEL)
+    assert journal_lines() == 23
+    assert pychai.replay_journal(pychai.journal_file(CHANNEL)) == [SYSTEM] + earlier + turns(2, start=100)
+
+    # Edits in the new session stay behind the earlier records.
+    pychai.conversation_histories[CHANNEL][-1] = {"role": "assistant", "content": "edited"}
+    pychai.sync_journal(CHANNEL)
+    pychai.ensure_clean_journal(CHANNEL)
+    assert pychai.replay_journal(pychai.journal_file(CHANNEL))[:21] == [SYSTEM] + earlier
+    assert pychai.replay_journal(pychai.journal_file(CHANNEL))[-1]["content"] == "edited"
+
+
+def test_range_view_after_an_edit_keeps_older_records(workdir, session):
+    pychai.conversation_histories[CHANNEL] = [SYSTEM] + turns(20)
+    pychai.sync_journal(CHANNEL)
+    pychai.close_journals()
+    pychai.conversation_histories[CHANNEL] = [SYSTEM]
+
+    pychai.process_commands(CHANNEL, "tester", "load", "last 4", None, [])
+    pychai.conversation_histories[CHANNEL][2] = {"role": "assistant", "content": "edited"}
+    pychai.sync_journal(CHANNEL)
+    pychai.process_commands(CHANNEL, "tester", "load", "1-3", None, [])
+    pychai.conversation_histories[CHANNEL].append({"role": "user", "content": "next"})
+    pychai.record_reply(CHANNEL)
+    pychai.flush_journal(CHANNEL)
+
+    expected = [SYSTEM] + turns(17) + [{"role": "assistant", "content": "edited"}] + turns(2, start=18) + [{"role": "user", "content": "next"}]
+    assert pychai.replay_journal(pychai.journal_file(CHANNEL)) == expected
+    assert journal_lines() == 22
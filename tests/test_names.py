@@ -0,0 +1,68 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import pychai
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def files_under(folder):
+    return {os.path.relpath(os.path.join(root, name), folder) for root, _, names in os.walk(folder) for name in names}
+
+
+@pytest.fixture
+def server(workdir):
+    port = free_port()
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(pychai.run_server("127.0.0.1", port))
+
+    def serve():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    yield port
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(5)
+    loop.close()
+
+
+def test_hostile_names_over_the_socket_stay_inside_memory(server, workdir):
+    before = files_under(workdir)
+    with socket.create_connection(("127.0.0.1", server), timeout=5) as sock:
+        stream = sock.makefile("rwb")
+        for line in ["mallory", "!character ../../escape", "!create ../x", "!duplicate ..", "!exit"]:
+            stream.write(line.encode() + b"\n")
+            stream.flush()
+        output = stream.read().decode("utf-8", "replace")
+    assert output.count("Invalid character name") == 3
+    written = files_under(workdir) - before
+    assert written and all(path.startswith("memory" + os.sep) for path in written)
+    assert not os.path.exists(os.path.join(workdir, "escape.jsonl"))
+    assert not pychai.character_store.get("../x")
+
+
+def test_paths_refuse_names_that_leave_their_folder(workdir):
+    with pytest.raises(ValueError):
+        pychai.journal_file("#../../escape")
+    assert pychai.journal_file("#bob").endswith(os.path.join("conversations", "bob.jsonl"))
+    assert not pychai.valid_character_name(".hidden")
+    assert not pychai.valid_character_name("a/b")
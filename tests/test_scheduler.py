@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pychai
+from pychai import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_SYSTEM, RequestScheduler
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def queue_request(scheduler, model, priority, started, release):
+    def run():
+        with scheduler.slot(model, priority):
+            started.append((model, priority, name))
+            release.wait(2)
+    name = f"{pychai.PRIORITY_NAMES[priority]}-{len(scheduler.waiting)}"
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_background_jobs_leave_reserved_slots_free():
+    scheduler = RequestScheduler(default_limit=4, limits={"small": 2}, reserved=1)
+    assert scheduler.limit("big", PRIORITY_INTERACTIVE) == 4
+    assert scheduler.limit("big", PRIORITY_BULK) == 3
+    assert scheduler.limit("small", PRIORITY_SYSTEM) == 1
+    assert RequestScheduler(default_limit=1, limits={}, reserved=1).limit("m", PRIORITY_BULK) == 1
+
+
+def test_waiting_requests_start_in_priority_then_arrival_order():
+    scheduler = RequestScheduler(default_limit=1, limits={}, reserved=0)
+    started, release = [], threading.Event()
+    threads = []
+    with scheduler.slot("m", PRIORITY_BULK):
+        for priority in [PRIORITY_BULK, PRIORITY_SYSTEM, PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_SYSTEM]:
+            count = len(scheduler.waiting)
+            threads.append(queue_request(scheduler, "m", priority, started, release))
+            wait_until(lambda: len(scheduler.waiting) == count + 1)
+    release.set()
+    for thread in threads:
+        thread.join(2)
+    assert [name for _, _, name in started] == ["interactive-3", "system-1", "system-4", "bulk-0", "bulk-2"]
+
+
+def test_interactive_turn_takes_the_reserved_slot():
+    scheduler = RequestScheduler(default_limit=2, limits={}, reserved=1)
+    started, release = [], threading.Event()
+    queue_request(scheduler, "m", PRIORITY_BULK, started, release)
+    wait_until(lambda: len(started) == 1)
+    queue_request(scheduler, "m", PRIORITY_BULK, started, release)
+    wait_until(lambda: len(scheduler.waiting) == 1)
+    queue_request(scheduler, "m", PRIORITY_INTERACTIVE, started, release)
+    wait_until(lambda: len(started) == 2)
+    assert started[1][1] == PRIORITY_INTERACTIVE
+    assert scheduler.active["m"] == 2
+    release.set()
+    wait_until(lambda: len(started) == 3 and scheduler.active["m"] == 0)
+
+
+def test_models_are_limited_independently():
+    scheduler = RequestScheduler(default_limit=1, limits={}, reserved=0)
+    started, release = [], threading.Event()
+    with scheduler.slot("a", PRIORITY_BULK):
+        queue_request(scheduler, "b", PRIORITY_BULK, started, release)
+        wait_until(lambda: len(started) == 1)
+        assert scheduler.status() == ["a: 1/1 in flight", "b: 1/1 in flight"]
+    release.set()
+
+
+def test_bulk_submitters_block_once_the_queue_is_full():
+    scheduler = RequestScheduler(default_limit=1, limits={}, reserved=0, max_queued=1)
+    started, release = [], threading.Event()
+    with scheduler.slot("m", PRIORITY_INTERACTIVE):
+        queue_request(scheduler, "m", PRIORITY_BULK, started, release)
+        wait_until(lambda: scheduler.queued_bulk == 1)
+        queue_request(scheduler, "m", PRIORITY_BULK, started, release)
+        time.sleep(0.05)
+        assert len(scheduler.waiting) == 1
+        # Backpressure only applies to bulk work; system jobs still join the queue.
+        queue_request(scheduler, "m", PRIORITY_SYSTEM, started, release)
+        wait_until(lambda: len(scheduler.waiting) == 2)
+        assert scheduler.status() == ["m: 1/1 in flight, waiting: system 1, bulk 1"]
+    release.set()
+    wait_until(lambda: len(started) == 3)
+    assert [priority for _, priority, _ in started] == [PRIORITY_SYSTEM, PRIORITY_BULK, PRIORITY_BULK]
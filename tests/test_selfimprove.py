@@ -0,0 +1,48 @@
+import itertools
+
+import pytest
+
+import pychai
+
+CHANNEL = "#bob"
+IMPROVE = "Improve the following system prompt"
+GRADE = "On a scale from 0 to 100"
+
+
+def improving_reply():
+    # Every improve request gets a new prompt and every grade is 50.
+    counter = itertools.count(1)
+
+    def reply(payload):
+        content = payload["messages"][-1]["content"]
+        if content.startswith(GRADE):
+            return "50"
+        if content.startswith(IMPROVE):
+            return f"Improved prompt {next(counter)}"
+        return "Summary of the changes."
+    return reply
+
+
+@pytest.fixture
+def channel(backend, monkeypatch):
+    monkeypatch.setattr(pychai, "RESPONSE_CACHE_ENABLED", True)
+    pychai.conversation_histories[CHANNEL] = [{"role": "system", "content": "You are Bob."}]
+    yield CHANNEL
+    pychai.confirmation_pending.pop(CHANNEL, None)
+
+
+@pytest.mark.parametrize("backend", [{"reply": improving_reply()}], indirect=True)
+def test_rounds_without_progress_request_fresh_candidates(backend, channel, session):
+    pychai.process_commands(channel, "tester", "selfimprove", "90 rounds=6", None, [])
+    assert len(backend.sent(IMPROVE)) == 6
+    assert len(backend.sent(GRADE)) == 6
+    assert "Self-improve stopped after 6 round(s) without reaching 90; offering the best candidate (grade 50)." in session.log
+
+
+@pytest.mark.parametrize("backend", [{"reply": improving_reply()}], indirect=True)
+def test_rerunning_reuses_the_cached_first_candidate(backend, channel, session):
+    pychai.process_commands(channel, "tester", "selfimprove", "90 rounds=1", None, [])
+    pychai.confirmation_pending.pop(channel, None)
+    pychai.process_commands(channel, "tester", "selfimprove", "90 rounds=1", None, [])
+    assert len(backend.sent(IMPROVE)) == 1
+    assert len(backend.sent(GRADE)) == 1
@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+import pychai
+from pychai import SingleFlight
+
+
+def run_together(count, target):
+    results, errors = [None] * count, [None] * count
+
+    def call(index):
+        try:
+            results[index] = target()
+        except Exception as e:
+            errors[index] = e
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    return results, errors
+
+
+def slow_call(calls, result=None, error=None):
+    def func():
+        calls.append(1)
+        time.sleep(0.1)
+        if error:
+            raise error
+        return result if result is not None else object()
+    return func
+
+
+def test_overlapping_calls_share_one_result():
+    flights, calls = SingleFlight(), []
+    func = slow_call(calls)
+    results, errors = run_together(5, lambda: flights.run("key", func))
+    assert calls == [1]
+    assert errors == [None] * 5
+    assert all(result is results[0] for result in results)
+    assert flights.shared == 4
+    assert flights.flights == {}
+
+
+def test_overlapping_calls_share_the_leaders_error():
+    flights, calls = SingleFlight(), []
+    error = ConnectionError("refused")
+    results, errors = run_together(3, lambda: flights.run("key", slow_call(calls, error=error)))
+    assert calls == [1]
+    assert results == [None] * 3
+    assert all(e is error for e in errors)
+    # A failed flight is not remembered; the next call tries again.
+    assert flights.run("key", lambda: "retried") == "retried"
+
+
+def test_finished_calls_and_other_keys_are_not_shared():
+    flights, calls = SingleFlight(), []
+    assert flights.run("a", lambda: "first") == "first"
+    assert flights.run("a", lambda: "second") == "second"
+    threads = [threading.Thread(target=flights.run, args=(key, slow_call(calls))) for key in ["b", "c"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert len(calls) == 2
+    assert flights.shared == 0
+
+
+slow = {"reply": lambda payload: "shared", "delay": 0.1}
+
+
+@pytest.mark.parametrize("backend", [slow], indirect=True)
+def test_lm_post_coalesces_identical_requests(backend):
+    payload = {"model": pychai.CONVO_MODEL, "messages": [{"role": "user", "content": "hi"}], "stream": False}
+    results, errors = run_together(4, lambda: pychai.lm_post(dict(payload)))
+    assert len(backend.payloads) == 1
+    assert errors == [None] * 4
+    assert all(result is results[0] for result in results)
+
+
+@pytest.mark.parametrize("backend", [slow], indirect=True)
+def test_lm_post_without_cache_always_sends(backend):
+    payload = {"model": pychai.CONVO_MODEL, "messages": [{"role": "user", "content": "hi"}], "stream": False}
+    results, errors = run_together(3, lambda: pychai.lm_post(dict(payload), cache=False))
+    assert len(backend.payloads) == 3
+    assert errors == [None] * 3
+    assert len({id(result) for result in results}) == 3
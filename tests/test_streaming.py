@@ -0,0 +1,65 @@
+import json
+
+from pychai import SSEDecoder, TokenBuffer, stream_token
+
+
+def event(content):
+    return b"data: " + json.dumps({"choices": [{"delta": {"content": content}}]}).encode("utf-8") + b"\n\n"
+
+
+def decode(chunks):
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    return events + decoder.finish()
+
+
+def test_events_split_across_chunks_at_every_byte():
+    body = event("Hel") + event("lo, wörld") + b"data: [DONE]\n\n"
+    expected = decode([body])
+    assert [stream_token(data) for data in expected[:-1]] == ["Hel", "lo, wörld"]
+    assert expected[-1] == "[DONE]"
+    for size in range(1, 8):
+        assert decode(body[i:i + size] for i in range(0, len(body), size)) == expected
+
+
+def test_crlf_framing_comments_and_other_fields():
+    body = b": keep-alive\r\nevent: message\r\nid: 7\r\ndata: first\r\n\r\nretry: 100\r\ndata:second\r\n\r\n"
+    assert decode([body]) == ["first", "second"]
+
+
+def test_multiline_data_is_joined_with_newlines():
+    assert decode([b"data: one\ndata: two\n\n"]) == ["one\ntwo"]
+
+
+def test_bare_json_lines_are_events():
+    line = json.dumps({"choices": [{"delta": {"content": "hi"}}]}).encode("utf-8")
+    assert [stream_token(data) for data in decode([line + b"\n", line])] == ["hi", "hi"]
+
+
+def test_unterminated_last_event_is_flushed_by_finish():
+    decoder = SSEDecoder()
+    assert decoder.feed(b"data: tail") == []
+    assert decoder.finish() == ["tail"]
+    assert decoder.finish() == []
+
+
+def test_stream_token_ignores_events_without_content():
+    assert stream_token("not json") == ""
+    assert stream_token(json.dumps({"choices": []})) == ""
+    assert stream_token(json.dumps({"choices": [{"delta": {"role": "assistant"}}]})) == ""
+    assert stream_token(json.dumps({"choices": [{"delta": {"content": None}}]})) == ""
+
+
+def test_token_buffer_batches_writes(session):
+    writes = []
+    session.write = writes.append
+    tokens = TokenBuffer(interval=3600, max_chars=10)
+    for token in ["abc", "def", "ghij", "k"]:
+        tokens.add(token)
+    assert writes == ["abcdefghij"]
+    tokens.flush()
+    assert writes == ["abcdefghij", "k"]
+    assert tokens.text() == "abcdefghijk"
+    assert tokens.first_token_at is not None